@@ -1,16 +1,21 @@
 import json
 import urllib.request
 import urllib.error
+import urllib.parse
 import logging
 import os
+import time
 import datetime
-from utils import resource_path
+from utils import resource_path, estimate_tokens, truncate_for_log
+from diagnostics import build_timed_opener, request_metrics, prompt_stats
+from lorebook import select_entries
 
 class AIClient:
     def __init__(self, config_manager):
         self.cm = config_manager
         self.logger = logging.getLogger("AIClient")
         self.prompt_templates = self._load_prompt_templates()
+        self._opener = build_timed_opener()
 
     def reload_client(self):
         # 重新加载提示词模板
@@ -65,8 +70,8 @@ class AIClient:
             return f"{base_url}/{endpoint}"
         return f"{base_url}/v1/{endpoint}" if not base_url.endswith(endpoint) else base_url
 
-    def _make_request(self, url, payload=None, method='POST'):
-        api_key = self.cm.get("api_key")
+    def _make_request(self, url, payload=None, method='POST', msg_type=None, api_key=None, char_id=None):
+        api_key = api_key if api_key is not None else self.cm.get("api_key")
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}",
@@ -76,31 +81,104 @@ class AIClient:
         data = json.dumps(payload).encode('utf-8') if payload else None
         
         self.logger.info(f"Making request to: {url}")
-        if payload:
-            safe_payload = payload.copy()
-            if 'messages' in safe_payload:
-                self.logger.debug(f"Prompt: {safe_payload['messages']}")
-
+        # 完整的 messages 可能很长（人设、Lorebook、历史），只在 DEBUG 开启时序列化并截断
+        if payload and 'messages' in payload and self.logger.isEnabledFor(logging.DEBUG):
+            max_chars = (self.cm.snapshot().get("logging") or {}).get("payload_max_chars", 2000)
+            self.logger.debug(f"Prompt: {truncate_for_log(str(payload['messages']), max_chars)}")
+
+        # 请求指标（msg_type 为空的请求如拉取模型列表不做统计）
+        metrics = {"status": None, "ttfb_ms": None, "response_bytes": 0, "usage": None, "error": None}
+        req = urllib.request.Request(url, data=data, headers=headers, method=method)
+        req.timings = {}
+        started = time.perf_counter()
         try:
-            req = urllib.request.Request(url, data=data, headers=headers, method=method)
-            with urllib.request.urlopen(req, timeout=30) as response: # 增加超时时间
+            with self._opener.open(req, timeout=30) as response: # 增加超时时间
+                metrics["ttfb_ms"] = (time.perf_counter() - started) * 1000
+                metrics["status"] = response.status
                 resp_data = response.read()
+                metrics["response_bytes"] = len(resp_data)
                 self.logger.info(f"Response status: {response.status}")
                 # 记录原始返回数据，以便排查
                 raw_response = resp_data.decode('utf-8')
-                self.logger.debug(f"Raw API Response: {raw_response[:500]}...") # 只记录前500字符
-                return json.loads(raw_response)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Raw API Response: {raw_response[:500]}...") # 只记录前500字符
+                result = json.loads(raw_response)
+                if isinstance(result, dict):
+                    metrics["usage"] = result.get("usage")
+                return result
         except urllib.error.HTTPError as e:
             err_msg = e.read().decode('utf-8')
+            metrics["status"] = e.code
+            metrics["error"] = f"HTTP {e.code}"
             self.logger.error(f"HTTP Error {e.code}: {err_msg}")
             raise Exception(f"HTTP {e.code}: {err_msg}")
         except Exception as e:
+            metrics["error"] = type(e).__name__
             self.logger.error(f"Request failed: {str(e)}")
             raise e
+        finally:
+            if msg_type:
+                self._record_metrics(msg_type, url, payload, data, req.timings, started, metrics, char_id)
 
-    def get_models(self):
-        """Fetches available models from the API"""
-        base_url = self.cm.get("api_base_url").rstrip('/')
+    def _record_prompt_breakdown(self, msg_type, system_sections, messages, char_id=None):
+        """统计提示词各部分的字数和估算 Token，写一条结构化日志并计入角色（char_id，默认当前角色）汇总"""
+        try:
+            texts = dict(system_sections)
+            texts["history"] = "".join(m["content"] for m in messages[1:-1])
+            texts["task"] = messages[-1]["content"]
+            sections = {name: {"chars": len(text), "tokens": estimate_tokens(text)} for name, text in texts.items()}
+
+            # 系统提示词中除上述各部分之外的固定文本
+            system_content = messages[0]["content"]
+            sections["frame"] = {
+                "chars": max(0, len(system_content) - sum(len(t) for t in system_sections.values())),
+                "tokens": max(0, estimate_tokens(system_content) - sum(estimate_tokens(t) for t in system_sections.values()))
+            }
+
+            record = {
+                "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+                "msg_type": msg_type,
+                "messages": len(messages),
+                "total_chars": sum(v["chars"] for v in sections.values()),
+                "total_tokens": sum(v["tokens"] for v in sections.values()),
+                "sections": sections
+            }
+            self.logger.info(f"Prompt breakdown: {json.dumps(record, ensure_ascii=False)}")
+            prompt_stats.record(char_id or self.cm.get_current_character_id(), record)
+        except Exception as e:
+            self.logger.error(f"Failed to record prompt breakdown: {e}")
+
+    def _record_metrics(self, msg_type, url, payload, data, timings, started, metrics, char_id=None):
+        """记录一次请求的耗时、流量与 Token 用量（计入 char_id，默认当前角色）"""
+        try:
+            usage = metrics.get("usage") or {}
+            record = {
+                "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+                "msg_type": msg_type,
+                "model": (payload or {}).get("model") or self.cm.get("model"),
+                "endpoint": urllib.parse.urlparse(url).path,
+                "status": metrics["status"],
+                "dns_ms": timings.get("dns_ms"),
+                "connect_ms": timings.get("connect_ms"),
+                "ttfb_ms": metrics["ttfb_ms"],
+                "total_ms": (time.perf_counter() - started) * 1000,
+                "request_bytes": len(data) if data else 0,
+                "response_bytes": metrics["response_bytes"],
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "total_tokens": usage.get("total_tokens"),
+                "error": metrics["error"]
+            }
+            request_metrics.record(char_id or self.cm.get_current_character_id(), record)
+        except Exception as e:
+            self.logger.error(f"Failed to record request metrics: {e}")
+
+    def get_models(self, base_url=None, api_key=None):
+        """Fetches available models from the API
+
+        base_url / api_key 可传入设置界面中尚未保存的值，默认使用当前配置
+        """
+        base_url = (base_url or self.cm.get("api_base_url")).rstrip('/')
         if base_url.endswith('/chat/completions'):
             base_url = base_url.replace('/chat/completions', '')
         
@@ -108,7 +186,7 @@ class AIClient:
 
         self.logger.info(f"Fetching models from {url}")
         try:
-            result = self._make_request(url, method='GET')
+            result = self._make_request(url, method='GET', api_key=api_key)
             return [m['id'] for m in result.get('data', [])]
         except Exception as e:
             self.logger.error(f"Failed to get models: {e}")
@@ -173,11 +251,12 @@ class AIClient:
         return self._generate_message("character_switch_goodbye",
                                        next_character_info=next_character_info)
     
-    def get_character_switch_hello(self, prev_character_info):
+    def get_character_switch_hello(self, prev_character_info, snap=None):
         """获取角色切换后的欢迎消息
         prev_character_info: 上一个角色的信息 dict {name, persona, user_identity}
+        snap: 新角色的配置快照（ConfigManager.snapshot_for），给出时可在切换前提前生成
         """
-        return self._generate_message("character_switch_hello",
+        return self._generate_message("character_switch_hello", snap=snap,
                                        prev_character_info=prev_character_info)
 
     def get_daily_briefing_message(self, date_str, weekday_str, weather_info=""):
@@ -186,47 +265,109 @@ class AIClient:
                                       weekday=weekday_str, 
                                       weather=weather_info)
 
-    def _generate_message(self, msg_type, user_input=None, reminder_type=None, **kwargs):
-        api_key = self.cm.get("api_key")
-        base_url = self.cm.get("api_base_url")
+    def _recall_memories(self, snap, user_input, exclude_ids=(), user_name="用户", char_name="角色"):
+        """从全部聊天记录中检索与用户输入相关的往事（bm25 排序，取前 top_k 轮，总 Token 数不超过预算）"""
+        settings = snap.get("memory_recall") or {}
+        if not settings.get("enabled", True) or not user_input:
+            return ""
+        top_k = settings.get("top_k", 3)
+        token_budget = settings.get("token_budget", 400)
+        
+        try:
+            start = time.perf_counter()
+            hits = self.cm.search_chat_history(user_input, limit=top_k * 4, match_all=False,
+                                               exclude_ids=exclude_ids, char_id=snap.character_id)
+            seen = set(exclude_ids)
+            exchanges = []
+            used_tokens = 0
+            for hit in hits:
+                if len(exchanges) >= top_k:
+                    break
+                if hit["id"] in seen:
+                    continue
+                # 还原命中消息所在的一问一答
+                context = self.cm.get_chat_context(hit["id"], char_id=snap.character_id)
+                pos = next((i for i, m in enumerate(context) if m["id"] == hit["id"]), 0)
+                if hit["role"] == "user":
+                    pair = context[pos:pos + 2]
+                else:
+                    pair = context[max(0, pos - 1):pos + 1]
+                pair = [m for m in pair if m["id"] not in seen]
+                if not pair:
+                    continue
+                
+                lines = [f"[{pair[0]['ts'][:10]}]"]
+                for m in pair:
+                    speaker = user_name if m["role"] == "user" else char_name
+                    lines.append(f"{speaker}: {m['content']}")
+                text = "\n".join(lines)
+                tokens = estimate_tokens(text)
+                if used_tokens + tokens > token_budget:
+                    continue
+                used_tokens += tokens
+                seen.update(m["id"] for m in pair)
+                exchanges.append((pair[0]["id"], text))
+            
+            self.logger.debug(f"Memory recall: {len(hits)} hits, {len(exchanges)} exchanges, "
+                              f"{used_tokens} tokens in {(time.perf_counter() - start) * 1000:.1f} ms")
+            if not exchanges:
+                return ""
+            # 按时间先后排列
+            exchanges.sort()
+            return ("\n\n以下是你和用户过去聊过的、可能与当前话题相关的内容，可以自然地参考：\n<memories>\n"
+                    + "\n\n".join(text for _, text in exchanges) + "\n</memories>")
+        except Exception as e:
+            self.logger.error(f"Memory recall failed: {e}")
+            return ""
+
+    def _generate_message(self, msg_type, user_input=None, reminder_type=None, snap=None, **kwargs):
+        # 整个请求只使用这一份只读配置快照，不受 UI 线程同时修改配置的影响
+        if snap is None:
+            snap = self.cm.snapshot()
+        char_id = snap.character_id
+        api_key = snap.get("api_key")
+        base_url = snap.get("api_base_url")
 
         if not api_key or not base_url:
             self.logger.warning("API key or URL missing")
             return "请先在设置中配置 API URL 和 Key 哦。"
 
-        persona = self.cm.get("persona")
-        user_identity = self.cm.get("user_identity")
-        model = self.cm.get("model")
-        user_name = self.cm.get("user_name") or "用户"  # 获取用户名称，默认为"用户"
-        char_name = self.cm.get_current_character().get("name", "角色") if self.cm.get_current_character() else "角色"
+        persona = snap.get("persona")
+        user_identity = snap.get("user_identity")
+        model = snap.get("model")
+        user_name = snap.get_user_name()  # 获取用户名称，默认为"用户"
+        char_name = snap.get_character_name()
 
+        # --- 近期历史 ---
+        history = []
+        recent_history = []
+        if msg_type == "manual_chat":
+            # 从配置读取最大历史消息数，只从数据库取最近的 N+1 条，避免 Token 爆炸
+            max_history = snap.get_max_history_messages()
+            history = self.cm.get_chat_history(limit=max_history + 1, char_id=char_id)
+            # 过滤掉刚刚加入的最后一条用户消息（因为那是本次的任务输入）
+            recent_history = history[:-1]
+        # ---------------------
+        
         # --- Lorebook 处理 ---
-        active_lore = []
-        lorebook = self.cm.get("lorebook") or []
-        
-        for entry in lorebook:
-            is_active = False
-            if entry.get("type") == "always":
-                is_active = True
-            elif entry.get("type") == "keyword" and user_input:
-                # 检查关键词
-                keywords = entry.get("keywords", "").replace("，", ",").split(",")
-                for kw in keywords:
-                    kw = kw.strip()
-                    if kw and kw in user_input:
-                        is_active = True
-                        self.logger.info(f"Lorebook triggered by keyword: {kw}")
-                        break
-            
-            if is_active:
-                active_lore.append(entry.get("content", ""))
+        # 常驻条目 + 关键词/BM25 选出的条目，总长度受 Token 预算限制，按 insertion_order 排列
+        lorebook = snap.get("lorebook") or ()
+        lore_settings = snap.get("lorebook_settings") or {}
+        history_text = ""
+        if lore_settings.get("mode") == "bm25":
+            n = lore_settings.get("history_messages", 4)
+            if n:
+                context = recent_history[-n:] if msg_type == "manual_chat" else self.cm.get_chat_history(limit=n, char_id=char_id)
+                history_text = "\n".join(m["content"] for m in context)
+        active_lore = [entry.get("content", "") for entry in select_entries(
+            char_id, lorebook, user_input or "", history_text, lore_settings)]
         
         lorebook_content = "\\n".join(active_lore) if active_lore else "无"
         # ---------------------
         
         # --- 纪念日检测 ---
         anniversary_note = ""
-        today_anniversaries = self.cm.get_today_anniversaries()
+        today_anniversaries = self.cm.get_today_anniversaries(char_id=char_id)
         if today_anniversaries:
             anniversary_texts = []
             for anniv in today_anniversaries:
@@ -247,9 +388,15 @@ class AIClient:
                 self.logger.info(f"Today's anniversaries: {today_anniversaries}")
         # ---------------------
         
+        # --- 相关记忆 ---
+        memory_note = ""
+        if msg_type == "manual_chat":
+            memory_note = self._recall_memories(snap, user_input, exclude_ids={m["id"] for m in history}, user_name=user_name, char_name=char_name)
+        # ---------------------
+        
         # --- 健康状态检测 ---
         health_note = ""
-        period_status = self.cm.get_period_status()
+        period_status = snap.get_period_status()
         
         if period_status.get("status") == "in_period":
             # 正在生理期内
@@ -271,8 +418,8 @@ class AIClient:
             "persona": persona,
             "user": user_name,  # 用户名称
             "char": char_name,  # 角色名称
-            "cups": self.cm.get("cups_drunk_today"),
-            "target": self.cm.get("daily_target_cups"),
+            "cups": snap.get_cups_drunk_today(),
+            "target": snap.get_daily_target_cups(),
             "user_input": user_input if user_input else "Hello",
             "hour": datetime.datetime.now().hour,
             "reminder_content": kwargs.get("reminder_content", ""),
@@ -299,7 +446,7 @@ class AIClient:
         variables["time_of_day"] = "morning" if 5 <= hour < 12 else "afternoon" if 12 <= hour < 18 else "evening"
         
         # 生成表情列表
-        expressions_config = self.cm.get("expressions") or {}
+        expressions_config = snap.get("expressions") or {}
         mappings = expressions_config.get("mappings", {})
         if mappings:
             expressions_list = ", ".join([f"[{keyword}]" for keyword in mappings.keys()])
@@ -417,6 +564,7 @@ class AIClient:
 {lorebook_content}
 
 {anniversary_note}
+{memory_note}
 {health_note}
 {switch_context}
 
@@ -437,25 +585,29 @@ class AIClient:
         ]
 
         # 插入历史记录
-        if msg_type == "manual_chat":
-            history = self.cm.get_chat_history()
-            # 过滤掉刚刚加入的最后一条用户消息（因为那是本次的任务输入）
-            if len(history) > 1:
-                # 从配置读取最大历史消息数
-                max_history = self.cm.get("max_history_messages") or 10
-                # 只取最近的 N 条历史记录，避免 Token 爆炸
-                # -max_history-1 表示倒数第(max_history+1)条，-1 表示倒数第2条（排除最后一条）
-                start_index = -(max_history + 1)
-                recent_history = history[max(0, start_index):-1]
-                self.logger.info(f"Sending {len(recent_history)} history messages (max: {max_history})")
-                for msg in recent_history:
-                    # 确保 role 是 API 支持的格式 (user/assistant)
-                    role = "user" if msg["role"] == "user" else "assistant"
-                    messages.append({"role": role, "content": msg["content"]})
+        if recent_history:
+            self.logger.info(f"Sending {len(recent_history)} history messages (max: {max_history})")
+            for msg in recent_history:
+                # 确保 role 是 API 支持的格式 (user/assistant)
+                role = "user" if msg["role"] == "user" else "assistant"
+                messages.append({"role": role, "content": msg["content"]})
 
         # 插入当前任务
         messages.append({"role": "user", "content": f"任务: {task_content}"})
 
+        # 记录提示词各部分的构成
+        system_sections = {
+            "persona": persona or "",
+            "user_identity": user_identity or "",
+            "lorebook": lorebook_content,
+            "anniversaries": anniversary_note,
+            "memories": memory_note,
+            "health": health_note,
+            "switch_context": switch_context,
+            "expressions": variables["expressions"]
+        }
+        self._record_prompt_breakdown(msg_type, system_sections, messages, char_id)
+
         # 极限精简的 Payload
         payload = {
             "model": model,
@@ -464,7 +616,8 @@ class AIClient:
         }
 
         try:
-            result = self._make_request(url, payload)
+            metric_type = f"reminder_{reminder_type}" if msg_type == "reminder" else msg_type
+            result = self._make_request(url, payload, msg_type=metric_type, api_key=api_key, char_id=char_id)
             
             # 增加对不同返回结构的容错处理
             if 'choices' in result and len(result['choices']) > 0:
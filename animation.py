@@ -0,0 +1,141 @@
+import time
+import logging
+
+render_logger = logging.getLogger("Render")
+
+DEFAULT_FPS = 30
+
+
+class _Animation:
+    __slots__ = ("step", "duration", "on_done", "started", "next_due")
+
+    def __init__(self, step, duration, on_done, now, first_delay):
+        self.step = step
+        self.duration = duration  # 补间动画的时长（毫秒），循环动画为 None
+        self.on_done = on_done
+        self.started = now
+        self.next_due = now + first_delay
+
+
+class Animator:
+    """集中调度所有动画（表情过渡、呼吸、GIF 帧、气泡弹出、退出淡出）
+
+    只有一个 after 循环，每次只在最近一个动画到期时唤醒，两次唤醒至少间隔一帧。
+    没有动画或窗口隐藏（suspend）时不再调度，不占用 CPU。
+    所有方法都只能在 Tk 主线程中调用。
+    """
+
+    def __init__(self, root, fps=DEFAULT_FPS):
+        self.root = root
+        self.frame_ms = max(1, int(1000 / fps))
+        self.suspended = False
+        self._animations = {}  # {名称: _Animation}，同名的新动画替换旧动画
+        self._job = None
+
+    @staticmethod
+    def _now():
+        return time.perf_counter() * 1000
+
+    def set_fps(self, fps):
+        self.frame_ms = max(1, int(1000 / (fps or DEFAULT_FPS)))
+
+    def running(self, name):
+        return name in self._animations
+
+    def animate(self, name, step, duration_ms, on_done=None):
+        """补间动画：每帧调用 step(p)，p 从 0 增长到 1（最后一次一定是 1），结束后调用 on_done()
+
+        duration_ms 为 0 或动画已暂停时直接跳到结束状态。
+        """
+        self._animations.pop(name, None)
+        if duration_ms <= 0 or self.suspended:
+            self._finish(name, step, on_done)
+            return
+        self._animations[name] = _Animation(step, duration_ms, on_done, self._now(), 0)
+        self._schedule()
+
+    def loop(self, name, step, interval_ms=None):
+        """循环动画：每隔一段时间调用 step(已运行毫秒数)，返回下一次的间隔（毫秒），返回 None 结束"""
+        now = self._now()
+        self._animations[name] = _Animation(step, None, None, now, interval_ms or self.frame_ms)
+        self._schedule()
+
+    def stop(self, name, finish=False):
+        """停止动画；finish 为 True 时补间动画先跳到结束状态"""
+        anim = self._animations.pop(name, None)
+        if anim is not None and finish and anim.duration is not None:
+            self._finish(name, anim.step, anim.on_done)
+
+    def suspend(self):
+        """窗口隐藏时暂停：补间动画直接结束，循环动画停在当前帧"""
+        if self.suspended:
+            return
+        self.suspended = True
+        self._cancel_job()
+        for name, anim in list(self._animations.items()):
+            if anim.duration is not None:
+                self.stop(name, finish=True)
+        render_logger.debug(f"Animator suspended ({len(self._animations)} loops paused)")
+
+    def resume(self):
+        if not self.suspended:
+            return
+        self.suspended = False
+        now = self._now()
+        for anim in self._animations.values():
+            anim.next_due = now
+        self._schedule()
+
+    def _finish(self, name, step, on_done):
+        try:
+            step(1.0)
+            if on_done:
+                on_done()
+        except Exception as e:
+            logging.error(f"Animation {name} failed: {e}")
+
+    def _cancel_job(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+    def _schedule(self):
+        if self.suspended or not self._animations:
+            self._cancel_job()
+            return
+        now = self._now()
+        delay = max(0, int(min(a.next_due for a in self._animations.values()) - now))
+        self._cancel_job()
+        self._job = self.root.after(delay, self._tick)
+
+    def _tick(self):
+        self._job = None
+        now = self._now()
+        for name, anim in list(self._animations.items()):
+            if self._animations.get(name) is not anim or anim.next_due > now:
+                continue
+            elapsed = now - anim.started
+            try:
+                if anim.duration is not None:
+                    p = min(1.0, elapsed / anim.duration)
+                    anim.step(p)
+                    if p >= 1.0:
+                        if self._animations.get(name) is anim:
+                            del self._animations[name]
+                        if anim.on_done:
+                            anim.on_done()
+                        continue
+                    interval = self.frame_ms
+                else:
+                    interval = anim.step(elapsed)
+                    if not interval:
+                        if self._animations.get(name) is anim:
+                            del self._animations[name]
+                        continue
+            except Exception as e:
+                logging.error(f"Animation {name} failed: {e}")
+                if self._animations.get(name) is anim:
+                    del self._animations[name]
+                continue
+            anim.next_due = now + max(self.frame_ms, interval)
+        self._schedule()
@@ -0,0 +1,210 @@
+import json
+import logging
+from collections import OrderedDict
+
+from PIL import Image as PILImage
+from PIL import ImageTk, ImageDraw
+
+render_logger = logging.getLogger("Render")
+
+# 已渲染气泡的缓存上限（按 PIL 图片 + PhotoImage 各 宽×高×4 字节估算）
+BUBBLE_CACHE_BYTES = 8 * 1024 * 1024
+# 气泡最小尺寸
+BUBBLE_MIN_WIDTH = 180
+BUBBLE_MIN_HEIGHT = 100
+# 已换行文字的缓存条数（翻页时不必重新换行）
+LAYOUT_CACHE_SIZE = 16
+
+
+def _hex_to_rgb(hex_color):
+    """将hex颜色转换为RGB元组"""
+    hex_color = (hex_color or "").lstrip('#')
+    try:
+        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return (255, 255, 255)  # 默认白色
+
+
+class BubbleStyle:
+    """气泡外观（来自 appearance.bubble），key 用于区分缓存"""
+
+    def __init__(self, bubble_style):
+        self.key = json.dumps(bubble_style, ensure_ascii=False, sort_keys=True, default=dict)
+        self.font_size = bubble_style.get("font_size", 14)
+        self.padding_x = bubble_style.get("padding_x", 30)
+        self.padding_y = bubble_style.get("padding_y", 28)
+        self.border_color = _hex_to_rgb(bubble_style.get("border_color", "#646464"))
+        self.fill_color = _hex_to_rgb(bubble_style.get("background_color", "#FFFFFF"))
+        self.text_color = _hex_to_rgb(bubble_style.get("text_color", "#323232"))
+        self.corner_radius = bubble_style.get("corner_radius", 14)
+        self.border_width = bubble_style.get("border_width", 1)
+        # 气泡最大高度，文字更多时分页显示（0 表示不限制）
+        self.max_height = bubble_style.get("max_height", 320)
+
+
+class RenderedBubble:
+    """渲染好的气泡：PIL 图片（动画缩放用）和按需创建的 PhotoImage"""
+
+    def __init__(self, image):
+        self.image = image
+        self._photo = None
+
+    @property
+    def photo(self):
+        # PhotoImage 只能在 Tk 主线程中创建
+        if self._photo is None:
+            self._photo = ImageTk.PhotoImage(self.image)
+        return self._photo
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def nbytes(self):
+        return self.image.width * self.image.height * 4 * 2
+
+
+def wrap_text(text, font, max_width):
+    """按最大宽度逐字换行，返回行列表"""
+    temp_draw = ImageDraw.Draw(PILImage.new('RGBA', (1, 1)))
+    lines = []
+    current = ""
+    for ch in text:
+        test = current + ch
+        w = temp_draw.textbbox((0, 0), test, font=font)[2]
+        if ch == '\n':
+            lines.append(current)
+            current = ""
+        elif w > max_width and current:
+            lines.append(current)
+            current = ch
+        else:
+            current = test
+    if current:
+        lines.append(current)
+    return lines, temp_draw
+
+
+class BubbleRenderer:
+    """气泡渲染：每种外观预先画好九宫格边框，整个气泡按 (文字, 外观, 换行宽度, 页码) 做 LRU 缓存
+
+    “思考中...”、“连接中...” 等反复出现的状态气泡第二次显示时不再绘制。
+    超过外观中 max_height 的文字分页，每次只绘制当前页，气泡和窗口大小与文字总长度无关。
+    """
+
+    def __init__(self, budget_bytes=BUBBLE_CACHE_BYTES):
+        self.budget_bytes = budget_bytes
+        self._chrome = {}  # {外观 key: 九宫格源图}
+        self._cache = OrderedDict()  # {(文字, 外观 key, 换行宽度, 页码): RenderedBubble}
+        self._layouts = OrderedDict()  # {(文字, 外观 key, 换行宽度): (行列表, 最宽一行的宽度)}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._chrome.clear()
+        self._cache.clear()
+        self._layouts.clear()
+        self.total_bytes = 0
+
+    def render(self, text, style, font, max_text_width, page=0):
+        """返回 (RenderedBubble, 总页数)，命中缓存时直接复用"""
+        ascent, descent = font.getmetrics()
+        # 行高：增大防止截断
+        line_height = ascent + descent + 10
+        lines, text_w = self._layout(text, style, font, max_text_width)
+
+        # 每页行数：超出最大高度时分页，最后留一行显示页码
+        lines_per_page = len(lines) or 1
+        if style.max_height and len(lines) * line_height + style.padding_y * 2 > style.max_height:
+            lines_per_page = max(1, (style.max_height - style.padding_y * 2) // line_height - 1)
+        pages = max(1, -(-len(lines) // lines_per_page))
+        page = min(max(page, 0), pages - 1)
+
+        key = (text, style.key, max_text_width, page)
+        bubble = self._cache.get(key)
+        if bubble is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return bubble, pages
+        self.misses += 1
+
+        # ========== 气泡尺寸（分页时各页大小相同，翻页时气泡不跳动） ==========
+        text_h = (lines_per_page + (1 if pages > 1 else 0)) * line_height
+        bubble_w = max(int(text_w + style.padding_x * 2), BUBBLE_MIN_WIDTH)
+        bubble_h = max(int(text_h + style.padding_y * 2), BUBBLE_MIN_HEIGHT)
+
+        image = self._frame(style, bubble_w, bubble_h)
+        draw = ImageDraw.Draw(image)
+        text_start_y = style.padding_y + 3
+        page_lines = lines[page * lines_per_page:(page + 1) * lines_per_page]
+        for i, line in enumerate(page_lines):
+            draw.text((style.padding_x, text_start_y + i * line_height), line, font=font, fill=style.text_color + (255,))
+        if pages > 1:
+            indicator = f"{page + 1}/{pages}"
+            indicator_w = draw.textbbox((0, 0), indicator, font=font)[2]
+            draw.text((bubble_w - style.padding_x - indicator_w, text_start_y + lines_per_page * line_height),
+                      indicator, font=font, fill=style.border_color + (255,))
+
+        bubble = RenderedBubble(image)
+        self._cache[key] = bubble
+        self.total_bytes += bubble.nbytes()
+        while self.total_bytes > self.budget_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self.total_bytes -= old.nbytes()
+        render_logger.debug(f"Bubble rendered {bubble_w}x{bubble_h} (page {page + 1}/{pages}, {len(page_lines)} lines), "
+                            f"cache {len(self._cache)} bubbles, {self.hits} hits / {self.misses} misses")
+        return bubble, pages
+
+    def _layout(self, text, style, font, max_text_width):
+        """换行结果：(行列表, 最宽一行的宽度)"""
+        key = (text, style.key, max_text_width)
+        layout = self._layouts.get(key)
+        if layout is not None:
+            self._layouts.move_to_end(key)
+            return layout
+        lines, temp_draw = wrap_text(text, font, max_text_width)
+        text_w = max(temp_draw.textbbox((0, 0), line, font=font)[2] for line in lines) if lines else 0
+        layout = self._layouts[key] = (lines, text_w)
+        if len(self._layouts) > LAYOUT_CACHE_SIZE:
+            self._layouts.popitem(last=False)
+        return layout
+
+    def _frame(self, style, w, h):
+        """用九宫格拼出 w×h 的空白气泡（圆角和边框只在每种外观第一次使用时绘制）"""
+        tile = self._chrome.get(style.key)
+        if tile is None:
+            r = max(style.corner_radius, style.border_width, 1)
+            size = 2 * r + 3
+            tile = PILImage.new('RGBA', (size, size), (0, 0, 0, 0))
+            ImageDraw.Draw(tile).rounded_rectangle([0, 0, size - 1, size - 1],
+                                                   radius=style.corner_radius,
+                                                   fill=style.fill_color + (255,),  # 添加alpha=255
+                                                   outline=style.border_color + (255,),
+                                                   width=style.border_width)
+            self._chrome[style.key] = tile
+
+        size = tile.width
+        c = size // 2  # 角的边长（中间一列/一行像素用于拉伸）
+        if w < 2 * c + 1 or h < 2 * c + 1:
+            # 圆角比气泡还大时直接绘制
+            image = PILImage.new('RGBA', (w, h), (0, 0, 0, 0))
+            ImageDraw.Draw(image).rounded_rectangle([0, 0, w - 1, h - 1], radius=style.corner_radius,
+                                                    fill=style.fill_color + (255,),
+                                                    outline=style.border_color + (255,),
+                                                    width=style.border_width)
+            return image
+
+        image = PILImage.new('RGBA', (w, h), tile.getpixel((c, c)))
+        far = size - c
+        # 四个角
+        image.paste(tile.crop((0, 0, c, c)), (0, 0))
+        image.paste(tile.crop((far, 0, size, c)), (w - c, 0))
+        image.paste(tile.crop((0, far, c, size)), (0, h - c))
+        image.paste(tile.crop((far, far, size, size)), (w - c, h - c))
+        # 四条边（取中间一列/一行像素拉伸）
+        image.paste(tile.crop((c, 0, c + 1, c)).resize((w - 2 * c, c), PILImage.NEAREST), (c, 0))
+        image.paste(tile.crop((c, far, c + 1, size)).resize((w - 2 * c, c), PILImage.NEAREST), (c, h - c))
+        image.paste(tile.crop((0, c, c, c + 1)).resize((c, h - 2 * c), PILImage.NEAREST), (0, c))
+        image.paste(tile.crop((far, c, size, c + 1)).resize((c, h - 2 * c), PILImage.NEAREST), (w - c, c))
+        return image
@@ -1,12 +1,38 @@
 import json
+import copy
 import os
 import logging
 import shutil
+from collections.abc import MutableMapping
+from types import MappingProxyType
 from datetime import datetime, timedelta
 import uuid
-from utils import resource_path
+import threading
+from utils import resource_path, atomic_write_text
+from data_store import DataStore
+from lorebook import DEFAULT_LOREBOOK_SETTINGS
 
 CONFIG_FILE = "config.json"
+# 每个角色的配置单独存放在 characters/<角色ID>/character.json
+CHARACTERS_DIR = "characters"
+CHARACTER_FILE = "character.json"
+# get_chat_history 默认返回的最近聊天记录条数（数据库中保存全部记录）
+CHAT_HISTORY_LIMIT = 20
+
+# 频繁变化的小字段只追加写入日志文件，不重写整个配置；
+# 下次完整保存配置或日志条数达到上限时合并（compact）到配置文件中
+JOURNAL_FILE = "config.journal"
+JOURNAL_COMPACT_EVERY = 200
+JOURNAL_KEYS = frozenset(("cups_drunk_today", "last_exit_time", "last_daily_briefing_date"))
+
+# get/set 的键路由：全局配置项、存储在数据库中的数据，其余为当前角色的配置项
+GLOBAL_KEYS = frozenset((
+    "api_base_url", "api_key", "model", "max_history_messages", "weather_city", "weather_api_key",
+    "current_character", "characters", "diagnostics", "logging", "memory_recall",
+    "sprite_cache", "animation", "window_position"
+))
+GLOBAL_SET_KEYS = GLOBAL_KEYS - {"characters"}
+DB_KEYS = frozenset(("chat_history", "anniversaries"))
 
 # 单个角色的默认配置模板
 DEFAULT_CHARACTER_CONFIG = {
@@ -71,14 +97,12 @@ DEFAULT_CHARACTER_CONFIG = {
         "custom": []
     },
     
-    # 聊天记录
-    "chat_history": [],
+    # 聊天记录、纪念日、吃药提醒存储在 SQLite 数据库中（见 data_store.py）
     
     # Lorebook (背景知识)
     "lorebook": [],
-    
-    # 纪念日
-    "anniversaries": [],
+    # 世界书注入方式与 Token 预算（见 lorebook.py）
+    "lorebook_settings": dict(DEFAULT_LOREBOOK_SETTINGS),
     
     # 健康管理
     "health": {
@@ -88,8 +112,7 @@ DEFAULT_CHARACTER_CONFIG = {
             "period_length": 5,
             "last_start_date": None,
             "history": []
-        },
-        "medication_reminders": []
+        }
     },
     
     # 触摸互动区域
@@ -116,6 +139,7 @@ DEFAULT_CHARACTER_CONFIG = {
             "padding_y": 28,
             "font_size": 14,
             "border_width": 1,
+            "max_height": 320,  # 气泡最大高度，文字更多时分页显示（0 表示不限制）
             "font_type": "system",  # "system"（系统字体）或 "custom"（自定义字体文件）
             "font_name": "Microsoft YaHei UI",  # 系统字体名称
             "font_file": ""  # 自定义字体文件路径
@@ -141,13 +165,316 @@ DEFAULT_GLOBAL_CONFIG = {
     "weather_city": "",
     "weather_api_key": "",
     "current_character": None,
-    "characters": {}
+    "characters": {},
+    # 主窗口上次拖动到的位置 {"x", "y"}（窗口为默认高度时的左上角），None 表示屏幕右下角
+    "window_position": None,
+    # 诊断：Tk 主线程卡顿监测、托盘诊断菜单
+    "diagnostics": {
+        "stall_watchdog": True,
+        "stall_threshold_ms": 250,
+        "tray_menu": False
+    },
+    # 日志：各子系统的级别（root 为全局默认）、请求内容写入日志时的最大字符数（0 表示不截断）、
+    # 单个日志文件的最大字节数及保留的旧文件个数
+    "logging": {
+        "levels": {
+            "root": "DEBUG",
+            "AIClient": "DEBUG",
+            "Touch": "INFO",
+            "Render": "INFO",
+            "Watchdog": "INFO"
+        },
+        "payload_max_chars": 2000,
+        "max_bytes": 2097152,
+        "backup_count": 3  # 1 及以上（小于 1 时按 1 处理，0 会使日志不再滚动）
+    },
+    # 相关记忆召回：聊天时从历史记录中检索与用户输入相关的对话，放入提示词
+    "memory_recall": {
+        "enabled": True,
+        "top_k": 3,
+        "token_budget": 400
+    },
+    # 表情立绘缓存：内存上限（按 宽×高×4 字节估算）、启动/切换角色时预先加载并常驻的常用表情数
+    # （按最近 history_messages 条聊天中 AI 回复使用的次数）；
+    # 切换角色后保留最近 resident_characters 个其他角色的立绘和字体，总内存不超过 resident_mb
+    "sprite_cache": {
+        "max_mb": 48,
+        "prewarm": 3,
+        "history_messages": 50,
+        "resident_characters": 2,
+        "resident_mb": 64
+    },
+    # 动画：帧率上限、表情渐变和气泡弹出的时长（毫秒，0 表示不使用动画）、空闲时的呼吸浮动
+    "animation": {
+        "enabled": True,
+        "fps": 30,
+        "crossfade_ms": 180,
+        "bubble_pop_ms": 120,
+        "breathing": True
+    }
 }
 
-class ConfigManager:
+def character_file(char_id):
+    """角色配置文件路径"""
+    return os.path.join(CHARACTERS_DIR, char_id, CHARACTER_FILE)
+
+
+class CharacterStore(MutableMapping):
+    """按需加载的角色配置集合（作为 config["characters"] 使用）
+
+    config.json 中只保存轻量索引 {角色ID: {name, avatar}}，角色的完整配置
+    在第一次访问时才从 characters/<ID>/character.json 读取。保存时只写入
+    内容有变化的角色文件。
+    """
+
+    def __init__(self, index=None, prepare=None):
+        self._index = dict(index or {})  # {char_id: {"name", "avatar"}}
+        self._loaded = {}  # {char_id: 角色配置}
+        self._saved_text = {}  # {char_id: 上次读取/写入的文件内容}
+        # 角色配置读入或放入时的预处理 prepare(char_id, char_config)，用于迁移旧数据
+        self._prepare = prepare
+        # 每次增删、替换、释放角色配置时加一，供 ConfigManager 判断缓存的当前角色是否失效
+        self.generation = 0
+
+    @classmethod
+    def from_characters(cls, characters, prepare=None):
+        """由普通的 {角色ID: 配置} 字典创建（所有角色都视为未保存）"""
+        store = cls(prepare=prepare)
+        for char_id, char_config in (characters or {}).items():
+            store[char_id] = char_config
+        return store
+
+    @staticmethod
+    def _index_entry(char_config):
+        return {
+            "name": char_config.get("name", "未命名"),
+            "avatar": char_config.get("avatar", "character.png")
+        }
+
+    def __getitem__(self, char_id):
+        if char_id not in self._index:
+            raise KeyError(char_id)
+        if char_id not in self._loaded:
+            self._loaded[char_id] = self._load(char_id)
+        return self._loaded[char_id]
+
+    def __setitem__(self, char_id, char_config):
+        if self._prepare:
+            self._prepare(char_id, char_config)
+        self._loaded[char_id] = char_config
+        self.generation += 1
+        self._index[char_id] = self._index_entry(char_config)
+
+    def __delitem__(self, char_id):
+        del self._index[char_id]
+        self._loaded.pop(char_id, None)
+        self._saved_text.pop(char_id, None)
+        self.generation += 1
+
+    def __contains__(self, char_id):
+        return char_id in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __deepcopy__(self, memo):
+        clone = CharacterStore(copy.deepcopy(self._index, memo), self._prepare)
+        clone._loaded = copy.deepcopy(self._loaded, memo)
+        clone._saved_text = dict(self._saved_text)
+        return clone
+
+    def index(self):
+        """轻量索引 {角色ID: {name, avatar}}，不会读取角色文件"""
+        return self._index
+
+    def loaded_items(self):
+        """已加载到内存的角色 [(角色ID, 配置)]"""
+        return list(self._loaded.items())
+
+    def unload(self, keep=()):
+        """释放已保存的、不在 keep 中的角色（调用前应先 save）"""
+        for char_id in list(self._loaded):
+            if char_id not in keep:
+                del self._loaded[char_id]
+        self.generation += 1
+
+    def _load(self, char_id):
+        path = character_file(char_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            char_config = json.loads(text)
+            self._saved_text[char_id] = text
+            logging.info(f"Loaded character config: {path}")
+            if self._prepare:
+                self._prepare(char_id, char_config)
+            return char_config
+        except FileNotFoundError:
+            logging.error(f"角色配置文件不存在: {path}，使用默认配置")
+        except Exception as e:
+            logging.error(f"加载角色配置失败 {path}: {e}")
+            # 保留损坏的文件，避免之后被默认配置覆盖
+            try:
+                os.replace(path, f"{path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}")
+            except OSError:
+                pass
+        
+        char_config = copy.deepcopy(DEFAULT_CHARACTER_CONFIG)
+        char_config.update(self._index.get(char_id, {}))
+        char_config["id"] = char_id
+        return char_config
+
+    def save(self):
+        """写入内容有变化的角色文件，返回写入的角色ID列表"""
+        written = []
+        for char_id, char_config in self._loaded.items():
+            if char_id not in self._index:
+                continue
+            self._index[char_id] = self._index_entry(char_config)
+            text = json.dumps(char_config, indent=4, ensure_ascii=False)
+            if text == self._saved_text.get(char_id):
+                continue
+            path = character_file(char_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write_text(path, text)
+            self._saved_text[char_id] = text
+            written.append(char_id)
+        return written
+
+
+def freeze(value):
+    """把配置转换为只读结构：dict -> MappingProxyType，list -> tuple"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def diff_paths(old, new, prefix=""):
+    """比较两份只读配置，返回发生变化的键路径（如 "reminders.water.interval"），按字母排序
+
+    未修改的部分在快照之间共用同一对象，比较时直接跳过。
+    """
+    if old is new:
+        return []
+    if isinstance(old, MappingProxyType) and isinstance(new, MappingProxyType):
+        paths = []
+        for key in old.keys() | new.keys():
+            path = f"{prefix}.{key}" if prefix else str(key)
+            if key not in old or key not in new:
+                paths.append(path)
+            else:
+                paths.extend(diff_paths(old[key], new[key], path))
+        return sorted(paths)
+    return [] if old == new else [prefix]
+
+
+class ConfigAccessors:
+    """ConfigManager 与 ConfigSnapshot 共用的读取方法，都建立在 get() 之上"""
+
+    def get_character_name(self):
+        return self.get("name") or "角色"
+
+    def get_user_name(self):
+        return self.get("user_name") or "用户"
+
+    def get_cups_drunk_today(self):
+        return float(self.get("cups_drunk_today") or 0.0)
+
+    def get_daily_target_cups(self):
+        return float(self.get("daily_target_cups") or DEFAULT_CHARACTER_CONFIG["daily_target_cups"])
+
+    def get_max_history_messages(self):
+        return int(self.get("max_history_messages") or DEFAULT_GLOBAL_CONFIG["max_history_messages"])
+
+    def get_period_status(self, health=None):
+        """获取生理期状态"""
+        if health is None:
+            health = self.get("health") or {}
+        period_tracker = health.get("period_tracker", {})
+        
+        if not period_tracker.get("enabled") or not period_tracker.get("last_start_date"):
+            return {"status": "disabled"}
+        
+        try:
+            last_start = datetime.strptime(period_tracker["last_start_date"], "%Y-%m-%d")
+            cycle_length = period_tracker.get("cycle_length", 28)
+            period_length = period_tracker.get("period_length", 5)
+            
+            today = datetime.now()
+            days_since_last = (today - last_start).days
+            
+            next_date = last_start + timedelta(days=cycle_length)
+            days_until = (next_date - today).days
+            
+            if days_since_last < period_length:
+                return {
+                    "status": "in_period",
+                    "period_day": days_since_last + 1,
+                    "days_until": days_until,
+                    "next_date": next_date.strftime("%Y-%m-%d")
+                }
+            elif days_until <= 5 and days_until > 0:
+                return {
+                    "status": "approaching",
+                    "days_until": days_until,
+                    "next_date": next_date.strftime("%Y-%m-%d")
+                }
+            else:
+                return {
+                    "status": "normal",
+                    "days_until": days_until,
+                    "next_date": next_date.strftime("%Y-%m-%d")
+                }
+        except Exception as e:
+            logging.error(f"Error calculating period status: {e}")
+            return {"status": "error"}
+
+
+class ConfigSnapshot(ConfigAccessors):
+    """某一版本的只读配置（全局配置 + 当前角色配置）
+
+    由 ConfigManager 在修改配置的线程中生成并整体替换发布，
+    后台线程每次请求取一次快照，之后的读取不会看到 UI 线程改到一半的数据。
+    未修改的部分在相邻版本之间共用同一个只读对象。
+    """
+    __slots__ = ("version", "character_id", "global_config", "character")
+
+    def __init__(self, version, character_id, global_config, character):
+        self.version = version
+        self.character_id = character_id
+        self.global_config = global_config  # MappingProxyType
+        self.character = character  # MappingProxyType
+
+    def get(self, key, default=None):
+        if key in GLOBAL_KEYS:
+            return self.global_config.get(key, default)
+        return self.character.get(key, default)
+
+
+class ConfigManager(ConfigAccessors):
     def __init__(self):
+        self._global_text = None  # 上次读取/写入的 config.json 内容
+        self._journal_lock = threading.Lock()
+        self._journal_count = 0  # 日志中尚未合并的条目数
+        self._journal_replayed = False  # 重放之前不能清理日志（加载时的迁移也会保存配置）
+        # 当前角色缓存：(config, 角色表, 当前角色ID, 角色表 generation, 角色配置)，任一项变化即失效
+        self._current_cache = None
+        self._medications_cache = {}  # {角色ID: 吃药提醒列表}，每秒的提醒检查不必查询数据库
+        self._snapshot = None  # 最新发布的 ConfigSnapshot
+        self._snapshot_lock = threading.Lock()
+        self._subscribers = []  # [(键路径前缀, 回调)]
+        self.store = DataStore()
         self.config = self.load_config()
+        self._fill_global_defaults()
+        self._replay_journal()
+        self._ensure_current_character()
         self.check_daily_reset()
+        self._publish_snapshot()
 
     def load_config(self):
         """加载配置文件"""
@@ -155,21 +482,43 @@ class ConfigManager:
         if os.path.exists(CONFIG_FILE):
             try:
                 with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    
-                    # 检查是否是新的多角色格式
-                    if "characters" in config and "current_character" in config:
-                        # 新格式，直接返回
-                        return config
-                    else:
-                        # 旧格式，需要迁移
-                        logging.info("检测到旧版配置格式，自动迁移到多角色格式")
-                        return self._migrate_old_config(config)
+                    text = f.read()
+                config = json.loads(text)
+                
+                if "character_index" in config:
+                    # 按角色分文件存储的格式：角色配置按需加载
+                    self._global_text = text
+                    config["characters"] = CharacterStore(config.pop("character_index"), self._extract_character_data)
+                    return config
+                elif "characters" in config and "current_character" in config:
+                    # 所有角色都在 config.json 中的格式，拆分到各角色目录
+                    logging.info("检测到单文件多角色配置，拆分为按角色存储")
+                    return self._split_characters(config)
+                else:
+                    # 旧格式，需要迁移
+                    logging.info("检测到旧版配置格式，自动迁移到多角色格式")
+                    return self._migrate_old_config(config)
             except Exception as e:
                 logging.error(f"加载配置失败: {e}")
+                # 保留损坏的文件，避免被默认配置覆盖；角色配置仍在各自目录中，可以找回
+                corrupt_file = f"{CONFIG_FILE}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+                try:
+                    os.replace(CONFIG_FILE, corrupt_file)
+                    logging.error(f"已将损坏的配置文件移至 {corrupt_file}")
+                except OSError:
+                    pass
+                
+                index = self._recover_character_index()
+                if index:
+                    config = copy.deepcopy(DEFAULT_GLOBAL_CONFIG)
+                    config["characters"] = CharacterStore(index, self._extract_character_data)
+                    config["current_character"] = next(iter(index))
+                    self.save_config(config)
+                    logging.info(f"已从角色目录恢复 {len(index)} 个角色，全局设置已重置为默认值")
+                    return config
         
         # 配置文件不存在，创建默认配置
-        config = DEFAULT_GLOBAL_CONFIG.copy()
+        config = copy.deepcopy(DEFAULT_GLOBAL_CONFIG)
         
         # 尝试加载打包的默认配置
         internal_config_path = resource_path("default_config.json")
@@ -201,9 +550,40 @@ class ConfigManager:
         self.save_config(config)
         return config
     
+    def _recover_character_index(self):
+        """扫描角色目录，重建角色索引（config.json 损坏时使用）"""
+        index = {}
+        if not os.path.isdir(CHARACTERS_DIR):
+            return index
+        for char_id in sorted(os.listdir(CHARACTERS_DIR)):
+            path = character_file(char_id)
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    char_config = json.load(f)
+                index[char_id] = CharacterStore._index_entry(char_config)
+            except Exception as e:
+                logging.error(f"恢复角色索引时跳过 {path}: {e}")
+        return index
+
+    def _split_characters(self, config):
+        """把 config.json 中的全部角色拆分到各自的 character.json（先备份原文件）"""
+        backup_file = f"{CONFIG_FILE}.bak"
+        try:
+            shutil.copy2(CONFIG_FILE, backup_file)
+            logging.info(f"已备份原配置文件: {backup_file}")
+        except Exception as e:
+            logging.error(f"备份配置文件失败: {e}")
+        
+        config["characters"] = CharacterStore.from_characters(config.get("characters"), self._extract_character_data)
+        self.save_config(config)
+        logging.info(f"配置拆分完成，共 {len(config['characters'])} 个角色")
+        return config
+
     def _migrate_old_config(self, old_config):
         """迁移旧版单角色配置到新版多角色格式"""
-        new_config = DEFAULT_GLOBAL_CONFIG.copy()
+        new_config = copy.deepcopy(DEFAULT_GLOBAL_CONFIG)
         
         # 全局设置
         new_config["api_base_url"] = old_config.get("api_base_url", "https://api.openai.com/v1")
@@ -237,39 +617,253 @@ class ConfigManager:
         
         return new_config
 
-    def save_config(self, new_config=None):
-        """保存配置文件"""
+    def _extract_character_data(self, char_id, char_config):
+        """把角色配置中的聊天记录、纪念日、吃药提醒移入数据库（旧配置迁移、导入角色时）"""
+        chat_history = char_config.pop("chat_history", None)
+        anniversaries = char_config.pop("anniversaries", None)
+        health = char_config.get("health")
+        medications = health.pop("medication_reminders", None) if isinstance(health, dict) else None
+        
+        if chat_history or anniversaries or medications:
+            self._medications_cache.pop(char_id, None)
+            self.store.import_character_data(char_id, chat_history or [], anniversaries or [], medications or [])
+            logging.info(f"Moved data of {char_id} into database: {len(chat_history or [])} messages, "
+                         f"{len(anniversaries or [])} anniversaries, {len(medications or [])} medications")
+
+    def save_config(self, new_config=None, changed=None):
+        """保存配置文件
+        
+        先写入有变化的角色文件，再写入全局配置 config.json（含角色索引），
+        内容没有变化的文件不会重写。changed 为本次修改过的顶层键，
+        用于只重建快照中变化的部分（为 None 时重建整个快照）。
+        """
         if new_config:
             self.config = new_config
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, indent=4, ensure_ascii=False)
+            changed = None
+        
+        characters = self.config.get("characters")
+        if not isinstance(characters, CharacterStore):
+            characters = CharacterStore.from_characters(characters, self._extract_character_data)
+            self.config["characters"] = characters
+        written = characters.save()
+        if written:
+            logging.debug(f"Saved character configs: {written}")
+        
+        global_config = {k: v for k, v in self.config.items() if k != "characters"}
+        global_config["character_index"] = characters.index()
+        text = json.dumps(global_config, indent=4, ensure_ascii=False)
+        if text != self._global_text:
+            atomic_write_text(CONFIG_FILE, text)
+            self._global_text = text
+        
+        # 内存中的配置已全部写入文件，日志中的条目不再需要
+        self._truncate_journal()
+        self._publish_snapshot(changed)
+
+    # ============ 只读快照 ============
+
+    def snapshot(self):
+        """返回最新的只读配置快照（供后台线程在一次请求中使用）"""
+        return self._snapshot or self._publish_snapshot()
+
+    def snapshot_for(self, char_id):
+        """返回指定角色的只读配置快照（不切换当前角色），角色不存在时返回 None
+
+        用于切换角色前在后台提前准备新角色的资源和请求。
+        """
+        snap = self.snapshot()
+        if char_id == snap.character_id:
+            return snap
+        character = self.config.get("characters", {}).get(char_id)
+        if character is None:
+            return None
+        return ConfigSnapshot(snap.version, char_id, snap.global_config,
+                              MappingProxyType({k: freeze(v) for k, v in character.items()}))
+
+    def _publish_snapshot(self, changed=None):
+        """根据当前配置生成新快照并发布；changed 给出时只重新冻结这些顶层键
+
+        发布后把与上一版快照相比变化的键路径通知给订阅者（见 subscribe）。
+        """
+        with self._snapshot_lock:
+            char_id = self.get_current_character_id()
+            current = self.get_current_character() or {}
+            old = self._snapshot
+            if old is None or changed is None or old.character_id != char_id:
+                global_config = {k: freeze(v) for k, v in self.config.items() if k != "characters"}
+                character = {k: freeze(v) for k, v in current.items()}
+            else:
+                global_config = dict(old.global_config)
+                character = dict(old.character)
+                for key in changed:
+                    source, target = (self.config, global_config) if key in GLOBAL_KEYS else (current, character)
+                    if key in source:
+                        target[key] = freeze(source[key])
+                    else:
+                        target.pop(key, None)
+            version = old.version + 1 if old else 1
+            snap = self._snapshot = ConfigSnapshot(version, char_id, MappingProxyType(global_config), MappingProxyType(character))
+        
+        if old is not None and self._subscribers:
+            paths = diff_paths(old.global_config, snap.global_config)
+            if old.character_id == char_id:
+                paths += diff_paths(old.character, snap.character)
+            # 切换角色时角色配置整体替换，只通知 current_character
+            if paths:
+                self._notify(paths)
+        return snap
+
+    # ============ 配置变化通知 ============
+
+    def subscribe(self, prefix, callback):
+        """订阅配置变化，返回取消订阅的函数
+        
+        prefix 为键路径前缀（如 "reminders"、"expressions.mappings"，空字符串表示全部），
+        callback(paths) 收到本次变化中匹配前缀的全部键路径。
+        回调在修改配置的线程中同步执行，涉及 Tk 的操作需自行转到主线程。
+        """
+        entry = (prefix, callback)
+        self._subscribers.append(entry)
+        
+        def unsubscribe():
+            if entry in self._subscribers:
+                self._subscribers.remove(entry)
+        return unsubscribe
+
+    def _notify(self, paths):
+        logging.debug(f"Config changed: {paths}")
+        for prefix, callback in list(self._subscribers):
+            matched = [p for p in paths if not prefix or p == prefix or p.startswith(prefix + ".")]
+            if not matched:
+                continue
+            try:
+                callback(matched)
+            except Exception as e:
+                logging.error(f"Config change callback for {prefix!r} failed: {e}")
+
+    # ============ 追加日志 ============
+
+    def _journal_set(self, char_id, path, value):
+        """修改角色配置中的一个字段，只追加一行日志而不重写配置文件
+        
+        path 为从角色配置开始的键路径，例如 ["reminders", "water", "last_triggered"]
+        """
+        target = self.config["characters"][char_id]
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+        
+        line = json.dumps({"char": char_id, "path": path, "value": value}, ensure_ascii=False)
+        try:
+            with self._journal_lock:
+                with open(JOURNAL_FILE, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._journal_count += 1
+                should_compact = self._journal_count >= JOURNAL_COMPACT_EVERY
+        except OSError as e:
+            logging.error(f"写入配置日志失败，改为完整保存: {e}")
+            should_compact = True
+        
+        if should_compact:
+            self.save_config(changed=(path[0],))
+        elif char_id == self.get_current_character_id():
+            self._publish_snapshot((path[0],))
+
+    def _replay_journal(self):
+        """启动时重放上次退出前未合并的日志（忽略崩溃时写了一半的行），然后合并到配置文件"""
+        if not os.path.exists(JOURNAL_FILE):
+            self._journal_replayed = True
+            return
+        applied = 0
+        try:
+            with open(JOURNAL_FILE, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError as e:
+            logging.error(f"读取配置日志失败: {e}")
+            return
+        
+        characters = self.config.get("characters", {})
+        for line_no, line in enumerate(lines, 1):
+            try:
+                entry = json.loads(line)
+                char_id, path, value = entry["char"], entry["path"], entry["value"]
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"跳过损坏的配置日志第 {line_no} 行: {line[:80]!r}")
+                continue
+            if char_id not in characters or not path:
+                continue
+            target = characters[char_id]
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+            applied += 1
+        
+        logging.info(f"重放配置日志 {applied} 条")
+        self._journal_replayed = True
+        self.save_config()
+
+    def _truncate_journal(self):
+        with self._journal_lock:
+            if not self._journal_replayed or (self._journal_count == 0 and not os.path.exists(JOURNAL_FILE)):
+                return
+            try:
+                if os.path.exists(JOURNAL_FILE):
+                    os.remove(JOURNAL_FILE)
+            except OSError as e:
+                logging.error(f"清理配置日志失败: {e}")
+                return
+            self._journal_count = 0
+
+    def _fill_global_defaults(self):
+        """补全旧配置文件中没有的全局项，之后 get 不必再逐次回退到默认值"""
+        for key, value in DEFAULT_GLOBAL_CONFIG.items():
+            if key not in self.config:
+                self.config[key] = copy.deepcopy(value)
+
+    def _ensure_current_character(self):
+        """当前角色不存在时改为第一个角色并保存（只在加载时执行，get 不产生写入）"""
+        characters = self.config.get("characters", {})
+        char_id = self.config.get("current_character")
+        if characters and (not char_id or char_id not in characters):
+            self.config["current_character"] = next(iter(characters))
+            logging.warning(f"当前角色 {char_id} 不存在，改为 {self.config['current_character']}")
+            self.save_config()
 
     def get_current_character_id(self):
         """获取当前角色ID"""
         return self.config.get("current_character")
     
     def get_current_character(self):
-        """获取当前角色的完整配置"""
-        char_id = self.get_current_character_id()
-        if char_id and char_id in self.config.get("characters", {}):
-            return self.config["characters"][char_id]
-        # 如果没有当前角色，返回第一个角色
-        characters = self.config.get("characters", {})
+        """获取当前角色的完整配置（缓存引用，配置对象、当前角色ID或角色表变化时重新查找）"""
+        config = self.config
+        char_id = config.get("current_character")
+        characters = config.get("characters")
+        cache = self._current_cache
+        if (cache is not None and cache[0] is config and cache[1] is characters and cache[2] == char_id
+                and cache[3] == getattr(characters, "generation", None)):
+            return cache[4]
+        
+        current = None
         if characters:
-            first_char_id = list(characters.keys())[0]
-            self.config["current_character"] = first_char_id
-            self.save_config()
-            return characters[first_char_id]
-        return None
+            if char_id and char_id in characters:
+                current = characters[char_id]
+            else:
+                # 当前角色不存在时使用第一个角色（不在这里保存，见 _ensure_current_character）
+                current = characters[next(iter(characters))]
+        # 读取角色可能触发按需加载，generation 在加载后取值
+        self._current_cache = (config, characters, char_id, getattr(characters, "generation", None), current)
+        return current
     
     def get_all_characters(self):
         """获取所有角色的列表 (仅基本信息)"""
         characters = []
-        for char_id, char_config in self.config.get("characters", {}).items():
+        for char_id, entry in self.config["characters"].index().items():
             characters.append({
                 "id": char_id,
-                "name": char_config.get("name", "未命名"),
-                "avatar": char_config.get("avatar", "character.png")
+                "name": entry.get("name", "未命名"),
+                "avatar": entry.get("avatar", "character.png")
             })
         return characters
     
@@ -278,6 +872,8 @@ class ConfigManager:
         if char_id in self.config.get("characters", {}):
             self.config["current_character"] = char_id
             self.save_config()
+            # 已保存，释放其他角色的配置，之后访问时再按需加载
+            self.config["characters"].unload(keep=(char_id,))
             self.check_daily_reset()  # 切换角色后检查日期重置
             return True
         return False
@@ -298,7 +894,7 @@ class ConfigManager:
             char_id = f"{char_id}{counter}"
         
         # 创建角色专属目录
-        char_dir = os.path.join("characters", char_id)
+        char_dir = os.path.join(CHARACTERS_DIR, char_id)
         os.makedirs(char_dir, exist_ok=True)
         logging.info(f"Created character directory: {char_dir}")
         
@@ -318,7 +914,7 @@ class ConfigManager:
             # 使用相对路径指向角色目录中的 character.png
             final_avatar = os.path.join(char_dir, "character.png")
         
-        char_config = DEFAULT_CHARACTER_CONFIG.copy()
+        char_config = copy.deepcopy(DEFAULT_CHARACTER_CONFIG)
         char_config["id"] = char_id
         char_config["name"] = name
         char_config["persona"] = persona if persona else DEFAULT_CHARACTER_CONFIG["persona"]
@@ -352,6 +948,8 @@ class ConfigManager:
             # 删除角色配置
             del self.config["characters"][char_id]
             self.save_config()
+            self.store.delete_character(char_id)
+            self._medications_cache.pop(char_id, None)
             
             # 删除角色资源目录
             char_dir = os.path.join("characters", char_id)
@@ -375,33 +973,68 @@ class ConfigManager:
         return False
 
     def get(self, key, default=None):
-        """获取配置项（优先从当前角色，其次从全局）"""
+        """获取配置项（优先从当前角色，其次从全局），不会写入任何文件"""
         # 全局配置项
-        global_keys = ["api_base_url", "api_key", "model", "max_history_messages", "weather_city", "weather_api_key", "current_character", "characters"]
-        
-        if key in global_keys:
+        if key in GLOBAL_KEYS:
             return self.config.get(key, default)
         
+        # 存储在数据库中的数据
+        if key in DB_KEYS:
+            return self.get_chat_history() if key == "chat_history" else self.get_anniversaries()
+        
         # 角色配置项
         current_char = self.get_current_character()
-        if current_char:
+        if current_char is not None:
             return current_char.get(key, default)
         
         return default
 
     def set(self, key, value):
         """设置配置项（自动判断是全局还是角色配置）"""
-        global_keys = ["api_base_url", "api_key", "model", "max_history_messages", "weather_city", "weather_api_key", "current_character"]
-        
-        if key in global_keys:
+        if key in GLOBAL_SET_KEYS:
             self.config[key] = value
+        elif key in JOURNAL_KEYS:
+            char_id = self.get_current_character_id()
+            if char_id and char_id in self.config.get("characters", {}):
+                self._journal_set(char_id, [key], value)
+            return
+        elif key in DB_KEYS:
+            logging.error(f"{key} 存储在数据库中，请使用对应的增删方法")
+            return
         else:
+            if key == "health" and isinstance(value, dict) and "medication_reminders" in value:
+                # 吃药提醒存储在数据库中
+                value = {k: v for k, v in value.items() if k != "medication_reminders"}
             # 设置当前角色的配置
             char_id = self.get_current_character_id()
             if char_id and char_id in self.config.get("characters", {}):
                 self.config["characters"][char_id][key] = value
         
-        self.save_config()
+        self.save_config(changed=(key,))
+
+    def apply_patch(self, patch):
+        """一次性修改多个顶层配置项（全局或当前角色），返回实际变化的键
+        
+        只有值确实改变的键才会写入、重建快照并通知订阅者，
+        后台线程看到的要么是修改前的快照，要么是全部修改之后的快照。
+        """
+        current = self.get_current_character()
+        changed = []
+        for key, value in patch.items():
+            if key in DB_KEYS:
+                logging.error(f"{key} 存储在数据库中，请使用对应的增删方法")
+                continue
+            if key == "health" and isinstance(value, dict) and "medication_reminders" in value:
+                value = {k: v for k, v in value.items() if k != "medication_reminders"}
+            target = self.config if key in GLOBAL_SET_KEYS else current
+            if target is None or (key in target and target[key] == value):
+                continue
+            target[key] = value
+            changed.append(key)
+        
+        if changed:
+            self.save_config(changed=tuple(changed))
+        return changed
 
     def check_daily_reset(self):
         """检查是否是新的一天，重置喝水计数和提醒时间"""
@@ -421,7 +1054,7 @@ class ConfigManager:
                     if isinstance(self.config["characters"][char_id]["reminders"][reminder_type], dict):
                         self.config["characters"][char_id]["reminders"][reminder_type]["last_triggered"] = None
             
-            self.save_config()
+            self.save_config(changed=("cups_drunk_today", "last_reset_date", "reminders"))
     
     def get_today_schedule(self):
         """获取今天的工作时间"""
@@ -464,24 +1097,43 @@ class ConfigManager:
         
         if reminder_type in char_config["reminders"]:
             if isinstance(char_config["reminders"][reminder_type], dict):
-                char_config["reminders"][reminder_type]["last_triggered"] = datetime.now().isoformat()
-                self.save_config()
+                self._journal_set(char_id, ["reminders", reminder_type, "last_triggered"], datetime.now().isoformat())
 
     def add_chat_history(self, role, content):
-        """添加聊天记录，保留最近20条"""
+        """添加一条聊天记录（完整保存，不再截断）"""
         char_id = self.get_current_character_id()
         if not char_id or char_id not in self.config.get("characters", {}):
             return
         
-        history = self.config["characters"][char_id].get("chat_history", [])
-        history.append({"role": role, "content": content})
-        if len(history) > 20:
-            history = history[-20:]
-        self.config["characters"][char_id]["chat_history"] = history
-        self.save_config()
+        self.store.add_chat_message(char_id, role, content)
         
-    def get_chat_history(self):
-        return self.get("chat_history") or []
+    def get_chat_history(self, limit=CHAT_HISTORY_LIMIT, char_id=None):
+        """获取角色（默认当前角色）最近 limit 条聊天记录（按时间顺序，limit 为 None 时返回全部）"""
+        char_id = char_id or self.get_current_character_id()
+        if not char_id:
+            return []
+        return self.store.get_chat_history(char_id, limit)
+    
+    def count_chat_messages(self, char_id=None):
+        """角色（默认当前角色）的聊天记录总条数"""
+        char_id = char_id or self.get_current_character_id()
+        if not char_id:
+            return 0
+        return self.store.count_chat_messages(char_id)
+    
+    def search_chat_history(self, query, limit=50, match_all=True, exclude_ids=(), char_id=None):
+        """全文检索聊天记录（默认当前角色），按相关度排序"""
+        char_id = char_id or self.get_current_character_id()
+        if not char_id:
+            return []
+        return self.store.search_chat(char_id, query, limit, match_all, exclude_ids)
+    
+    def get_chat_context(self, message_id, char_id=None):
+        """获取某条聊天记录及其前后各一条消息"""
+        char_id = char_id or self.get_current_character_id()
+        if not char_id:
+            return []
+        return self.store.get_chat_neighbors(char_id, message_id)
     
     def add_anniversary(self, title, date_str, anniversary_type, notes=""):
         """添加纪念日"""
@@ -489,16 +1141,13 @@ class ConfigManager:
         if not char_id or char_id not in self.config.get("characters", {}):
             return
         
-        anniversaries = self.config["characters"][char_id].get("anniversaries", [])
-        anniversaries.append({
+        self.store.add_anniversary(char_id, {
             "id": str(datetime.now().timestamp()),
             "title": title,
             "date": date_str,
             "type": anniversary_type,
             "notes": notes
         })
-        self.config["characters"][char_id]["anniversaries"] = anniversaries
-        self.save_config()
     
     def remove_anniversary(self, anniversary_id):
         """删除纪念日"""
@@ -506,17 +1155,21 @@ class ConfigManager:
         if not char_id or char_id not in self.config.get("characters", {}):
             return
         
-        anniversaries = self.config["characters"][char_id].get("anniversaries", [])
-        anniversaries = [a for a in anniversaries if a.get("id") != anniversary_id]
-        self.config["characters"][char_id]["anniversaries"] = anniversaries
-        self.save_config()
+        self.store.remove_anniversary(char_id, anniversary_id)
     
-    def get_today_anniversaries(self):
+    def get_anniversaries(self):
+        """获取当前角色的所有纪念日"""
+        char_id = self.get_current_character_id()
+        if not char_id:
+            return []
+        return self.store.get_anniversaries(char_id)
+    
+    def get_today_anniversaries(self, char_id=None):
         """获取今天的纪念日列表"""
-        today = datetime.now().strftime("%m-%d")
-        anniversaries = self.get("anniversaries") or []
-        today_anniversaries = [a for a in anniversaries if a.get("date") == today]
-        return today_anniversaries
+        char_id = char_id or self.get_current_character_id()
+        if not char_id:
+            return []
+        return self.store.get_anniversaries(char_id, date=datetime.now().strftime("%m-%d"))
     
     # ============ 健康管理 ============
     
@@ -553,69 +1206,20 @@ class ConfigManager:
         self.config["characters"][char_id]["health"] = health
         self.save_config()
     
-    def get_period_status(self):
-        """获取生理期状态"""
-        health = self.get("health") or {}
-        period_tracker = health.get("period_tracker", {})
-        
-        if not period_tracker.get("enabled") or not period_tracker.get("last_start_date"):
-            return {"status": "disabled"}
-        
-        try:
-            last_start = datetime.strptime(period_tracker["last_start_date"], "%Y-%m-%d")
-            cycle_length = period_tracker.get("cycle_length", 28)
-            period_length = period_tracker.get("period_length", 5)
-            
-            today = datetime.now()
-            days_since_last = (today - last_start).days
-            
-            next_date = last_start + timedelta(days=cycle_length)
-            days_until = (next_date - today).days
-            
-            if days_since_last < period_length:
-                return {
-                    "status": "in_period",
-                    "period_day": days_since_last + 1,
-                    "days_until": days_until,
-                    "next_date": next_date.strftime("%Y-%m-%d")
-                }
-            elif days_until <= 5 and days_until > 0:
-                return {
-                    "status": "approaching",
-                    "days_until": days_until,
-                    "next_date": next_date.strftime("%Y-%m-%d")
-                }
-            else:
-                return {
-                    "status": "normal",
-                    "days_until": days_until,
-                    "next_date": next_date.strftime("%Y-%m-%d")
-                }
-        except Exception as e:
-            logging.error(f"Error calculating period status: {e}")
-            return {"status": "error"}
-    
     def add_medication_reminder(self, name, times, notes=""):
         """添加吃药提醒"""
         char_id = self.get_current_character_id()
         if not char_id or char_id not in self.config.get("characters", {}):
             return
         
-        health = self.config["characters"][char_id].get("health", {})
-        if "medication_reminders" not in health:
-            health["medication_reminders"] = []
-        
-        medication = {
+        self._medications_cache.pop(char_id, None)
+        self.store.add_medication(char_id, {
             "id": str(datetime.now().timestamp()),
             "name": name,
             "times": times,
             "notes": notes,
             "enabled": True
-        }
-        
-        health["medication_reminders"].append(medication)
-        self.config["characters"][char_id]["health"] = health
-        self.save_config()
+        })
     
     def remove_medication_reminder(self, med_id):
         """删除吃药提醒"""
@@ -623,19 +1227,18 @@ class ConfigManager:
         if not char_id or char_id not in self.config.get("characters", {}):
             return
         
-        health = self.config["characters"][char_id].get("health", {})
-        if "medication_reminders" in health:
-            health["medication_reminders"] = [
-                m for m in health["medication_reminders"] 
-                if m.get("id") != med_id
-            ]
-            self.config["characters"][char_id]["health"] = health
-            self.save_config()
+        self._medications_cache.pop(char_id, None)
+        self.store.remove_medication(char_id, med_id)
     
     def get_medication_reminders(self):
         """获取所有吃药提醒"""
-        health = self.get("health") or {}
-        return health.get("medication_reminders", [])
+        char_id = self.get_current_character_id()
+        if not char_id:
+            return []
+        medications = self._medications_cache.get(char_id)
+        if medications is None:
+            medications = self._medications_cache[char_id] = self.store.get_medications(char_id)
+        return medications
 
     def export_character(self, char_id, export_path):
         """导出角色为ZIP包
@@ -662,10 +1265,16 @@ class ConfigManager:
                 temp_path = os.path.join(temp_dir, "character")
                 os.makedirs(temp_path, exist_ok=True)
                 
-                # 1. 保存角色配置
+                # 1. 保存角色配置（连同数据库中的聊天记录、纪念日、吃药提醒，保持旧版角色包格式）
+                data = self.store.export_character_data(char_id)
+                export_config = copy.deepcopy(char_config)
+                export_config["chat_history"] = data["chat_history"]
+                export_config["anniversaries"] = data["anniversaries"]
+                export_config.setdefault("health", {})["medication_reminders"] = data["medication_reminders"]
+                
                 config_file = os.path.join(temp_path, "character.json")
                 with open(config_file, 'w', encoding='utf-8') as f:
-                    json.dump(char_config, f, indent=4, ensure_ascii=False)
+                    json.dump(export_config, f, indent=4, ensure_ascii=False)
                 
                 # 2. 收集资源文件
                 resources = []
@@ -841,8 +1450,7 @@ class ConfigManager:
                 char_config["cups_drunk_today"] = 0.0
                 char_config["last_reset_date"] = datetime.now().strftime("%Y-%m-%d")
                 
-                # 清空聊天历史（可选，用户可能想保留）
-                # char_config["chat_history"] = []
+                # 聊天历史保留，放入配置时会随角色一起移入数据库
                 
                 # 重置提醒触发时间
                 if "reminders" in char_config:
@@ -850,7 +1458,7 @@ class ConfigManager:
                         if isinstance(char_config["reminders"][reminder_type], dict):
                             char_config["reminders"][reminder_type]["last_triggered"] = None
                 
-                # 7. 添加角色到配置
+                # 7. 添加角色到配置（聊天记录等会被移入数据库）
                 self.config["characters"][new_char_id] = char_config
                 self.save_config()
                 
@@ -0,0 +1,288 @@
+import json
+import uuid
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from utils import segment_for_search, build_fts_query
+
+# 聊天记录、纪念日、吃药提醒等会不断增长或需要按条件查询的数据存放在这里，
+# 角色的其他设置仍在 characters/<角色ID>/character.json 中
+DATA_DB_FILE = "anmicius.db"
+
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    character_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    ts TEXT NOT NULL
+);
+-- 消息按 id（插入顺序）排序，ts 只用于显示（系统时间回拨后 ts 可能倒序）
+DROP INDEX IF EXISTS idx_chat_history_char_ts;
+CREATE INDEX IF NOT EXISTS idx_chat_history_char ON chat_history (character_id);
+
+CREATE TABLE IF NOT EXISTS anniversaries (
+    id TEXT PRIMARY KEY,
+    character_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT 'custom',
+    notes TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_anniversaries_char_date ON anniversaries (character_id, date);
+
+CREATE TABLE IF NOT EXISTS medications (
+    id TEXT PRIMARY KEY,
+    character_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    times TEXT NOT NULL DEFAULT '[]',
+    notes TEXT NOT NULL DEFAULT '',
+    enabled INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_medications_char ON medications (character_id);
+"""
+
+# 聊天记录全文索引：rowid 与 chat_history.id 相同，内容为 segment_for_search 切分后的文本
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(content, tokenize = 'unicode61');
+"""
+
+
+class DataStore:
+    """基于 SQLite（WAL 模式）的角色数据存储
+
+    单个连接 + 锁，可在 Tk 主线程和 AI 请求线程中共用。
+    每次写入只插入/删除对应的行，不需要重写整个配置文件。
+    """
+
+    def __init__(self, path=DATA_DB_FILE):
+        self.path = path
+        self.logger = logging.getLogger("DataStore")
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.create_function("segment", 1, segment_for_search)
+        self.fts_enabled = False
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+            try:
+                self._conn.executescript(_FTS_SCHEMA)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # 个别 Python 发行版的 SQLite 未编译 FTS5，退回到 LIKE 查询
+                self.logger.warning(f"FTS5 unavailable, chat search falls back to LIKE: {e}")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 2 and self.fts_enabled:
+                self._rebuild_chat_index()
+            if version < SCHEMA_VERSION:
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _rebuild_chat_index(self):
+        """根据 chat_history 重建全文索引（升级数据库或修改分词方式后）"""
+        self._conn.execute("DELETE FROM chat_fts")
+        self._conn.execute("INSERT INTO chat_fts (rowid, content) SELECT id, segment(content) FROM chat_history")
+        self.logger.info("Rebuilt chat full-text index")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ============ 聊天记录 ============
+
+    def add_chat_message(self, character_id, role, content, ts=None):
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO chat_history (character_id, role, content, ts) VALUES (?, ?, ?, ?)",
+                (character_id, role, content, ts or datetime.now().isoformat())
+            )
+            if self.fts_enabled:
+                self._conn.execute(
+                    "INSERT INTO chat_fts (rowid, content) VALUES (?, segment(?))", (cur.lastrowid, content)
+                )
+            return cur.lastrowid
+
+    def get_chat_history(self, character_id, limit=None):
+        """按时间顺序返回最近 limit 条聊天记录（limit 为 None 时返回全部）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, role, content, ts FROM chat_history WHERE character_id = ? "
+                "ORDER BY id DESC LIMIT ?",
+                (character_id, -1 if limit is None else limit)
+            ).fetchall()
+        return [{"id": r["id"], "role": r["role"], "content": r["content"], "ts": r["ts"]} for r in reversed(rows)]
+
+    def search_chat(self, character_id, query, limit=50, match_all=True, exclude_ids=()):
+        """全文检索聊天记录，按 bm25 相关度排序（分数越小越相关）
+
+        match_all 的含义见 utils.build_fts_query；exclude_ids 中的消息不会返回。
+        """
+        if not self.fts_enabled:
+            return self._search_chat_like(character_id, query, limit, exclude_ids)
+        fts_query = build_fts_query(query, match_all)
+        if not fts_query:
+            return []
+        exclude_ids = list(exclude_ids)
+        sql = ("SELECT h.id, h.role, h.content, h.ts, bm25(chat_fts) AS score "
+               "FROM chat_fts JOIN chat_history h ON h.id = chat_fts.rowid "
+               "WHERE chat_fts MATCH ? AND h.character_id = ?")
+        params = [fts_query, character_id]
+        if exclude_ids:
+            sql += f" AND h.id NOT IN ({','.join('?' * len(exclude_ids))})"
+            params.extend(exclude_ids)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                self.logger.error(f"Chat search failed for {fts_query!r}: {e}")
+                return []
+        return [dict(r) for r in rows]
+
+    def _search_chat_like(self, character_id, query, limit, exclude_ids):
+        query = (query or "").strip()
+        if not query:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, role, content, ts, 0.0 AS score FROM chat_history "
+                "WHERE character_id = ? AND content LIKE ? ORDER BY id DESC LIMIT ?",
+                (character_id, f"%{query}%", limit + len(exclude_ids))
+            ).fetchall()
+        return [dict(r) for r in rows if r["id"] not in exclude_ids][:limit]
+
+    def get_chat_neighbors(self, character_id, message_id, before=1, after=1):
+        """返回某条消息及其前后相邻的消息（按时间顺序），用于还原一轮完整的对话"""
+        with self._lock:
+            prev_rows = self._conn.execute(
+                "SELECT id, role, content, ts FROM chat_history WHERE character_id = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?", (character_id, message_id, before)
+            ).fetchall()
+            next_rows = self._conn.execute(
+                "SELECT id, role, content, ts FROM chat_history WHERE character_id = ? AND id >= ? "
+                "ORDER BY id LIMIT ?", (character_id, message_id, after + 1)
+            ).fetchall()
+        return [dict(r) for r in reversed(prev_rows)] + [dict(r) for r in next_rows]
+
+    def count_chat_messages(self, character_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM chat_history WHERE character_id = ?", (character_id,)
+            ).fetchone()[0]
+
+    # ============ 纪念日 ============
+
+    def add_anniversary(self, character_id, anniversary):
+        anniv_id = anniversary.get("id") or str(datetime.now().timestamp())
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO anniversaries (id, character_id, title, date, type, notes) VALUES (?, ?, ?, ?, ?, ?)",
+                (anniv_id, character_id, anniversary.get("title", ""), anniversary.get("date", ""),
+                 anniversary.get("type", "custom"), anniversary.get("notes", ""))
+            )
+        return anniv_id
+
+    def remove_anniversary(self, character_id, anniversary_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM anniversaries WHERE character_id = ? AND id = ?", (character_id, anniversary_id)
+            )
+
+    def get_anniversaries(self, character_id, date=None):
+        """返回角色的纪念日（按添加顺序），date 为 MM-DD 时只返回当天的"""
+        query = "SELECT id, title, date, type, notes FROM anniversaries WHERE character_id = ?"
+        params = [character_id]
+        if date is not None:
+            query += " AND date = ?"
+            params.append(date)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY rowid", params).fetchall()
+        return [dict(r) for r in rows]
+
+    # ============ 吃药提醒 ============
+
+    def add_medication(self, character_id, medication):
+        med_id = medication.get("id") or str(datetime.now().timestamp())
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO medications (id, character_id, name, times, notes, enabled) VALUES (?, ?, ?, ?, ?, ?)",
+                (med_id, character_id, medication.get("name", ""),
+                 json.dumps(medication.get("times", []), ensure_ascii=False),
+                 medication.get("notes", ""), 1 if medication.get("enabled", True) else 0)
+            )
+        return med_id
+
+    def remove_medication(self, character_id, medication_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM medications WHERE character_id = ? AND id = ?", (character_id, medication_id)
+            )
+
+    def get_medications(self, character_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, name, times, notes, enabled FROM medications WHERE character_id = ? ORDER BY rowid",
+                (character_id,)
+            ).fetchall()
+        medications = []
+        for r in rows:
+            try:
+                times = json.loads(r["times"])
+            except ValueError:
+                times = []
+            medications.append({
+                "id": r["id"],
+                "name": r["name"],
+                "times": times,
+                "notes": r["notes"],
+                "enabled": bool(r["enabled"])
+            })
+        return medications
+
+    # ============ 整个角色 ============
+
+    def import_character_data(self, character_id, chat_history=(), anniversaries=(), medications=()):
+        """导入角色数据（旧配置迁移、导入角色包时使用）
+
+        可重复执行：该角色已有聊天记录时不再导入聊天记录，纪念日和吃药提醒按 ID 去重。
+        """
+        with self._lock, self._conn:
+            if chat_history and not self.count_chat_messages(character_id):
+                now = datetime.now().isoformat()
+                for m in chat_history:
+                    if isinstance(m, dict):
+                        self.add_chat_message(character_id, m.get("role", "user"), m.get("content", ""),
+                                              m.get("ts") or now)
+            for anniversary in anniversaries:
+                self.add_anniversary(character_id, dict(anniversary, id=anniversary.get("id") or str(uuid.uuid4())))
+            for medication in medications:
+                self.add_medication(character_id, dict(medication, id=medication.get("id") or str(uuid.uuid4())))
+
+    def export_character_data(self, character_id):
+        """导出角色数据，格式与旧版 character.json 中的字段一致"""
+        return {
+            "chat_history": [{"role": m["role"], "content": m["content"], "ts": m["ts"]}
+                             for m in self.get_chat_history(character_id)],
+            "anniversaries": self.get_anniversaries(character_id),
+            "medication_reminders": self.get_medications(character_id)
+        }
+
+    def delete_character(self, character_id):
+        with self._lock, self._conn:
+            if self.fts_enabled:
+                self._conn.execute(
+                    "DELETE FROM chat_fts WHERE rowid IN (SELECT id FROM chat_history WHERE character_id = ?)",
+                    (character_id,)
+                )
+            for table in ("chat_history", "anniversaries", "medications"):
+                self._conn.execute(f"DELETE FROM {table} WHERE character_id = ?", (character_id,))
+        self.logger.info(f"Deleted data for character {character_id}")
@@ -0,0 +1,574 @@
+import os
+import sys
+import abc
+import json
+import math
+import time
+import pstats
+import cProfile
+import tracemalloc
+import socket
+import logging
+import threading
+import functools
+import sysconfig
+import traceback
+import http.client
+import urllib.request
+from collections import Counter, deque
+from datetime import datetime
+
+# 所有诊断数据（指标、报告、性能分析文件）统一放在这个目录下
+DIAGNOSTICS_DIR = "diagnostics"
+
+# 标准库与第三方库所在目录，用于从调用栈中区分应用代码
+_LIBRARY_DIRS = tuple(sorted({
+    os.path.normcase(os.path.abspath(path))
+    for key, path in sysconfig.get_paths().items()
+    if key in ("stdlib", "platstdlib", "purelib", "platlib")
+}))
+
+
+def percentile(values, pct):
+    """计算百分位数（最近秩法），values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# ============ 带分阶段计时的 HTTP 连接 ============
+
+def _timed_connect(conn, connect):
+    """执行连接并记录 DNS 解析与建连耗时（HTTPS 的建连耗时包含 TLS 握手）
+
+    解析由 _timed_create_connection 完成并计时，建连耗时为总耗时减去解析耗时。
+    """
+    conn.timings.pop("dns_ms", None)
+    t0 = time.perf_counter()
+    connect()
+    total_ms = (time.perf_counter() - t0) * 1000
+    conn.timings["connect_ms"] = total_ms - (conn.timings.get("dns_ms") or 0)
+
+
+def _timed_create_connection(conn, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """代替 socket.create_connection：只解析一次主机名并计时，然后依次尝试连接解析出的地址"""
+    host, port = address
+    t0 = time.perf_counter()
+    try:
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    finally:
+        conn.timings["dns_ms"] = (time.perf_counter() - t0) * 1000
+    error = None
+    for family, socktype, proto, _, sockaddr in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error or OSError(f"getaddrinfo returned no addresses for {host}")
+
+
+class _TimedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, timings=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = timings if timings is not None else {}
+        self._create_connection = functools.partial(_timed_create_connection, self)
+
+    def connect(self):
+        _timed_connect(self, super().connect)
+
+
+class _TimedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, timings=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = timings if timings is not None else {}
+        self._create_connection = functools.partial(_timed_create_connection, self)
+
+    def connect(self):
+        _timed_connect(self, super().connect)
+
+
+class _TimedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        factory = functools.partial(_TimedHTTPConnection, timings=getattr(req, "timings", None))
+        return self.do_open(factory, req)
+
+
+class _TimedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        factory = functools.partial(_TimedHTTPSConnection, timings=getattr(req, "timings", None))
+        kwargs = {"context": self._context}
+        if hasattr(self, "_check_hostname"):  # Python 3.12 之前的版本
+            kwargs["check_hostname"] = self._check_hostname
+        return self.do_open(factory, req, **kwargs)
+
+
+def build_timed_opener():
+    """创建一个会把 DNS/建连耗时写入 request.timings 的 opener（保留系统代理等默认行为）"""
+    return urllib.request.build_opener(_TimedHTTPHandler, _TimedHTTPSHandler)
+
+
+# ============ 按天落盘的记录 ============
+
+class DailyRecordLog(abc.ABC):
+    """按角色、按天追加写入 jsonl 的记录器基类
+
+    子类实现 _ingest() 把单条记录合并进内存中的统计；
+    首次访问某角色时会先用今天的记录文件恢复统计。
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        self._loaded = set()  # 已从磁盘恢复过的 (char_id, date)
+
+    @abc.abstractmethod
+    def _ingest(self, char_id, record):
+        """把单条记录合并进内存中的统计（调用方持有锁）"""
+
+    def _day_file(self, char_id, day):
+        return os.path.join(self.base_dir, char_id or "_global", f"{day}.jsonl")
+
+    def _ensure_loaded(self, char_id, day):
+        """调用方需持有锁"""
+        if (char_id, day) in self._loaded:
+            return
+        self._loaded.add((char_id, day))
+        path = self._day_file(char_id, day)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 跳过写了一半的行
+                    self._ingest(char_id, record)
+        except Exception as e:
+            logging.error(f"Failed to load diagnostics records {path}: {e}")
+
+    def record(self, char_id, record):
+        """记录一条数据（可在任意线程调用）"""
+        day = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            self._ensure_loaded(char_id, day)
+            self._ingest(char_id, record)
+            path = self._day_file(char_id, day)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                logging.error(f"Failed to persist diagnostics record: {e}")
+
+
+# ============ 请求指标 ============
+
+class RequestMetrics(DailyRecordLog):
+    """记录每次 AI 请求的耗时、流量与 Token 用量
+
+    内存中按 (角色, 消息类型) 保留最近 window 条记录用于计算 p50/p95，
+    同时按天追加写入 diagnostics/metrics/<角色ID>/<日期>.jsonl。
+    """
+
+    def __init__(self, base_dir=None, window=200):
+        super().__init__(base_dir or os.path.join(DIAGNOSTICS_DIR, "metrics"))
+        self.window = window
+        self._windows = {}  # {(char_id, msg_type): deque[record]}
+
+    def _ingest(self, char_id, record):
+        key = (char_id, record.get("msg_type") or "unknown")
+        if key not in self._windows:
+            self._windows[key] = deque(maxlen=self.window)
+        self._windows[key].append(record)
+
+    def summary(self, char_id):
+        """按消息类型汇总指定角色的滚动指标"""
+        with self._lock:
+            self._ensure_loaded(char_id, datetime.now().strftime("%Y-%m-%d"))
+            windows = {k[1]: list(v) for k, v in self._windows.items() if k[0] == char_id}
+
+        rows = []
+        for msg_type, records in sorted(windows.items()):
+            ok = [r for r in records if not r.get("error")]
+            totals = [r["total_ms"] for r in ok if r.get("total_ms") is not None]
+            ttfbs = [r["ttfb_ms"] for r in ok if r.get("ttfb_ms") is not None]
+            tokens = [r["total_tokens"] for r in ok if r.get("total_tokens")]
+            rows.append({
+                "msg_type": msg_type,
+                "count": len(records),
+                "errors": len(records) - len(ok),
+                "model": records[-1].get("model", ""),
+                "p50_total_ms": percentile(totals, 50),
+                "p95_total_ms": percentile(totals, 95),
+                "p50_ttfb_ms": percentile(ttfbs, 50),
+                "p95_ttfb_ms": percentile(ttfbs, 95),
+                "avg_request_bytes": sum(r.get("request_bytes", 0) for r in records) // len(records),
+                "avg_response_bytes": sum(r.get("response_bytes", 0) for r in records) // len(records),
+                "avg_total_tokens": sum(tokens) // len(tokens) if tokens else None
+            })
+        return rows
+
+
+# ============ 提示词构成 ============
+
+class PromptStats(DailyRecordLog):
+    """统计每次请求的提示词各部分（人设、Lorebook、历史等）的字数与估算 Token
+
+    记录写入 diagnostics/prompts/<角色ID>/<日期>.jsonl，内存中按角色累计各部分的总量与峰值。
+    """
+
+    def __init__(self, base_dir=None):
+        super().__init__(base_dir or os.path.join(DIAGNOSTICS_DIR, "prompts"))
+        self._totals = {}  # {char_id: {"count": n, "sections": {name: {"chars", "tokens", "max_tokens"}}}}
+
+    def _ingest(self, char_id, record):
+        agg = self._totals.setdefault(char_id, {"count": 0, "sections": {}})
+        agg["count"] += 1
+        for name, section in record.get("sections", {}).items():
+            totals = agg["sections"].setdefault(name, {"chars": 0, "tokens": 0, "max_tokens": 0})
+            totals["chars"] += section.get("chars", 0)
+            totals["tokens"] += section.get("tokens", 0)
+            totals["max_tokens"] = max(totals["max_tokens"], section.get("tokens", 0))
+
+    def summary(self, char_id):
+        """返回指定角色各部分的平均/峰值 Token，按平均 Token 从大到小排序"""
+        with self._lock:
+            self._ensure_loaded(char_id, datetime.now().strftime("%Y-%m-%d"))
+            agg = self._totals.get(char_id)
+            if not agg or not agg["count"]:
+                return []
+            count = agg["count"]
+            sections = {k: dict(v) for k, v in agg["sections"].items()}
+
+        grand_total = sum(v["tokens"] for v in sections.values()) or 1
+        rows = [{
+            "section": name,
+            "avg_chars": v["chars"] // count,
+            "avg_tokens": v["tokens"] // count,
+            "max_tokens": v["max_tokens"],
+            "share": v["tokens"] / grand_total
+        } for name, v in sections.items()]
+        rows.sort(key=lambda r: r["avg_tokens"], reverse=True)
+        return rows
+
+
+# ============ Tk 事件循环卡顿监测 ============
+
+class StallWatchdog:
+    """监测 Tk 主线程卡顿
+
+    主线程用 root.after 定时打心跳；后台线程发现心跳超时后，
+    通过 sys._current_frames 采样主线程调用栈。卡顿结束时记录
+    卡顿时长、触发卡顿的事件处理函数以及采样到最多的代码位置。
+    心跳正常时后台线程只在下一次可能超时的时刻醒来；窗口隐藏时 suspend() 停止心跳，
+    后台线程阻塞等待 resume()，不再占用 CPU。
+    必须在 Tk 主线程创建，start/stop/suspend/resume 只能在 Tk 主线程调用。
+    """
+
+    # 卡顿超过这个时长仍未结束时，先记一条日志（防止彻底卡死时什么都没留下）
+    HANG_REPORT_MS = 5000
+
+    def __init__(self, root, interval_ms=100, threshold_ms=250, sample_ms=50):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.sample_ms = sample_ms
+        self.logger = logging.getLogger("Watchdog")
+        self.main_thread_id = threading.get_ident()
+        self.stall_count = 0
+        self._running = False
+        self._expected_at = 0.0  # 下一次心跳的预期时间（perf_counter 秒）
+        self._samples = []  # 当前卡顿期间采样到的调用栈
+        self._hang_reported = False
+        self._lock = threading.Lock()
+        self._active = threading.Event()  # 运行中且未暂停
+        self._job = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._begin()
+        threading.Thread(target=self._monitor, name="StallWatchdog", daemon=True).start()
+        self.logger.info(f"Stall watchdog started (threshold {self.threshold_ms}ms)")
+
+    def stop(self):
+        self._running = False
+        self._pause()
+        self._active.set()  # 唤醒后台线程使其退出
+
+    def suspend(self):
+        """窗口隐藏时暂停监测"""
+        if self._running and self._active.is_set():
+            self._pause()
+            self.logger.debug("Stall watchdog suspended")
+
+    def resume(self):
+        if self._running and not self._active.is_set():
+            self._begin()
+            self.logger.debug("Stall watchdog resumed")
+
+    def _begin(self):
+        with self._lock:
+            self._samples = []
+            self._hang_reported = False
+            self._expected_at = time.perf_counter() + self.interval_ms / 1000
+            self._active.set()
+        self._job = self.root.after(self.interval_ms, self._heartbeat)
+
+    def _pause(self):
+        with self._lock:
+            self._active.clear()
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+    def _heartbeat(self):
+        self._job = None
+        if not self._running or not self._active.is_set():
+            return
+        now = time.perf_counter()
+        lag_ms = (now - self._expected_at) * 1000
+        with self._lock:
+            samples, self._samples = self._samples, []
+            self._hang_reported = False
+            self._expected_at = now + self.interval_ms / 1000
+        if lag_ms > self.threshold_ms:
+            self.stall_count += 1
+            self._report(lag_ms, samples, finished=True)
+        self._job = self.root.after(self.interval_ms, self._heartbeat)
+
+    def _monitor(self):
+        while True:
+            self._active.wait()
+            if not self._running:
+                return
+            with self._lock:
+                lag_ms = (time.perf_counter() - self._expected_at) * 1000
+            if lag_ms <= self.threshold_ms:
+                # 心跳正常：睡到下一次可能判定为卡顿的时刻
+                time.sleep(max(self.threshold_ms - lag_ms, self.sample_ms) / 1000)
+                continue
+            time.sleep(self.sample_ms / 1000)
+            with self._lock:
+                lag_ms = (time.perf_counter() - self._expected_at) * 1000
+                # 睡眠期间可能已暂停（心跳停止不算卡顿）或心跳已恢复
+                if not self._active.is_set() or lag_ms <= self.threshold_ms:
+                    continue
+                frame = sys._current_frames().get(self.main_thread_id)
+                if frame is not None:
+                    self._samples.append(traceback.extract_stack(frame))
+                del frame
+                report_hang = lag_ms > self.HANG_REPORT_MS and not self._hang_reported
+                if report_hang:
+                    self._hang_reported = True
+                    samples = list(self._samples)
+            if report_hang:
+                self._report(lag_ms, samples, finished=False)
+
+    @staticmethod
+    def _is_library_frame(frame_summary):
+        filename = os.path.normcase(os.path.abspath(frame_summary.filename))
+        return filename.startswith(_LIBRARY_DIRS)
+
+    def _describe(self, stack):
+        """返回 (事件处理函数, 最内层的应用代码位置)"""
+        handler = None
+        innermost = None
+        came_from_tk = False
+        for fs in stack:
+            if self._is_library_frame(fs):
+                came_from_tk = True
+                continue
+            location = f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})"
+            # Tk 回调进入应用代码的第一帧即为事件处理函数
+            if came_from_tk and handler is None:
+                handler = location
+            innermost = location
+        return handler or innermost or "unknown", innermost or "unknown"
+
+    def _report(self, lag_ms, samples, finished):
+        if not samples:
+            self.logger.warning(f"Tk event loop stalled {lag_ms:.0f}ms (no stack sampled)")
+            return
+        handler, _ = self._describe(samples[0])
+        hotspots = Counter(self._describe(stack)[1] for stack in samples)
+        hotspot, hits = hotspots.most_common(1)[0]
+        state = "stalled" if finished else "still stalled after"
+        self.logger.warning(
+            f"Tk event loop {state} {lag_ms:.0f}ms in handler {handler}; "
+            f"hotspot {hotspot} ({hits}/{len(samples)} samples)"
+        )
+        self.logger.debug("Main thread stack during stall:\n" + "".join(traceback.format_list(samples[-1])))
+
+
+# ============ 用户可触发的诊断工具（托盘菜单） ============
+
+def _report_path(subdir, prefix, ext):
+    folder = os.path.join(DIAGNOSTICS_DIR, subdir)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+
+class ProcessProfiler:
+    """整个进程的 cProfile 开关，停止时写出 .prof 文件和文本摘要
+
+    start/stop 须在 Tk 主线程调用。Python 3.12 以下 cProfile 只能分析调用线程，
+    因此另外通过 threading.setprofile 为之后新建的线程（AI 请求等）各挂一个分析器，
+    停止时合并；开始前已在运行的线程（托盘等）不在统计范围内。
+    disable() 同样只作用于调用线程，线程分析器由各自线程中的跟踪函数在分析停止后自行移除。
+    """
+
+    def __init__(self):
+        self.running = False
+        self._generation = 0  # 每次开始/停止加一，旧的线程分析器据此自行移除
+        self._main = None
+        self._thread_profilers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.running:
+            return
+        self._main = cProfile.Profile()
+        self._thread_profilers = []
+        self.running = True
+        self._generation += 1
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._thread_hook)
+        self._main.enable()
+        logging.info("Profiler started")
+
+    def _thread_hook(self, frame, event, arg):
+        sys.setprofile(None)
+        if not self.running:
+            return
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append(profiler)
+        profiler.enable()
+        sys.settrace(functools.partial(self._thread_tracer, self._generation))
+
+    def _thread_tracer(self, generation, frame, event, arg):
+        """线程中每次函数调用时检查分析是否已停止，停止后在本线程内移除分析器（返回 None，不跟踪逐行事件）"""
+        if generation != self._generation:
+            sys.setprofile(None)
+            sys.settrace(None)
+        return None
+
+    def stop(self):
+        """停止分析并返回 .prof 文件路径"""
+        if not self.running:
+            return None
+        self.running = False
+        self._generation += 1
+        threading.setprofile(None)
+        self._main.disable()
+
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            thread_profilers, self._thread_profilers = self._thread_profilers, []
+        for profiler in thread_profilers:
+            try:
+                profiler.disable()
+                stats.add(profiler)
+            except (TypeError, ValueError) as e:
+                logging.debug(f"Skipped thread profile: {e}")
+
+        path = _report_path("profiles", "profile", "prof")
+        stats.dump_stats(path)
+        # 同时写一份文本摘要，方便没有分析工具的用户直接查看
+        with open(path[:-len(".prof")] + ".txt", 'w', encoding='utf-8') as f:
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(60)
+        logging.info(f"Profiler stopped, saved to {path}")
+        return path
+
+
+class MemoryReporter:
+    """tracemalloc 内存快照
+
+    第一次调用时才开启 tracemalloc（开启后略微拖慢分配），之后每次快照都会
+    与上一次比较，列出增长最多的位置。Tk 图片的像素数据不在 Python 堆上，
+    由调用方通过 app_usage 传入估算值。
+    """
+
+    def __init__(self, limit=25):
+        self.limit = limit
+        self._last_snapshot = None
+
+    def write_report(self, app_usage=None):
+        """生成报告文件并返回路径；app_usage 为 [(名称, 字节数)]"""
+        just_started = not tracemalloc.is_tracing()
+        if just_started:
+            tracemalloc.start(10)
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+
+        lines = [f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+                 f"Python 堆 (tracemalloc): 当前 {current / 1024 / 1024:.1f} MB, 峰值 {peak / 1024 / 1024:.1f} MB", ""]
+        if just_started:
+            lines += ["注意：tracemalloc 刚刚开启，只统计之后的内存分配。过一段时间再生成一次快照可以看到增长情况。", ""]
+
+        if app_usage:
+            lines.append("== 应用对象估算 ==")
+            for name, size in sorted(app_usage, key=lambda item: item[1], reverse=True):
+                lines.append(f"{size / 1024:>10.1f} KB  {name}")
+            lines.append(f"{sum(size for _, size in app_usage) / 1024:>10.1f} KB  合计")
+            lines.append("")
+
+        lines.append(f"== 分配最多的 {self.limit} 处代码 ==")
+        for stat in snapshot.statistics("lineno")[:self.limit]:
+            lines.append(str(stat))
+
+        if self._last_snapshot is not None:
+            lines.append("")
+            lines.append(f"== 与上次快照相比增长最多的 {self.limit} 处代码 ==")
+            for stat in snapshot.compare_to(self._last_snapshot, "lineno")[:self.limit]:
+                lines.append(str(stat))
+        self._last_snapshot = snapshot
+
+        path = _report_path("reports", "memory", "txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        logging.info(f"Memory report saved to {path}")
+        return path
+
+
+def dump_thread_stacks():
+    """把所有线程的当前调用栈写入文件并返回路径"""
+    frames = sys._current_frames()
+    lines = [f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ""]
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        lines.append(f"== {thread.name} (ident={thread.ident}, daemon={thread.daemon}) ==")
+        if frame is not None:
+            lines.append("".join(traceback.format_stack(frame)))
+        lines.append("")
+    del frames
+
+    path = _report_path("reports", "threads", "txt")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines))
+    logging.info(f"Thread stacks saved to {path}")
+    return path
+
+
+# 全进程共享的记录器（AIClient 可能被多次重建）
+request_metrics = RequestMetrics()
+prompt_stats = PromptStats()
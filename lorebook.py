@@ -0,0 +1,166 @@
+import json
+import math
+import hashlib
+import logging
+import threading
+
+from utils import search_tokens, estimate_tokens, is_cjk
+
+logger = logging.getLogger("Lorebook")
+
+LOREBOOK_MODES = ("keyword", "bm25")
+
+DEFAULT_LOREBOOK_SETTINGS = {
+    "mode": "keyword",        # keyword: 关键词命中即触发；bm25: 按与对话的相关度排序取前 top_k 条
+    "token_budget": 1500,     # 注入提示词的世界书总 Token 上限（常驻条目也计入，0 表示不限制）
+    "top_k": 5,               # bm25 模式下最多注入的非常驻条目数
+    "history_messages": 4     # bm25 模式下除当前输入外参与检索的最近聊天条数
+}
+
+# 条目关键词在索引中的权重（相当于重复出现的次数）
+KEYWORD_WEIGHT = 3
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def lore_terms(text):
+    """BM25 使用的词：英文单词/数字整体作为一个词，连续的中日韩字符取相邻二字（单字时取单字）"""
+    terms = []
+    run = []
+    for token in search_tokens(text) + [""]:
+        if is_cjk(token):
+            run.append(token)
+            continue
+        if run:
+            if len(run) == 1:
+                terms.append(run[0])
+            else:
+                terms.extend(a + b for a, b in zip(run, run[1:]))
+            run = []
+        if token:
+            terms.append(token)
+    return terms
+
+
+def split_keywords(keywords):
+    return [kw.strip() for kw in (keywords or "").replace("，", ",").split(",") if kw.strip()]
+
+
+def entry_order(entry, index):
+    """条目的注入顺序：优先使用酒馆角色卡中的 insertion_order，否则按列表顺序"""
+    order = entry.get("insertion_order")
+    return (order if isinstance(order, (int, float)) else index, index)
+
+
+class LorebookIndex:
+    """单个角色世界书的内存 BM25 索引（只索引关键词触发的条目）"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.tokens = [estimate_tokens(e.get("content", "")) for e in entries]
+        self.keywords = [split_keywords(e.get("keywords")) for e in entries]
+        self.doc_tf = {}  # {条目下标: {词: 词频}}
+        self.doc_len = {}
+        df = {}
+        for i, entry in enumerate(entries):
+            if entry.get("type") == "always":
+                continue
+            terms = lore_terms(entry.get("content", ""))
+            for kw in self.keywords[i]:
+                terms.extend(lore_terms(kw) * KEYWORD_WEIGHT)
+            tf = {}
+            for term in terms:
+                tf[term] = tf.get(term, 0) + 1
+            self.doc_tf[i] = tf
+            self.doc_len[i] = len(terms)
+            for term in tf:
+                df[term] = df.get(term, 0) + 1
+        n = len(self.doc_tf)
+        self.avg_len = (sum(self.doc_len.values()) / n) if n else 0
+        self.idf = {t: math.log(1 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+
+    def score(self, query):
+        """返回 {条目下标: 相关度}，只包含相关度大于 0 的条目"""
+        query_terms = set(lore_terms(query))
+        scores = {}
+        if not query_terms or not self.avg_len:
+            return scores
+        for i, tf in self.doc_tf.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[i] / self.avg_len)
+            total = 0.0
+            for term in query_terms:
+                freq = tf.get(term)
+                if freq:
+                    total += self.idf[term] * freq * (BM25_K1 + 1) / (freq + norm)
+            if total > 0:
+                scores[i] = total
+        return scores
+
+    def keyword_hits(self, text):
+        """关键词直接出现在文本中的条目下标（与旧版触发规则相同）"""
+        if not text:
+            return []
+        return [i for i in self.doc_tf if any(kw in text for kw in self.keywords[i])]
+
+
+_index_cache = {}  # {角色ID: (世界书内容指纹, LorebookIndex)}
+_index_lock = threading.Lock()
+
+
+def get_index(char_id, entries):
+    """获取角色的世界书索引，内容未变化时复用已构建的索引"""
+    # 配置快照中的条目是只读映射（MappingProxyType），序列化时按普通字典处理
+    fingerprint = hashlib.md5(json.dumps(entries, ensure_ascii=False, sort_keys=True, default=dict).encode("utf-8")).hexdigest()
+    with _index_lock:
+        cached = _index_cache.get(char_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+    index = LorebookIndex(entries)
+    with _index_lock:
+        _index_cache[char_id] = (fingerprint, index)
+    logger.debug(f"Built lorebook index for {char_id}: {len(index.doc_tf)} searchable of {len(entries)} entries")
+    return index
+
+
+def drop_index(char_id):
+    """释放角色的世界书索引（角色不再常驻内存时）"""
+    with _index_lock:
+        _index_cache.pop(char_id, None)
+
+
+def select_entries(char_id, entries, user_input="", history_text="", settings=None):
+    """选出本次要注入提示词的世界书条目
+
+    常驻条目优先（按注入顺序），其余条目按关键词命中或 BM25 相关度排序，
+    在 token_budget 内依次加入；返回的条目按 insertion_order 排列。
+    """
+    if not entries:
+        return []
+    settings = dict(DEFAULT_LOREBOOK_SETTINGS, **(settings or {}))
+    token_budget = settings.get("token_budget") or 0
+    index = get_index(char_id, entries)
+
+    constant = sorted((i for i, e in enumerate(entries) if e.get("type") == "always"),
+                      key=lambda i: entry_order(entries[i], i))
+
+    # 关键词命中的条目总是排在最前面（保持旧版行为）
+    hits = index.keyword_hits(user_input)
+    if settings.get("mode") == "bm25":
+        scores = index.score(f"{user_input or ''}\n{history_text or ''}")
+        ranked = sorted(scores, key=lambda i: (i not in hits, -scores[i]))
+        ranked = list(dict.fromkeys(hits + ranked))[:max(settings.get("top_k") or 0, len(hits))]
+    else:
+        ranked = hits
+
+    selected = []
+    used_tokens = 0
+    for i in constant + ranked:
+        if token_budget and used_tokens + index.tokens[i] > token_budget:
+            logger.debug(f"Lorebook entry {entries[i].get('id')} skipped: over budget ({used_tokens}+{index.tokens[i]}>{token_budget})")
+            continue
+        used_tokens += index.tokens[i]
+        selected.append(i)
+
+    logger.info(f"Lorebook: {len(selected)}/{len(entries)} entries, {used_tokens} tokens "
+                f"(mode={settings.get('mode')}, {len(hits)} keyword hits)")
+    return [entries[i] for i in sorted(selected, key=lambda i: entry_order(entries[i], i))]
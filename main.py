@@ -2,22 +2,34 @@ import tkinter as tk
 from tkinter import ttk, messagebox, Menu, simpledialog, filedialog
 import customtkinter as ctk
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import shutil
 import time
+import math
 import uuid
+import json
+import weakref
 import webbrowser
 from config_manager import ConfigManager
 from ai_client import AIClient
 import logging
 import sys
-from utils import resource_path, setup_logging, get_weather_info
+from utils import resource_path, setup_logging, apply_log_levels, apply_log_rotation, get_weather_info
+from diagnostics import request_metrics, prompt_stats, StallWatchdog, ProcessProfiler, MemoryReporter, dump_thread_stacks
+from lorebook import DEFAULT_LOREBOOK_SETTINGS, get_index as get_lore_index, drop_index as drop_lore_index
+from scene import CanvasScene
+from bubble import BubbleRenderer, BubbleStyle
+from animation import Animator
+from touch import TouchIndex, sprite_mask, area_points
+from sprites import (SpriteLoader, ExpressionCache, ResidentCharacters, SpriteFrames, decode_sprite,
+                     likely_expressions, binarize_alpha)
 
 # 托盘图标支持
 import pystray
 from PIL import Image as PILImage
-from PIL import ImageTk, ImageDraw, ImageFont
+from PIL import ImageTk, ImageFont
 
 # 设置 CustomTkinter 主题
 ctk.set_appearance_mode("System")  # 跟随系统 (Light/Dark)
@@ -26,6 +38,24 @@ ctk.set_default_color_theme("blue")  # 主题颜色
 # 定义透明色（必须是一个你立绘里没用到的颜色）
 TRANSPARENT_COLOR = '#ff00ff'  # 亮粉色
 
+# 世界书注入方式在设置界面中的显示名称
+LORE_MODE_LABELS = {"keyword": "关键词触发", "bm25": "BM25 相关度"}
+
+# 呼吸动画：立绘上下浮动的幅度（像素）、周期和检查间隔（毫秒）
+BREATH_AMPLITUDE = 2
+BREATH_PERIOD_MS = 4000
+BREATH_INTERVAL_MS = 100
+# 气泡弹出/收起时从该比例缩放到原大小
+BUBBLE_POP_SCALE = 0.85
+# 退出时窗口淡出的时长（毫秒）
+QUIT_FADE_MS = 1000
+# 指针移动超过该距离（像素）才算拖动窗口，否则视为单击
+DRAG_THRESHOLD = 3
+
+# 高频路径使用独立的 logger，可在 config.json 的 logging.levels 中单独调整级别
+touch_logger = logging.getLogger("Touch")
+render_logger = logging.getLogger("Render")
+
 class InputBox(ctk.CTkToplevel):
     def __init__(self, parent, x, y, callback, continuous_mode=False, config_manager=None):
         super().__init__(parent)
@@ -141,6 +171,9 @@ class DesktopPetApp:
     def __init__(self, root):
         self.root = root
         self.cm = ConfigManager()
+        log_config = self.cm.get("logging") or {}
+        apply_log_levels(log_config.get("levels"))
+        apply_log_rotation(log_config.get("max_bytes"), log_config.get("backup_count"))
         self.ai_client = AIClient(self.cm)
         
         # 窗口基本设置
@@ -150,10 +183,9 @@ class DesktopPetApp:
         self.root.config(bg=TRANSPARENT_COLOR)
         
         # 屏幕适配与初始位置
-        screen_width = self.root.winfo_screenwidth()
-        screen_height = self.root.winfo_screenheight()
-        # 加宽窗口，给气泡留足够的左侧空间
-        self.root.geometry(f"600x500+{screen_width-650}+{screen_height-600}")
+        # 加宽窗口，给气泡留足够的左侧空间；恢复上次拖动到的位置
+        self.root.geometry("600x500+{}+{}".format(*self._initial_window_position()))
+        self._drag = None  # 最近一次拖动窗口的状态，见 start_move
         
         # 状态变量
         self.timer_running = True
@@ -174,15 +206,40 @@ class DesktopPetApp:
         # 气泡图片引用（防止被垃圾回收）
         self.bubble_photo = None
         
+        # 气泡字体缓存 {字号: 字体}，外观设置变化时清空
+        self._font_cache = {}
+        
         # 表情系统
-        self.expressions = {}  # 存储所有表情立绘
+        self.expressions = ExpressionCache(0)  # 已加载的表情立绘（LRU，内存上限见 sprite_cache）
         self.current_expression = "default"  # 当前表情
         self.expression_restore_timer = None  # 表情恢复定时器
+        self.sprite_loader = SpriteLoader()  # 后台解码表情立绘
+        self._hit_masks = weakref.WeakKeyDictionary()  # {立绘: 不透明像素位图}，立绘释放时位图随之释放
+        self._touch_index = None  # 触摸区域的网格索引（见 _rebuild_touch_index）
+        
+        # 所有动画（表情过渡、呼吸、气泡弹出、退出淡出）由同一个调度器按帧驱动
+        self.animator = Animator(self.root, (self.cm.get("animation") or {}).get("fps", 30))
+        self.bubble_renderer = BubbleRenderer()  # 气泡边框和渲染结果的缓存
+        self._breath_offset = 0  # 呼吸动画当前让立绘偏移的像素
+        self._bubble_image = None  # 当前气泡的 PIL 图片和位置，收起动画使用
+        self._bubble_pos = None
+        self._bubble_text = ""  # 当前气泡的文字和页码（文字超过最大高度时分页显示）
+        self._bubble_page = 0
+        self._bubble_pages = 1
+        self._bubble_page_ms = 0
+        self._pending_sprites = {}  # 正在后台解码的表情 {表情标签: 文件名}
+        cache_config = self.cm.get("sprite_cache") or {}
+        self.residency = ResidentCharacters(cache_config.get("resident_characters", 2),
+                                            int(cache_config.get("resident_mb", 64) * 1024 * 1024))  # 最近用过的其他角色的立绘和字体
         
         # AI请求锁定状态
         self.is_waiting_ai_response = False
         self.ai_lock = threading.Lock()
         
+        # 诊断工具
+        self.profiler = ProcessProfiler()
+        self.memory_reporter = MemoryReporter()
+        
         # 加载资源
         self.load_assets()
         
@@ -199,6 +256,16 @@ class DesktopPetApp:
         self.schedule_all_reminders()
         self.check_schedule()
         
+        # 配置变化时只更新受影响的部分
+        self._subscribe_config_changes()
+        
+        # 主线程卡顿监测
+        self.watchdog = None
+        diag_config = self.cm.get("diagnostics") or {}
+        if diag_config.get("stall_watchdog", True):
+            self.watchdog = StallWatchdog(self.root, threshold_ms=diag_config.get("stall_threshold_ms", 250))
+            self.watchdog.start()
+        
         # 初始打招呼
         self.show_bubble("连接中...", duration=0)
         threading.Thread(target=self._async_ai_welcome, daemon=True).start()
@@ -206,84 +273,186 @@ class DesktopPetApp:
         # 检查每日早报
         self.root.after(5000, self.check_daily_briefing)
 
-    def load_assets(self):
-        """加载默认立绘和所有表情立绘"""
+    def load_assets(self, tags=None, prepared=None, resident=None):
+        """加载默认立绘，并在后台预先加载常用表情
+        
+        默认立绘在当前线程同步加载以便立即显示；其余表情在第一次使用时才加载，
+        近期 AI 回复中最常用的几个表情会提前在后台加载并常驻缓存。
+        tags 给出时只重新加载这些表情（"default" 表示默认立绘），并移除已删除的表情。
+        prepared 为 _prepare_character 在后台准备好的资源（切换角色时），直接使用其中已解码的立绘；
+        resident 为切回常驻角色时取出的资源（见 _park_current_character），整体复用不再加载。
+        """
         # 获取当前角色
         current_char = self.cm.get_current_character()
         if not current_char:
             logging.error("No current character found!")
             return
         
-        # 获取表情配置
-        expressions_config = self.cm.get("expressions") or {}
+        snap = self.cm.snapshot()
+        plan = self._sprite_plan(snap)
+        mappings = plan["mappings"]
+        if prepared and prepared.get("character_id") != snap.character_id:
+            prepared = None
+        
+        if tags is None:
+            # 整体重新加载（启动、切换角色）：放下旧角色的立绘（可能已常驻）并作废未完成的解码
+            self._rebuild_touch_index(snap)
+            self.sprite_loader.cancel()
+            self._pending_sprites = {}
+            if resident is not None:
+                self.expressions = resident["expressions"]
+                self.expressions.budget_bytes = plan["budget_bytes"]
+                self.photo = resident["photo"]
+                logging.info(f"Reused resident sprites of {snap.character_id}: "
+                             f"{len(self.expressions)} sprites, {self.expressions.total_bytes // 1024} KB")
+                return
+            self.expressions = ExpressionCache(plan["budget_bytes"])
+            prewarm = plan["prewarm"]
+            self.expressions.pinned = {"default"} | set(prewarm)
+            reload_tags = set(prewarm)
+            if prewarm:
+                logging.info(f"Prewarming expressions: {prewarm}")
+        else:
+            # 缓存中已有或正在加载的表情需要重新加载，其余的等下次使用时再加载
+            reload_tags = set()
+            for emotion_tag in tags:
+                if emotion_tag == "default":
+                    continue
+                loaded = self.expressions.pop(emotion_tag) is not None
+                if emotion_tag not in mappings:
+                    self.expressions.pinned.discard(emotion_tag)
+                    self._pending_sprites.pop(emotion_tag, None)
+                elif loaded or emotion_tag in self._pending_sprites or emotion_tag == self.current_expression:
+                    reload_tags.add(emotion_tag)
+            # 新批次会作废旧批次，仍在解码的其他表情需要一起重新提交
+            reload_tags.update(self._pending_sprites)
         
         # 获取默认立绘：优先使用 expressions.default，否则使用 avatar
+        if tags is None or "default" in tags:
+            if prepared:
+                self.photo = self._to_photo(prepared["images"].get("default"), plan["default"],
+                                            prepared["masks"].get("default"))
+            else:
+                self.photo = self._load_single_image(plan["default"])
+            self.expressions.put("default", self.photo)
+        
+        # 后台已解码好的常用表情直接放入缓存
+        if prepared:
+            for tag in list(reload_tags):
+                image = prepared["images"].get(tag)
+                if image is not None and mappings.get(tag) == prepared["files"].get(tag):
+                    self.expressions.put(tag, self._to_photo(image, mappings[tag], prepared["masks"].get(tag)))
+                    reload_tags.discard(tag)
+        
+        self._pending_sprites = {tag: mappings[tag] for tag in reload_tags if tag in mappings}
+        if self._pending_sprites or tags is None:
+            self.sprite_loader.load(self._pending_sprites, self._on_sprite_decoded)
+    
+    def _sprite_plan(self, snap):
+        """根据配置快照确定角色的默认立绘、表情映射和需要预先加载的常用表情"""
+        expressions_config = snap.get("expressions") or {}
         default_img = expressions_config.get("default", "")
         if not default_img:
-            default_img = current_char.get("avatar", "character.png")
+            default_img = snap.get("avatar", "character.png")
             logging.info(f"No expressions.default, using avatar: {default_img}")
-        self.photo = self._load_single_image(default_img)
-        self.expressions["default"] = self.photo
-        
-        # 加载所有表情立绘
         mappings = expressions_config.get("mappings", {})
-        for emotion_tag, filename in mappings.items():
-            img = self._load_single_image(filename)
-            if img:
-                self.expressions[emotion_tag] = img
-                logging.info(f"Loaded expression: {emotion_tag} -> {filename}")
-            else:
-                logging.warning(f"Failed to load expression: {emotion_tag} -> {filename}")
+        cache_config = snap.get("sprite_cache") or {}
+        history = self.cm.get_chat_history(limit=cache_config.get("history_messages", 50), char_id=snap.character_id)
+        return {
+            "default": default_img,
+            "mappings": mappings,
+            "prewarm": likely_expressions(history, mappings, cache_config.get("prewarm", 3)),
+            "budget_bytes": int(cache_config.get("max_mb", 48) * 1024 * 1024)
+        }
     
-    def _load_single_image(self, filename):
-        """加载单个立绘图片
+    def _resident_fingerprint(self, snap):
+        """常驻资源依赖的角色配置，变化后常驻的立绘和字体失效"""
+        return (snap.get("expressions"), snap.get("avatar"), snap.get("appearance"))
+    
+    def _park_current_character(self):
+        """切换角色前把当前角色已加载的立绘和字体放入常驻缓存"""
+        snap = self.cm.snapshot()
+        if not snap.character_id:
+            return
+        resources = {"expressions": self.expressions, "photo": self.photo, "fonts": self._font_cache}
+        evicted = self.residency.park(snap.character_id, self._resident_fingerprint(snap),
+                                      resources, self.expressions.total_bytes)
+        for char_id in evicted:
+            drop_lore_index(char_id)
+        logging.info(f"Parked character {snap.character_id} "
+                     f"(resident: {self.residency.total_bytes // 1024} KB, evicted {evicted})")
+    
+    def _prepare_character(self, snap):
+        """在后台线程中准备切换目标角色的资源：默认立绘和常用表情（只解码，不创建 PhotoImage）、
+        气泡字体、世界书索引"""
+        start = time.perf_counter()
+        plan = self._sprite_plan(snap)
+        files = {tag: plan["mappings"][tag] for tag in plan["prewarm"]}
+        files["default"] = plan["default"]
+        images = {tag: decode_sprite(filename) for tag, filename in files.items()}
+        masks = {tag: sprite_mask(image) for tag, image in images.items()}
+        appearance = snap.get("appearance") or {}
+        fonts = {size: self._create_font(size, appearance) for size in list(self._font_cache)}
+        get_lore_index(snap.character_id, snap.get("lorebook") or ())
+        logging.info(f"Prepared character {snap.character_id}: {len(images)} sprites, {len(fonts)} fonts "
+                     f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return {"character_id": snap.character_id, "files": files, "images": images, "masks": masks, "fonts": fonts}
+    
+    def _has_expression(self, tag):
+        """当前角色是否有该表情（不论是否已加载）"""
+        return tag == "default" or tag in (self.cm.get("expressions") or {}).get("mappings", {})
+    
+    def _request_sprite(self, tag):
+        """在后台加载尚未缓存的表情"""
+        if tag in self._pending_sprites:
+            return
+        filename = (self.cm.get("expressions") or {}).get("mappings", {}).get(tag)
+        if not filename:
+            return
+        self._pending_sprites[tag] = filename
+        self.sprite_loader.submit(tag, filename, self._on_sprite_decoded)
+    
+    def _on_sprite_decoded(self, generation, tag, image):
+        """后台线程解码完成（在工作线程中调用），顺便生成触摸检测用的不透明像素位图"""
+        self.root.after(0, self._install_sprite, generation, tag, image, sprite_mask(image))
+    
+    def _install_sprite(self, generation, tag, image, mask=None):
+        """在主线程中把解码好的立绘转为 PhotoImage 放入缓存"""
+        if generation != self.sprite_loader.generation or tag not in self._pending_sprites:
+            return
+        filename = self._pending_sprites.pop(tag)
+        if image is None:
+            logging.warning(f"Failed to load expression: {tag} -> {filename}")
+            return
+        sprite = self._to_photo(image, filename, mask)
+        if sprite is None:
+            return
+        self.expressions.put(tag, sprite)
+        logging.info(f"Loaded expression: {tag} -> {filename} "
+                     f"(cache {len(self.expressions)} sprites, {self.expressions.total_bytes // 1024} KB)")
         
-        重要说明：
-        - tkinter使用-transparentcolor技术实现透明窗口
-        - 该技术将亮粉色(#ff00ff)像素视为透明
-        - PNG边缘的半透明像素会与粉色背景混合，产生粉色边缘
-        - 解决方案：对alpha通道进行二值化处理（牺牲抗锯齿，换取无粉边）
+        # 该表情在加载完成前已被请求（暂时显示默认立绘），现在换上
+        if tag == self.current_expression:
+            self.set_expression(tag)
+    
+    def _load_single_image(self, filename):
+        """同步加载单个立绘图片（预处理见 sprites.decode_sprite）"""
+        return self._to_photo(decode_sprite(filename), filename)
+    
+    def _to_photo(self, frames, filename, mask=None):
+        """把解码好的立绘转为 PhotoImage，动图转为 SpriteFrames（只能在 Tk 主线程中调用）
         
-        最佳实践：
-        - 在Photoshop中预处理PNG，去除半透明像素（参见PNG处理指南.md）
-        - 这样可以获得最佳显示效果
+        同时登记立绘的不透明像素位图（mask 未提供时在这里生成），触摸检测时忽略透明像素。
         """
-        # 优先使用当前目录的自定义立绘，否则使用打包的默认立绘
-        img_path = filename
-        if not os.path.exists(img_path):
-            img_path = resource_path(filename)
-        
-        if not os.path.exists(img_path):
+        if not frames:
             return None
-            
         try:
-            pil_image = PILImage.open(img_path)
-            
-            # 确保图像为RGBA模式（支持透明度）
-            if pil_image.mode != 'RGBA':
-                pil_image = pil_image.convert('RGBA')
-            
-            # 缩放处理 - 使用高质量的LANCZOS算法
-            if pil_image.height > 400:
-                ratio = 400 / pil_image.height
-                new_width = int(pil_image.width * ratio)
-                pil_image = pil_image.resize((new_width, 400), PILImage.Resampling.LANCZOS)
-            
-            # 处理Alpha通道 - 移除半透明像素以避免粉色边缘
-            # 这是tkinter透明窗口的必要处理
-            if pil_image.mode == 'RGBA':
-                r, g, b, a = pil_image.split()
-                
-                # 二值化Alpha通道：移除所有半透明像素
-                # alpha > 200: 保持不透明
-                # alpha <= 200: 变为完全透明
-                # 阈值200而不是128可以保留更多边缘细节
-                a = a.point(lambda x: 255 if x > 200 else 0)
-                
-                # 应用处理后的Alpha通道
-                pil_image.putalpha(a)
-            
-            return ImageTk.PhotoImage(pil_image)
+            if len(frames) == 1:
+                sprite = ImageTk.PhotoImage(frames[0][0])
+            else:
+                sprite = SpriteFrames([(ImageTk.PhotoImage(image), duration) for image, duration in frames])
+            self._hit_masks[sprite] = mask or sprite_mask(frames)
+            return sprite
         except Exception as e:
             logging.error(f"Error loading image {filename}: {e}")
             return None
@@ -313,9 +482,17 @@ class DesktopPetApp:
                 # 最后的备选方案：创建一个色块
                 image = PILImage.new('RGB', (64, 64), color='skyblue')
         
+        # 诊断工具子菜单（默认隐藏，在设置-诊断中开启）
+        diagnostics_menu = pystray.Menu(
+            pystray.MenuItem(lambda item: "停止性能分析" if self.profiler.running else "开始性能分析", self.toggle_profiler),
+            pystray.MenuItem("内存快照", self.take_memory_snapshot),
+            pystray.MenuItem("导出线程堆栈", self.export_thread_stacks)
+        )
+        
         # 创建菜单
         menu = pystray.Menu(
             pystray.MenuItem("显示/隐藏", self.toggle_visibility),
+            pystray.MenuItem("诊断", diagnostics_menu, visible=lambda item: (self.cm.get("diagnostics") or {}).get("tray_menu", False)),
             pystray.MenuItem("退出", self.force_quit)
         )
         
@@ -324,70 +501,230 @@ class DesktopPetApp:
         threading.Thread(target=self.tray_icon.run, daemon=True).start()
 
     def toggle_visibility(self, icon, item):
-        if self.root.winfo_viewable():
-            self.root.withdraw()
-        else:
-            self.root.deiconify()
+        # 托盘回调运行在托盘线程，转到主线程；窗口隐藏期间暂停所有动画和卡顿监测
+        def toggle():
+            if self.root.winfo_viewable():
+                self.root.withdraw()
+                self.animator.suspend()
+                if self.watchdog:
+                    self.watchdog.suspend()
+            else:
+                self.root.deiconify()
+                self.animator.resume()
+                if self.watchdog:
+                    self.watchdog.resume()
+        self.root.after(0, toggle)
+
+    # --- 托盘诊断工具（托盘回调运行在托盘线程，涉及 Tk 的操作都转到主线程） ---
+    def toggle_profiler(self, icon, item):
+        def toggle():
+            if self.profiler.running:
+                path = self.profiler.stop()
+                self.show_bubble(f"性能分析已保存：{path}", duration=8000)
+            else:
+                self.profiler.start()
+                self.show_bubble("性能分析已开始，复现卡顿后从托盘菜单停止。", duration=5000)
+            icon.update_menu()
+        self.root.after(0, toggle)
+
+    def take_memory_snapshot(self, icon, item):
+        def collect():
+            app_usage = self._estimate_memory_usage()
+            threading.Thread(target=lambda: self._write_memory_report(app_usage), daemon=True).start()
+        self.root.after(0, collect)
+
+    def _write_memory_report(self, app_usage):
+        try:
+            path = self.memory_reporter.write_report(app_usage)
+            self.root.after(0, lambda: self.show_bubble(f"内存快照已保存：{path}", duration=8000))
+        except Exception as e:
+            logging.error(f"Failed to write memory report: {e}")
+
+    def _estimate_memory_usage(self):
+        """估算 Tk 图片与配置占用的内存（这些不在 tracemalloc 统计范围内）"""
+        usage = []
+        seen = set()
+        for tag, photo in self.expressions.items():
+            if photo is None or id(photo) in seen:
+                continue
+            seen.add(id(photo))
+            usage.append((f"立绘 [{tag}] {photo.width()}x{photo.height()}", photo.width() * photo.height() * 4))
+        if self.residency.total_bytes:
+            usage.append(("常驻的其他角色立绘", self.residency.total_bytes))
+        if self.bubble_renderer.total_bytes:
+            usage.append(("气泡缓存", self.bubble_renderer.total_bytes))
+        if self.bubble_photo:
+            usage.append((f"气泡图片 {self.bubble_photo.width()}x{self.bubble_photo.height()}", self.bubble_photo.width() * self.bubble_photo.height() * 4))
+        try:
+            global_config = {k: v for k, v in self.cm.config.items() if k != "characters"}
+            usage.append(("全局配置 (JSON 序列化大小)", len(json.dumps(global_config, ensure_ascii=False).encode('utf-8'))))
+            for char_id, char_config in self.cm.config["characters"].loaded_items():
+                usage.append((f"角色配置 {char_id} (JSON 序列化大小)", len(json.dumps(char_config, ensure_ascii=False).encode('utf-8'))))
+        except Exception as e:
+            logging.error(f"Failed to measure config size: {e}")
+        return usage
+
+    def export_thread_stacks(self, icon, item):
+        try:
+            path = dump_thread_stacks()
+            self.root.after(0, lambda: self.show_bubble(f"线程堆栈已保存：{path}", duration=8000))
+        except Exception as e:
+            logging.error(f"Failed to dump thread stacks: {e}")
 
     def force_quit(self, icon, item):
         # 保存退出时间
         self.save_exit_time()
+        self.sprite_loader.shutdown()
         self.tray_icon.stop()
         self.root.quit()
         sys.exit()
 
-    def setup_ui(self):
-        # 先恢复窗口到默认高度和位置，避免立绘被裁剪
+    def _initial_window_position(self):
+        """上次保存的窗口位置（限制在屏幕范围内），没有时为屏幕右下角"""
         screen_width = self.root.winfo_screenwidth()
         screen_height = self.root.winfo_screenheight()
-        default_x = screen_width - 650
-        default_y = screen_height - 600
-        self.root.geometry(f"600x500+{default_x}+{default_y}")
+        position = self.cm.get("window_position") or {}
+        try:
+            x = min(max(int(position["x"]), 0), max(screen_width - 600, 0))
+            y = min(max(int(position["y"]), 0), max(screen_height - 500, 0))
+            return x, y
+        except (KeyError, TypeError, ValueError):
+            return screen_width - 650, screen_height - 600
+    
+    def setup_ui(self):
+        # 先恢复窗口到默认高度和保存的位置，避免立绘被裁剪
+        self.root.geometry("600x500+{}+{}".format(*self._initial_window_position()))
         
-        if hasattr(self, 'canvas'):
-            self.canvas.destroy()
-            
-        self.canvas = tk.Canvas(self.root, width=600, height=500, 
-                                bg=TRANSPARENT_COLOR, highlightthickness=0)
-        self.canvas.pack(fill=tk.BOTH, expand=True)
+        # 画布只创建一次，之后立绘和气泡都在原有图元上更新
+        if not hasattr(self, 'canvas'):
+            self.canvas = tk.Canvas(self.root, width=600, height=500, 
+                                    bg=TRANSPARENT_COLOR, highlightthickness=0)
+            self.canvas.pack(fill=tk.BOTH, expand=True)
+            self.scene = CanvasScene(self.canvas)
+        
+        # 窗口已恢复默认高度，旧气泡不再适用
+        self._hide_bubble()
+        self.canvas.delete("placeholder")
+        self._stop_breathing()
         
         # 使用当前表情的立绘
-        current_photo = self.expressions.get(self.current_expression, self.photo)
+        shown_tag = self.current_expression if self.current_expression in self.expressions else "default"
+        current_photo = self.expressions.get(shown_tag, self.photo)
+        self.expressions.set_active(shown_tag)
         
         if current_photo:
             # 立绘往右移，给左侧气泡留足够空间
-            self.canvas.create_image(370, 480, image=current_photo, anchor=tk.S, tags="character")
+            self._display_sprite(current_photo, 370, 480)
+            self._start_breathing()
         else:
             # 缺省立绘也要对应右移
-            self.canvas.create_oval(270, 250, 470, 450, fill="#FFB6C1", outline="white", width=3, tags="character")
-            self.canvas.create_text(370, 350, text="立绘缺失\n请放入\ncharacter.png", fill="white", justify=tk.CENTER, font=("微软雅黑", 12, "bold"))
+            self.animator.stop("sprite_frames")
+            self.scene.remove("character")
+            self.canvas.create_oval(270, 250, 470, 450, fill="#FFB6C1", outline="white", width=3, tags=("character", "placeholder"))
+            self.canvas.create_text(370, 350, text="立绘缺失\n请放入\ncharacter.png", fill="white", justify=tk.CENTER, font=("微软雅黑", 12, "bold"), tags="placeholder")
     
     def set_expression(self, emotion_tag):
-        """切换表情"""
-        if emotion_tag in self.expressions:
+        """切换表情（表情尚未加载时先显示默认立绘，后台加载完成后自动换上）"""
+        if self._has_expression(emotion_tag):
             self.current_expression = emotion_tag
             
             # 获取当前立绘的位置（如果存在）
-            char_x, char_y = 370, 480  # 默认位置
-            try:
-                items = self.canvas.find_withtag("character")
-                if items:
-                    # 获取第一个 character 项的坐标
-                    coords = self.canvas.coords(items[0])
-                    if coords:
-                        char_x, char_y = coords[0], coords[1]
-            except Exception as e:
-                logging.error(f"Error getting character position: {e}")
-            
-            # 更新画布上的立绘
-            self.canvas.delete("character")
-            current_photo = self.expressions[emotion_tag]
+            char_x, char_y = self.scene.coords("character") or (370, 480)  # 默认位置
+            
+            # 原地更换画布上的立绘
+            shown_tag = emotion_tag if emotion_tag in self.expressions else "default"
+            current_photo = self.expressions.get(shown_tag, self.photo)
+            if shown_tag != emotion_tag:
+                self._request_sprite(emotion_tag)
+                logging.info(f"Expression {emotion_tag} still loading, showing default")
+            self.expressions.set_active(shown_tag)
             if current_photo:
-                self.canvas.create_image(char_x, char_y, image=current_photo, anchor=tk.S, tags="character")
+                self.canvas.delete("placeholder")
+                self._display_sprite(current_photo, char_x, char_y, crossfade=True)
             logging.info(f"Expression changed to: {emotion_tag}")
         else:
             logging.warning(f"Expression not found: {emotion_tag}")
     
+    def _animation_settings(self):
+        settings = self.cm.get("animation") or {}
+        return settings if settings.get("enabled", True) else {}
+    
+    def _display_sprite(self, sprite, x, y, crossfade=False):
+        """在画布上显示立绘（PhotoImage 或动图 SpriteFrames），crossfade 时从当前立绘渐变过去"""
+        self.animator.stop("sprite_frames")
+        frames = getattr(sprite, "frames", None)
+        photo = frames[0][0] if frames else sprite
+        old_photo = self.scene.current_image("character")
+        crossfade_ms = self._animation_settings().get("crossfade_ms", 0)
+        if crossfade and crossfade_ms and not frames and old_photo is not None and old_photo is not photo:
+            self._crossfade_sprite(old_photo, photo, crossfade_ms)
+        else:
+            self.animator.stop("crossfade")
+            self.scene.image("character", x, y, photo, anchor=tk.S, tags=("character",))
+        if frames:
+            self._play_sprite_frames(frames)
+    
+    def _crossfade_sprite(self, old_photo, new_photo, duration_ms):
+        """两张立绘之间的渐变（按底部居中对齐混合，每帧重新二值化 alpha 以免出现粉边）"""
+        try:
+            old_img = ImageTk.getimage(old_photo)
+            new_img = ImageTk.getimage(new_photo)
+        except Exception as e:
+            render_logger.debug(f"Crossfade unavailable: {e}")
+            self.animator.stop("crossfade")
+            self.scene.set_image("character", new_photo)
+            return
+        
+        size = (max(old_img.width, new_img.width), max(old_img.height, new_img.height))
+        def pad(img):
+            padded = PILImage.new("RGBA", size, (0, 0, 0, 0))
+            padded.paste(img, ((size[0] - img.width) // 2, size[1] - img.height))
+            return padded
+        old_img, new_img = pad(old_img), pad(new_img)
+        
+        def step(p):
+            if p >= 1.0:
+                self.scene.set_image("character", new_photo)
+                return
+            blended = binarize_alpha(PILImage.blend(old_img, new_img, p), threshold=127)
+            self.scene.set_image("character", ImageTk.PhotoImage(blended))
+        self.animator.animate("crossfade", step, duration_ms)
+    
+    def _play_sprite_frames(self, frames):
+        """循环播放动图立绘的各帧"""
+        index = [0]
+        def step(elapsed):
+            index[0] = (index[0] + 1) % len(frames)
+            photo, duration = frames[index[0]]
+            self.scene.set_image("character", photo)
+            return duration or 100
+        self.animator.loop("sprite_frames", step, frames[0][1] or 100)
+    
+    def _start_breathing(self):
+        """空闲时立绘轻微上下浮动（只在偏移的整数像素变化时移动图元）"""
+        settings = self._animation_settings()
+        if not settings or not settings.get("breathing", True):
+            # 动画关闭时不保留任何循环，空闲时不唤醒 Tk
+            self._stop_breathing()
+            return
+        if self.animator.running("breathing"):
+            return
+        self._breath_offset = 0
+        def step(elapsed):
+            new_offset = round(BREATH_AMPLITUDE * math.sin(2 * math.pi * elapsed / BREATH_PERIOD_MS))
+            if new_offset != self._breath_offset:
+                self.scene.move("character", 0, new_offset - self._breath_offset)
+                self._breath_offset = new_offset
+            return BREATH_INTERVAL_MS
+        self.animator.loop("breathing", step, BREATH_INTERVAL_MS)
+    
+    def _stop_breathing(self):
+        """停止呼吸动画，并把立绘移回原位（否则每次重新开始都会累积偏移）"""
+        self.animator.stop("breathing")
+        if self._breath_offset:
+            self.scene.move("character", 0, -self._breath_offset)
+            self._breath_offset = 0
+    
     def restore_default_expression(self):
         """恢复默认表情"""
         if self.current_expression != "default":
@@ -410,27 +747,35 @@ class DesktopPetApp:
         return cleaned_text, emotion
 
     def _load_font(self, size=12):
-        """加载字体（支持系统字体和自定义字体文件）"""
+        """加载字体（支持系统字体和自定义字体文件），按字号缓存"""
+        font = self._font_cache.get(size)
+        if font is None:
+            font = self._font_cache[size] = self._create_font(size)
+        return font
+
+    def _create_font(self, size, appearance=None):
+        """按外观设置加载字体（支持系统字体和自定义字体文件），appearance 默认为当前角色的外观设置"""
         # 获取字体配置
-        appearance = self.cm.get("appearance") or {}
+        if appearance is None:
+            appearance = self.cm.get("appearance") or {}
         bubble_style = appearance.get("bubble", {})
         
         font_type = bubble_style.get("font_type", "custom")  # "system" 或 "custom"
         font_name = bubble_style.get("font_name", "Microsoft YaHei UI")
         font_file = bubble_style.get("font_file", "")
         
-        logging.info(f"加载字体 - 类型: {font_type}, 名称: {font_name}, 文件: {font_file}")
+        render_logger.debug(f"加载字体 - 类型: {font_type}, 名称: {font_name}, 文件: {font_file}")
         
         # 1. 如果是自定义字体文件
         if font_type == "custom" and font_file:
             # 规范化路径（处理正斜杠和反斜杠）
             font_file_normalized = os.path.normpath(font_file)
-            logging.info(f"尝试加载自定义字体文件: {font_file_normalized}")
+            render_logger.debug(f"尝试加载自定义字体文件: {font_file_normalized}")
             
             if os.path.exists(font_file_normalized):
                 try:
                     font = ImageFont.truetype(font_file_normalized, size)
-                    logging.info(f"✓ 成功加载自定义字体: {font_file_normalized}")
+                    render_logger.debug(f"✓ 成功加载自定义字体: {font_file_normalized}")
                     return font
                 except Exception as e:
                     logging.error(f"✗ 无法加载自定义字体文件 {font_file_normalized}: {e}")
@@ -442,7 +787,7 @@ class DesktopPetApp:
                     if os.path.exists(relative_path):
                         try:
                             font = ImageFont.truetype(relative_path, size)
-                            logging.info(f"✓ 使用相对路径加载字体: {relative_path}")
+                            render_logger.debug(f"✓ 使用相对路径加载字体: {relative_path}")
                             return font
                         except Exception as e:
                             logging.error(f"✗ 相对路径也失败: {e}")
@@ -495,14 +840,6 @@ class DesktopPetApp:
         except:
             return ImageFont.load_default()
     
-    def _hex_to_rgb(self, hex_color):
-        """将hex颜色转换为RGB元组"""
-        hex_color = hex_color.lstrip('#')
-        try:
-            return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-        except:
-            return (255, 255, 255)  # 默认白色
-    
     def adjust_window_height(self, required_height):
         """动态调整窗口高度以适应内容，保持立绘在屏幕上的位置视觉不变"""
         target_height = int(max(500, required_height))
@@ -517,14 +854,22 @@ class DesktopPetApp:
         diff = target_height - current_height
         
         # 1. 调整窗口 Geometry (向上生长)
-        x = self.root.winfo_x()
-        y = self.root.winfo_y()
+        drag = self._drag
+        if drag is not None and drag["active"]:
+            # 拖动中窗口的实际位置可能还没更新，使用拖动记录的位置，之后的拖动目标同样上移
+            x, y = drag["applied"]
+            for key in ("origin", "target", "applied"):
+                drag[key] = (drag[key][0], drag[key][1] - diff)
+        else:
+            x = self.root.winfo_x()
+            y = self.root.winfo_y()
         new_y = y - diff
         
         self.root.geometry(f"600x{target_height}+{x}+{new_y}")
         
         # 2. 移动立绘 (向下移动以抵消窗口上移，保持屏幕位置不变)
-        self.canvas.move("character", 0, diff)
+        self.scene.move("character", 0, diff)
+        self.canvas.move("placeholder", 0, diff)
         
         self.root.update_idletasks()
         
@@ -532,17 +877,17 @@ class DesktopPetApp:
         """恢复窗口默认高度"""
         self.adjust_window_height(500)
 
-    def create_bubble(self, text):
-        """绘制气泡（无尾巴、纯绘制，避免边框变粗和重叠）"""
-        logging.info(f"create_bubble called with text: {text[:50] if text else 'EMPTY'}...")
+    def create_bubble(self, text, page=0):
+        """绘制气泡（无尾巴、纯绘制，避免边框变粗和重叠），文字过长时只显示第 page 页"""
+        render_logger.debug(f"create_bubble called with text: {text[:50] if text else 'EMPTY'}...")
         
-        self.canvas.delete("bubble_image")
         if not text:
-            logging.info("create_bubble: text is empty, restoring window height")
+            self._hide_bubble()
+            render_logger.debug("create_bubble: text is empty, restoring window height")
             self.restore_window_height()
             return
         
-        logging.info(f"create_bubble: proceeding to draw bubble with text length: {len(text)}")
+        render_logger.debug(f"create_bubble: proceeding to draw bubble with text length: {len(text)}")
 
         # ========== 获取立绘当前位置 (动态) ==========
         char_bottom_y = 480 # 默认值
@@ -551,7 +896,8 @@ class DesktopPetApp:
         char_left_edge = 270 # Default fallback
         
         try:
-            # 查找 tag 为 character 的项
+            # 查找 tag 为 character 的项（先提交本帧尚未应用的立绘修改）
+            self.scene.flush()
             items = self.canvas.find_withtag("character")
             if items:
                 # 找最底部的边界
@@ -582,25 +928,8 @@ class DesktopPetApp:
 
         # ========== 配置 - 从config读取 ==========
         appearance = self.cm.get("appearance") or {}
-        bubble_style = appearance.get("bubble", {})
-        
-        font_size = bubble_style.get("font_size", 14)
-        pil_font = self._load_font(font_size)
-        ascent, descent = pil_font.getmetrics()
-        
-        # 行高：增大防止截断
-        line_height = ascent + descent + 10
-        
-        # 内边距
-        padding_x = bubble_style.get("padding_x", 30)
-        padding_y = bubble_style.get("padding_y", 28)
-        
-        # 颜色 - 将hex转为RGB元组
-        border_color = self._hex_to_rgb(bubble_style.get("border_color", "#646464"))
-        fill_color = self._hex_to_rgb(bubble_style.get("background_color", "#FFFFFF"))
-        text_color = self._hex_to_rgb(bubble_style.get("text_color", "#323232"))
-        corner_radius = bubble_style.get("corner_radius", 14)
-        border_width = bubble_style.get("border_width", 1)
+        style = BubbleStyle(appearance.get("bubble", {}))
+        pil_font = self._load_font(style.font_size)
 
         # ========== 可用空间计算 ==========
         # 气泡在立绘左侧，预留 10px 间隙
@@ -612,39 +941,16 @@ class DesktopPetApp:
         # 用户要求不要限制长度，但为了换行，我们需要一个宽度基准
         # 这里的 max_text_width 主要是决定何时换行
         # 我们可以稍微放宽，但不能太宽导致覆盖立绘
-        max_text_width = available_space - padding_x * 2
+        max_text_width = available_space - style.padding_x * 2
         max_text_width = max(max_text_width, 160) 
-        max_text_width = min(max_text_width, 400) # 稍微放宽到 400
+        max_text_width = int(min(max_text_width, 400)) # 稍微放宽到 400
 
-        # ========== 文本换行与尺寸计算 ==========
-        temp_img = PILImage.new('RGBA', (1, 1))
-        temp_draw = ImageDraw.Draw(temp_img)
-
-        lines = []
-        current = ""
-        for ch in text:
-            test = current + ch
-            w = temp_draw.textbbox((0, 0), test, font=pil_font)[2]
-            if ch == '\n':
-                lines.append(current)
-                current = ""
-            elif w > max_text_width and current:
-                lines.append(current)
-                current = ch
-            else:
-                current = test
-        if current:
-            lines.append(current)
-
-        text_w = max(temp_draw.textbbox((0, 0), line, font=pil_font)[2] for line in lines) if lines else 0
-        text_h = len(lines) * line_height
-
-        # ========== 气泡尺寸 ==========
-        bubble_w = int(text_w + padding_x * 2)
-        bubble_h = int(text_h + padding_y * 2)
-        
-        bubble_w = max(bubble_w, 180)
-        bubble_h = max(bubble_h, 100)
+        # ========== 换行、绘制（相同文字和外观的气泡直接取缓存） ==========
+        bubble, pages = self.bubble_renderer.render(text, style, pil_font, max_text_width, page)
+        bubble_w, bubble_h = bubble.size
+        self._bubble_text = text
+        self._bubble_page = min(page, pages - 1)
+        self._bubble_pages = pages
 
         # ========== 动态调整窗口高度 ==========
         # 使用绝对高度公式计算
@@ -676,34 +982,23 @@ class DesktopPetApp:
         if canvas_x < 5:
             canvas_x = 5
         
-        # ========== 绘制气泡 ==========
-        # 使用RGBA模式，支持透明背景
-        bubble_img = PILImage.new('RGBA', (bubble_w, bubble_h), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(bubble_img)
-
-        # 背景 - 先画填充，再画边框
-        draw.rounded_rectangle([0, 0, bubble_w - 1, bubble_h - 1],
-                               radius=corner_radius,
-                               fill=fill_color + (255,),  # 添加alpha=255
-                               outline=border_color + (255,),
-                               width=border_width)
-
-        # 文字
-        text_start_y = padding_y + 3 
-        for i, line in enumerate(lines):
-            y = text_start_y + i * line_height
-            draw.text((padding_x, y), line, font=pil_font, fill=text_color + (255,))
-
         # ========== 显示 ==========
-        self.bubble_photo = ImageTk.PhotoImage(bubble_img)
-        self.canvas.create_image(int(canvas_x), int(canvas_y),
-                                 image=self.bubble_photo, anchor=tk.NW, tags="bubble_image")
+        was_visible = self.scene.is_visible("bubble")
+        self.bubble_photo = bubble.photo
+        self._bubble_image = bubble.image
+        self._bubble_pos = (int(canvas_x), int(canvas_y))
+        if was_visible or not self._animation_settings().get("bubble_pop_ms"):
+            self.animator.stop("bubble")
+            self.scene.image("bubble", int(canvas_x), int(canvas_y), self.bubble_photo,
+                             anchor=tk.NW, tags=("bubble_image",))
+        else:
+            self._pop_bubble(appear=True)
         
     def show_bubble(self, text, duration=None):
         # 解析表情标签
         cleaned_text, emotion = self.parse_expression_tags(text)
         
-        logging.info(f"show_bubble called - Original: {text[:50]}... | Cleaned: {cleaned_text[:50] if cleaned_text else 'EMPTY'}... | Emotion: {emotion}")
+        render_logger.debug(f"show_bubble called - Original: {text[:50]}... | Cleaned: {cleaned_text[:50] if cleaned_text else 'EMPTY'}... | Emotion: {emotion}")
         
         # 如果检测到表情标签，切换表情
         if emotion:
@@ -723,6 +1018,17 @@ class DesktopPetApp:
         
         if self.bubble_timer:
             self.root.after_cancel(self.bubble_timer)
+            self.bubble_timer = None
+        
+        # 分页显示时按每页的阅读时间自动翻页，停在最后一页
+        self.animator.stop("bubble_pages")
+        if self._bubble_pages > 1:
+            per_page_chars = len(cleaned_text) // self._bubble_pages
+            self._bubble_page_ms = min(max(3000 + per_page_chars * 150, 3000), 60000)
+            self.animator.loop("bubble_pages", lambda elapsed: self._turn_bubble_page(1, manual=False),
+                               self._bubble_page_ms)
+            if duration is None:
+                duration = self._bubble_page_ms * self._bubble_pages
             
         # 如果 duration 为 0，表示不自动消失
         if duration == 0:
@@ -743,24 +1049,131 @@ class DesktopPetApp:
         if duration > 0:
             self.bubble_timer = self.root.after(duration, lambda: self.delete_bubble())
 
+    def _pop_bubble(self, appear, on_done=None):
+        """气泡弹出（从 BUBBLE_POP_SCALE 放大到原大小）或收起（反向）的动画
+        
+        缩放使用最近邻插值，alpha 保持二值，不会出现粉边。
+        """
+        bubble_img = self._bubble_image
+        x, y = self._bubble_pos
+        w, h = bubble_img.size
+        def step(p):
+            if p >= 1.0 and appear:
+                self.scene.image("bubble", x, y, self.bubble_photo, anchor=tk.NW, tags=("bubble_image",))
+                return
+            t = p if appear else 1.0 - p
+            scale = BUBBLE_POP_SCALE + (1.0 - BUBBLE_POP_SCALE) * t
+            sw, sh = max(1, int(w * scale)), max(1, int(h * scale))
+            frame = ImageTk.PhotoImage(bubble_img.resize((sw, sh), PILImage.Resampling.NEAREST))
+            self.scene.image("bubble", x + (w - sw) // 2, y + (h - sh) // 2, frame,
+                             anchor=tk.NW, tags=("bubble_image",))
+        self.animator.animate("bubble", step, self._animation_settings().get("bubble_pop_ms", 0), on_done)
+    
+    def _hide_bubble(self):
+        """立即隐藏气泡（停止正在进行的气泡动画和自动翻页）"""
+        self.animator.stop("bubble")
+        self.animator.stop("bubble_pages")
+        self.scene.hide("bubble")
+    
+    def _turn_bubble_page(self, delta, manual=True):
+        """气泡翻页，返回自动翻页的下一次间隔（已到最后一页时返回 None）
+        
+        手动翻页后停止自动翻页，并按剩余页数重新计算气泡消失的时间。
+        """
+        if self._bubble_pages <= 1 or not self.scene.is_visible("bubble"):
+            return None
+        page = min(max(self._bubble_page + delta, 0), self._bubble_pages - 1)
+        if page != self._bubble_page:
+            self.create_bubble(self._bubble_text, page)
+        if manual:
+            self.animator.stop("bubble_pages")
+            if self.bubble_timer:
+                self.root.after_cancel(self.bubble_timer)
+                remaining = self._bubble_pages - self._bubble_page
+                self.bubble_timer = self.root.after(self._bubble_page_ms * remaining, lambda: self.delete_bubble())
+            return None
+        return self._bubble_page_ms if self._bubble_page < self._bubble_pages - 1 else None
+    
+    def _on_bubble_click(self, event):
+        """单击气泡（没有拖动窗口）时翻到下一页"""
+        if self._drag is None or not self._drag["moved"]:
+            self._turn_bubble_page(1)
+    
+    def _on_mouse_wheel(self, event):
+        if self.scene.is_visible("bubble"):
+            self._turn_bubble_page(-1 if event.delta > 0 else 1)
+    
     def delete_bubble(self):
-        self.canvas.delete("bubble_image")
+        self.animator.stop("bubble_pages")
+        if self.scene.is_visible("bubble") and self._bubble_image is not None and self._animation_settings().get("bubble_pop_ms"):
+            def done():
+                self.scene.hide("bubble")
+                self.restore_window_height()
+            self._pop_bubble(appear=False, on_done=done)
+            return
+        self._hide_bubble()
         self.restore_window_height()
 
     def bind_events(self):
         self.canvas.bind("<Button-1>", self.start_move)
         self.canvas.bind("<B1-Motion>", self.do_move)
+        self.canvas.bind("<ButtonRelease-1>", self.end_move)
         self.canvas.bind("<Button-3>", self.show_context_menu)
         self.canvas.bind("<Double-Button-1>", self.on_double_click)
+        self.canvas.bind("<MouseWheel>", self._on_mouse_wheel)
+        self.canvas.tag_bind("bubble_image", "<ButtonRelease-1>", self._on_bubble_click)
 
     def start_move(self, event):
-        self.last_x = event.x
-        self.last_y = event.y
+        """按下时记录窗口和指针的屏幕坐标，拖动过程中不再查询窗口位置"""
+        x, y = self.root.winfo_x(), self.root.winfo_y()
+        self._drag = {
+            "origin": (x, y),
+            "pointer": (event.x_root, event.y_root),
+            "target": (x, y),
+            "applied": (x, y),
+            "moved": False,
+            "active": True
+        }
 
     def do_move(self, event):
-        x = self.root.winfo_x() + (event.x - self.last_x)
-        y = self.root.winfo_y() + (event.y - self.last_y)
-        self.root.geometry(f"+{x}+{y}")
+        """只记录目标位置，由调度器每帧最多移动一次窗口（高回报率鼠标每秒数百个移动事件）"""
+        drag = self._drag
+        if drag is None or not drag["active"]:
+            return
+        dx = event.x_root - drag["pointer"][0]
+        dy = event.y_root - drag["pointer"][1]
+        drag["target"] = (drag["origin"][0] + dx, drag["origin"][1] + dy)
+        if abs(dx) + abs(dy) >= DRAG_THRESHOLD:
+            drag["moved"] = True
+        if not self.animator.running("window_drag"):
+            self.animator.loop("window_drag", lambda elapsed: self._apply_drag(), self.animator.frame_ms)
+
+    def _apply_drag(self):
+        """把窗口移动到最新的目标位置，没有新位置时结束循环"""
+        drag = self._drag
+        if drag is None or drag["target"] == drag["applied"]:
+            return None
+        drag["applied"] = drag["target"]
+        self.root.geometry("+{}+{}".format(*drag["applied"]))
+        return self.animator.frame_ms
+
+    def end_move(self, event):
+        """松开时移动到最终位置，并保存（按默认高度换算，窗口因气泡升高时底部不变）
+        
+        拖动状态保留到下次按下，气泡的单击翻页据此判断这次是否拖动过。
+        """
+        drag = self._drag
+        if drag is None or not drag["active"]:
+            return
+        drag["active"] = False
+        self.animator.stop("window_drag")
+        self._apply_drag()
+        # 手抖产生的几个像素位移不算拖动，不写配置文件
+        if drag["moved"] and drag["applied"] != drag["origin"]:
+            x, y = drag["applied"]
+            y += max(self.root.winfo_height(), 500) - 500
+            if self.cm.get("window_position") != {"x": x, "y": y}:
+                self.cm.set("window_position", {"x": x, "y": y})
 
     def on_double_click(self, event):
         """双击事件 - 先判断是否点击了触摸区域"""
@@ -786,86 +1199,60 @@ class DesktopPetApp:
         
         # 检查触摸功能是否启用
         touch_config = self.cm.get("touch_areas")
-        logging.info(f"on_double_click: Touch config exists: {touch_config is not None}")
-        
-        if touch_config:
-            enabled = touch_config.get("enabled", False)
-            areas_count = len(touch_config.get("areas", []))
-            logging.info(f"on_double_click: Touch enabled: {enabled}, Areas: {areas_count}")
-            
-            if enabled:
-                # 尝试检测触摸区域
-                touched_area = self.detect_touch_area(event.x, event.y)
-                if touched_area:
-                    # 点击了触摸区域，触发触摸反应
-                    logging.info(f"on_double_click: Triggering touch reaction for '{touched_area.get('name')}'")
-                    self.on_touch_area(touched_area)
-                    return
-                else:
-                    logging.info("on_double_click: No touch area detected, falling back to chat")
-            else:
-                logging.info("on_double_click: Touch disabled, falling back to chat")
-        else:
-            logging.info("on_double_click: No touch config, falling back to chat")
+        if touch_config and touch_config.get("enabled", False):
+            # 尝试检测触摸区域
+            touched_area = self.detect_touch_area(event.x, event.y)
+            if touched_area:
+                # 点击了触摸区域，触发触摸反应
+                logging.info(f"on_double_click: Triggering touch reaction for '{touched_area.get('name')}'")
+                self.on_touch_area(touched_area)
+                return
         
         # 没有点击触摸区域，执行正常闲聊
-        logging.info("on_double_click: Triggering normal chat")
+        touch_logger.debug("on_double_click: No touch area hit, triggering normal chat")
         self.trigger_chat()
     
+    def _rebuild_touch_index(self, snap=None):
+        """按当前角色的触摸区域配置重建网格索引（加载立绘、切换角色、修改触摸区域时调用）"""
+        snap = snap or self.cm.snapshot()
+        touch_config = snap.get("touch_areas") or {}
+        self._touch_index = TouchIndex(touch_config.get("areas") or ())
+    
     def detect_touch_area(self, click_x, click_y):
         """检测点击位置是否在某个触摸区域内
+        
+        先用立绘的不透明像素位图排除透明处的点击，再查触摸区域的网格索引，都是 O(1)。
         返回: 触摸区域配置 或 None
         """
-        # 获取立绘的边界框
-        items = self.canvas.find_withtag("character")
-        if not items:
-            logging.warning("detect_touch_area: No character items found")
-            return None
-        
-        # 获取第一个角色图像的边界框
-        char_bbox = self.canvas.bbox(items[0])
+        # 获取立绘的边界框（缺少立绘时为占位图形）
+        char_bbox = self.scene.bbox("character") or self.canvas.bbox("character")
         if not char_bbox:
-            logging.warning("detect_touch_area: No bbox for character")
+            touch_logger.warning("detect_touch_area: No bbox for character")
             return None
         
         char_left, char_top, char_right, char_bottom = char_bbox
-        
-        logging.info(f"detect_touch_area: Click at ({click_x}, {click_y})")
-        logging.info(f"detect_touch_area: Character bbox: left={char_left}, top={char_top}, right={char_right}, bottom={char_bottom}")
-        logging.info(f"detect_touch_area: Character size: width={char_right-char_left}, height={char_bottom-char_top}")
-        
         # 检查是否点击在立绘范围内
         if not (char_left <= click_x <= char_right and char_top <= click_y <= char_bottom):
-            logging.info("detect_touch_area: Click outside character bounds")
+            touch_logger.debug(f"detect_touch_area: Click ({click_x}, {click_y}) outside character bounds {char_bbox}")
             return None
         
         # 计算点击位置相对于立绘的坐标
         relative_x = click_x - char_left
         relative_y = click_y - char_top
         
-        logging.info(f"detect_touch_area: Relative position: ({relative_x}, {relative_y})")
-        
-        # 检测点击了哪个触摸区域
-        touch_config = self.cm.get("touch_areas")
-        if not touch_config:
+        # 点在立绘的透明像素上不算触摸
+        sprite = self.expressions.get(self.expressions.active, self.photo)
+        mask = self._hit_masks.get(sprite) if sprite is not None else None
+        if mask is not None and not mask.contains(relative_x, relative_y):
+            touch_logger.debug(f"detect_touch_area: Click ({relative_x}, {relative_y}) on transparent pixel")
             return None
         
-        areas = touch_config.get("areas", [])
-        logging.info(f"detect_touch_area: Checking {len(areas)} areas")
-        
-        for i, area in enumerate(areas):
-            ax, ay, aw, ah = area.get("x", 0), area.get("y", 0), area.get("width", 0), area.get("height", 0)
-            area_name = area.get("name", f"Area {i}")
-            
-            logging.info(f"detect_touch_area: Area '{area_name}': x={ax}, y={ay}, w={aw}, h={ah}, range: x[{ax}, {ax+aw}], y[{ay}, {ay+ah}]")
-            
-            # 判断点击是否在这个区域内
-            if ax <= relative_x <= ax + aw and ay <= relative_y <= ay + ah:
-                logging.info(f"detect_touch_area: HIT! Area '{area_name}' matched")
-                return area
-        
-        logging.info("detect_touch_area: No area matched")
-        return None
+        if self._touch_index is None:
+            self._rebuild_touch_index()
+        area = self._touch_index.hit(relative_x, relative_y)
+        touch_logger.debug(f"detect_touch_area: Click ({relative_x}, {relative_y}) -> "
+                           f"{area.get('name') if area else 'no area'}")
+        return area
 
     def on_touch_area(self, area):
         """触摸区域被点击"""
@@ -953,7 +1340,7 @@ class DesktopPetApp:
         InputBox(self.root, x, target_y, self.send_manual_chat, continuous_mode=True, config_manager=self.cm)
         
         # 如果没有历史记录，显示欢迎语
-        if not self.cm.get_chat_history():
+        if not self.cm.get_chat_history(limit=1):
             self.show_bubble("来聊聊天吧！")
 
     def send_manual_chat(self, text):
@@ -976,18 +1363,15 @@ class DesktopPetApp:
         # 保存退出时间
         self.save_exit_time()
         
-        alpha = 1.0
-        def _fade():
-            nonlocal alpha
-            alpha -= 0.05
-            if alpha <= 0:
-                if self.tray_icon: self.tray_icon.stop()
-                self.root.destroy()
-                sys.exit()
-            else:
-                self.root.attributes('-alpha', alpha)
-                self.root.after(50, _fade)
-        _fade()
+        def _fade(p):
+            if p < 1.0:
+                self.root.attributes('-alpha', 1.0 - p)
+        def _exit():
+            if self.tray_icon: self.tray_icon.stop()
+            self.sprite_loader.shutdown()
+            self.root.destroy()
+            sys.exit()
+        self.animator.animate("quit_fade", _fade, QUIT_FADE_MS, on_done=_exit)
     
     def save_exit_time(self):
         """保存退出时间"""
@@ -1000,8 +1384,8 @@ class DesktopPetApp:
 
 
     def drink_water(self):
-        current = self.cm.get("cups_drunk_today")
-        target = self.cm.get("daily_target_cups")
+        current = self.cm.get_cups_drunk_today()
+        target = self.cm.get_daily_target_cups()
         self.cm.set("cups_drunk_today", current + 1)
         self.schedule_next_reminder()
         self.show_bubble(f"喝水记录中...\n进度: {current+1}/{target}", duration=0)
@@ -1126,15 +1510,30 @@ class DesktopPetApp:
             self.ai_lock.release()
     
     def perform_character_switch(self, target_char_id, current_char_info, target_char_info):
-        """执行角色切换（带AI生成的告别和欢迎消息）"""
+        """执行角色切换（带AI生成的告别和欢迎消息）
+        
+        生成告别消息的同时在后台准备新角色的立绘、字体和世界书索引；
+        告别消息显示期间新角色的欢迎消息已经开始生成，整个切换只需等待约一次请求的时间。
+        """
+        # 切换前先取得新角色的配置快照，后台准备资源和生成欢迎消息都使用它
+        target_snap = self.cm.snapshot_for(target_char_id)
+        if target_snap is None:
+            messagebox.showerror("错误", "角色切换失败")
+            return
+        
+        # 常驻的角色不需要重新准备资源
+        warm = self.residency.peek(target_char_id, self._resident_fingerprint(target_snap))
+        
         # 第一步：当前角色说再见
         self.show_bubble("正在生成告别消息...", duration=0)
         threading.Thread(target=self._async_character_switch_goodbye, 
-                        args=(target_char_id, current_char_info, target_char_info), 
+                        args=(target_char_id, target_snap, current_char_info, target_char_info, warm), 
                         daemon=True).start()
     
-    def _async_character_switch_goodbye(self, target_char_id, current_char_info, target_char_info):
-        """异步生成告别消息"""
+    def _async_character_switch_goodbye(self, target_char_id, target_snap, current_char_info, target_char_info, warm=False):
+        """异步生成告别消息，同时准备新角色的资源（warm 为 True 时已常驻，不需要准备）并提前请求欢迎消息"""
+        pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="CharacterSwitch")
+        prepared = None if warm else pool.submit(self._prepare_character, target_snap)
         try:
             # 生成告别消息
             next_char_info = {
@@ -1146,29 +1545,56 @@ class DesktopPetApp:
             
             # 显示告别消息
             self.root.after(0, lambda m=goodbye_msg: self.show_bubble(m, duration=0))
-            
-            # 等待3秒让用户看到告别消息
-            time.sleep(3)
-            
-            # 第二步：切换角色
-            self.root.after(0, lambda: self._perform_switch_and_hello(target_char_id, current_char_info, target_char_info))
-            
         except Exception as e:
             error_msg = f"告别消息生成失败: {str(e)[:50]}"
             logging.error(f"Character switch goodbye failed: {e}")
             self.root.after(0, lambda m=error_msg: self.show_bubble(m, duration=5000))
             # 即使失败也继续切换
-            self.root.after(0, lambda: self._perform_switch_and_hello(target_char_id, current_char_info, target_char_info))
+        
+        # 第二步：用户看告别消息的同时，新角色开始生成欢迎消息
+        prev_char_info = {
+            "name": current_char_info.get("name", "未知"),
+            "persona": current_char_info.get("persona", ""),
+            "user_identity": current_char_info.get("user_identity", "")
+        }
+        hello = pool.submit(self.ai_client.get_character_switch_hello, prev_char_info, snap=target_snap)
+        pool.shutdown(wait=False)
+        
+        # 等待3秒让用户看到告别消息
+        time.sleep(3)
+        
+        try:
+            assets = prepared.result() if prepared else None
+        except Exception as e:
+            logging.error(f"Preparing character {target_char_id} failed: {e}")
+            assets = None
+        
+        # 第三步：切换角色
+        self.root.after(0, lambda: self._perform_switch_and_hello(target_char_id, assets, hello))
     
-    def _perform_switch_and_hello(self, target_char_id, current_char_info, target_char_info):
-        """执行切换并生成欢迎消息"""
+    def _perform_switch_and_hello(self, target_char_id, prepared, hello):
+        """执行切换并显示欢迎消息（prepared 为后台准备好的资源，hello 为欢迎消息请求的 Future）"""
+        # 先取出新角色的常驻资源，再放入当前角色，以免新角色被当作最久未用的角色淘汰
+        target_snap = self.cm.snapshot_for(target_char_id)
+        fingerprint = self._resident_fingerprint(target_snap) if target_snap else None
+        # 常驻资源在等待告别消息期间失效（配置变化）时 prepared 为 None，
+        # load_assets 会在后台 SpriteLoader 中加载表情，不在 Tk 主线程补做准备
+        resident = self.residency.take(target_char_id, fingerprint) if target_snap else None
+        
+        # 当前角色的立绘和字体保留在常驻缓存中，切回来时直接使用
+        previous_char_id = self.cm.get_current_character_id()
+        self._park_current_character()
+        
         # 切换角色
         if not self.cm.switch_character(target_char_id):
+            self.residency.discard(previous_char_id)
+            if resident is not None:
+                self.residency.park(target_char_id, fingerprint, resident, resident["expressions"].total_bytes)
             messagebox.showerror("错误", "角色切换失败")
             return
         
-        # 先删除旧气泡并恢复窗口（重要！）
-        self.canvas.delete("bubble_image")
+        # 先隐藏旧气泡并恢复窗口（重要！）
+        self._hide_bubble()
         self.restore_window_height()
         
         # 强制更新窗口，确保高度恢复生效
@@ -1177,8 +1603,14 @@ class DesktopPetApp:
         # 重新加载AI客户端（使用新角色的配置）
         self.ai_client = AIClient(self.cm)
         
+        # 使用新角色的立绘和字体（常驻缓存中有则直接复用，否则使用后台刚准备好的）
+        if resident is not None:
+            self._font_cache = resident["fonts"]
+        else:
+            self._font_cache = dict(prepared["fonts"]) if prepared else {}
+        
         # 重新加载资源和UI
-        self.load_assets()
+        self.load_assets(prepared=prepared, resident=resident)
         self.setup_ui()
         
         # 重新绑定事件（关键！）
@@ -1190,24 +1622,18 @@ class DesktopPetApp:
         # 等待一帧，确保UI完全渲染
         self.root.update_idletasks()
         
-        # 显示加载消息
-        self.show_bubble("正在生成欢迎消息...", duration=0)
+        # 欢迎消息还没生成完时显示加载消息
+        if not hello.done():
+            self.show_bubble("正在生成欢迎消息...", duration=0)
         
-        # 第三步：新角色打招呼
         threading.Thread(target=self._async_character_switch_hello, 
-                        args=(current_char_info,), 
+                        args=(hello,), 
                         daemon=True).start()
     
-    def _async_character_switch_hello(self, prev_char_info):
-        """异步生成欢迎消息"""
+    def _async_character_switch_hello(self, hello):
+        """等待欢迎消息生成完成并显示"""
         try:
-            # 生成欢迎消息
-            prev_char_info_dict = {
-                "name": prev_char_info.get("name", "未知"),
-                "persona": prev_char_info.get("persona", ""),
-                "user_identity": prev_char_info.get("user_identity", "")
-            }
-            hello_msg = self.ai_client.get_character_switch_hello(prev_char_info_dict)
+            hello_msg = hello.result()
             
             # 显示欢迎消息
             self.root.after(0, lambda m=hello_msg: self.show_bubble(m))
@@ -1216,7 +1642,6 @@ class DesktopPetApp:
             error_msg = f"欢迎消息生成失败: {str(e)[:50]}"
             logging.error(f"Character switch hello failed: {e}")
             self.root.after(0, lambda m=error_msg: self.show_bubble(m, duration=5000))
-            self.root.after(0, lambda m=error_msg: self.show_bubble(m, duration=5000))
     
     def calculate_offline_duration(self):
         """计算用户离线时长
@@ -1286,8 +1711,8 @@ class DesktopPetApp:
         if not work_start or not work_end:
             return -1
         
-        target = self.cm.get("daily_target_cups")
-        current = self.cm.get("cups_drunk_today")
+        target = self.cm.get_daily_target_cups()
+        current = self.cm.get_cups_drunk_today()
         now = datetime.now()
         
         try:
@@ -1590,7 +2015,7 @@ class DesktopPetApp:
         self.show_bubble("好痒！别挠了！>_<", duration=2000)
         # 尝试切换到害羞或惊讶表情
         for expr in ["shy", "surprised", "happy"]:
-            if expr in self.expressions:
+            if self._has_expression(expr):
                 self.set_expression(expr)
                 break
 
@@ -1640,15 +2065,106 @@ class DesktopPetApp:
         SettingsWindow(self.root, self.cm, self.ai_client, self.update_after_settings)
 
     def update_after_settings(self):
-        """设置更新后重新调度所有提醒和重新加载资源"""
-        self.schedule_all_reminders()
-        # 重新加载表情立绘
-        self.load_assets()
-        self.setup_ui()
-        # 重新绑定事件（重要！）
-        self.bind_events()
+        """设置保存后的提示（提醒、立绘、字体等由配置变化订阅按需更新）"""
         self.show_bubble("设置已更新！字体将在下次显示气泡时生效。")
 
+    # --- 配置变化订阅 ---
+    def _subscribe_config_changes(self):
+        """按键路径订阅配置变化，只更新受影响的部分
+        
+        切换角色时 ConfigManager 只通知 current_character，由 _perform_switch_and_hello 整体重新加载。
+        """
+        schedule_all = lambda paths: self.schedule_all_reminders()
+        subscriptions = [
+            ("reminders", self._on_reminders_changed),
+            ("weekly_schedule", schedule_all),
+            ("work_start_time", schedule_all),
+            ("work_end_time", schedule_all),
+            ("enable_random_chat", lambda paths: self.schedule_next_chat()),
+            ("random_chat_interval", lambda paths: self.schedule_next_chat()),
+            ("expressions", self._on_expressions_changed),
+            ("avatar", self._on_expressions_changed),
+            ("appearance", self._on_appearance_changed),
+            ("logging", self._on_logging_changed),
+            ("diagnostics.tray_menu", lambda paths: self.tray_icon and self.tray_icon.update_menu()),
+            ("sprite_cache", self._on_sprite_cache_changed),
+            ("animation", self._on_animation_changed),
+            ("touch_areas", lambda paths: self._rebuild_touch_index()),
+        ]
+        for prefix, handler in subscriptions:
+            # 配置可能在后台线程中修改，回调统一转到 Tk 主线程执行
+            self.cm.subscribe(prefix, lambda paths, handler=handler: self.root.after(0, lambda: handler(paths)))
+
+    def _on_reminders_changed(self, paths):
+        """只重新调度设置发生变化的提醒（触发时间的记录、自定义提醒的倒计时不需要重新调度）"""
+        types = set()
+        for path in paths:
+            parts = path.split(".")
+            if len(parts) == 1:
+                self.schedule_all_reminders()
+                return
+            if parts[-1] != "last_triggered":
+                types.add(parts[1])
+        
+        if "water" in types:
+            self.schedule_next_reminder()
+        if "meal" in types:
+            self.schedule_meal_reminders()
+        for reminder_type in ("sitting", "relax"):
+            if reminder_type in types:
+                self.schedule_interval_reminder(reminder_type)
+        if types - {"custom"}:
+            logging.info(f"Rescheduled reminders: {sorted(types - {'custom'})}")
+
+    def _on_expressions_changed(self, paths):
+        """只重新加载变化的立绘"""
+        tags = set()
+        for path in paths:
+            parts = path.split(".", 2)
+            if path in ("avatar", "expressions.default"):
+                tags.add("default")
+            elif len(parts) == 3 and parts[1] == "mappings":
+                tags.add(parts[2])
+            elif path != "expressions.restore_delay":
+                # 整个表情配置被替换，全部重新加载
+                tags = None
+                break
+        
+        if tags is not None and not tags:
+            return
+        self.load_assets(tags)
+        logging.info(f"Reloaded expressions: {'all' if tags is None else sorted(tags)}")
+        
+        # 当前显示的立绘被修改或删除时刷新画布
+        if tags is None or self.current_expression in tags or not self._has_expression(self.current_expression):
+            if not self._has_expression(self.current_expression):
+                self.current_expression = "default"
+            self.set_expression(self.current_expression)
+
+    def _on_animation_changed(self, paths):
+        self.animator.set_fps((self.cm.get("animation") or {}).get("fps", 30))
+        self._stop_breathing()
+        self._start_breathing()
+
+    def _on_sprite_cache_changed(self, paths):
+        """调整立绘缓存和常驻角色的内存上限（超出时立即淘汰）"""
+        cache_config = self.cm.get("sprite_cache") or {}
+        self.expressions.budget_bytes = int(cache_config.get("max_mb", 48) * 1024 * 1024)
+        self.expressions.set_active(self.expressions.active)
+        self.residency.max_characters = cache_config.get("resident_characters", 2)
+        self.residency.budget_bytes = int(cache_config.get("resident_mb", 64) * 1024 * 1024)
+        for char_id in self.residency.trim():
+            drop_lore_index(char_id)
+
+    def _on_appearance_changed(self, paths):
+        self._font_cache.clear()
+        self.bubble_renderer.clear()
+
+    def _on_logging_changed(self, paths):
+        log_config = self.cm.get("logging") or {}
+        apply_log_levels(log_config.get("levels"))
+        apply_log_rotation(log_config.get("max_bytes"), log_config.get("backup_count"))
+
 class ExpressionDialog(ctk.CTkToplevel):
     def __init__(self, parent, entry_data, callback):
         super().__init__(parent)
@@ -1813,12 +2329,14 @@ class LorebookDialog(ctk.CTkToplevel):
             messagebox.showwarning("提示", "关键词触发模式下，必须输入关键词")
             return
             
-        data = {
-            "id": self.entry_data.get("id", str(uuid.uuid4())) if self.entry_data else str(uuid.uuid4()),
+        # 保留条目的其他字段（如酒馆角色卡导入的 insertion_order）
+        data = dict(self.entry_data or {})
+        data.update({
+            "id": data.get("id", str(uuid.uuid4())),
             "type": entry_type,
             "keywords": keywords,
             "content": content
-        }
+        })
         
         self.callback(data)
         self.destroy()
@@ -1901,6 +2419,9 @@ class TouchAreaDialog(ctk.CTkToplevel):
                 data["width"] = self.area_data["width"]
             if "height" in self.area_data:
                 data["height"] = self.area_data["height"]
+            if "shape" in self.area_data:
+                data["shape"] = self.area_data["shape"]
+                data["points"] = self.area_data.get("points", [])
         
         self.callback(data)
         self.destroy()
@@ -1932,6 +2453,7 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
         self.start_x = 0
         self.start_y = 0
         self.current_rect = None
+        self.stroke_points = []  # 自由绘制时鼠标经过的点（画布坐标）
         self.areas = []  # 存储所有区域
         self.selected_area_index = None
         
@@ -1953,6 +2475,7 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
         
         ctk.CTkLabel(info_frame, text="使用说明", font=("Microsoft YaHei UI", 13, "bold"), text_color="#333333").pack(anchor="w", padx=15, pady=(10, 5))
         ctk.CTkLabel(info_frame, text="• 在立绘上拖动鼠标绘制矩形框来定义触摸区域", font=("Microsoft YaHei UI", 11), text_color="gray", anchor="w").pack(anchor="w", padx=15)
+        ctk.CTkLabel(info_frame, text="• 选择“自由绘制”后按住鼠标圈出任意形状，松开时自动闭合", font=("Microsoft YaHei UI", 11), text_color="gray", anchor="w").pack(anchor="w", padx=15)
         ctk.CTkLabel(info_frame, text="• 点击右侧区域列表可以编辑或删除", font=("Microsoft YaHei UI", 11), text_color="gray", anchor="w").pack(anchor="w", padx=15, pady=(0, 10))
         
         # 中间内容区域（左右分栏）
@@ -1963,7 +2486,14 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
         left_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
         left_frame.pack(side="left", fill="both", expand=True, padx=(0, 10))
         
-        ctk.CTkLabel(left_frame, text="立绘预览", font=("Microsoft YaHei UI", 12, "bold")).pack(anchor="w", pady=(0, 5))
+        header_frame = ctk.CTkFrame(left_frame, fg_color="transparent")
+        header_frame.pack(fill="x", pady=(0, 5))
+        ctk.CTkLabel(header_frame, text="立绘预览", font=("Microsoft YaHei UI", 12, "bold")).pack(side="left")
+        
+        # 绘制方式：矩形 / 自由绘制（多边形）
+        self.shape_var = ctk.StringVar(value="rect")
+        ctk.CTkRadioButton(header_frame, text="自由绘制", variable=self.shape_var, value="polygon").pack(side="right")
+        ctk.CTkRadioButton(header_frame, text="矩形", variable=self.shape_var, value="rect").pack(side="right", padx=(0, 10))
         
         canvas_frame = ctk.CTkFrame(left_frame, fg_color="#F2F2F7", corner_radius=10)
         canvas_frame.pack(fill="both", expand=True)
@@ -2089,12 +2619,22 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
         self.drawing = True
         self.start_x = event.x
         self.start_y = event.y
+        self.stroke_points = [(event.x, event.y)]
         
     def on_mouse_drag(self, event):
         """鼠标拖动"""
         if not self.drawing:
             return
         
+        if self.shape_var.get() == "polygon":
+            # 自由绘制：相距 3 像素以上才记录新点，只追加新的线段
+            last_x, last_y = self.stroke_points[-1]
+            if abs(event.x - last_x) + abs(event.y - last_y) < 3:
+                return
+            self.stroke_points.append((event.x, event.y))
+            self.canvas.create_line(last_x, last_y, event.x, event.y, fill="#FF6B6B", width=2, tags="temp_rect")
+            return
+        
         # 删除旧的临时矩形
         if self.current_rect:
             self.canvas.delete(self.current_rect)
@@ -2112,14 +2652,20 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
         
         self.drawing = False
         
-        # 删除临时矩形
-        if self.current_rect:
-            self.canvas.delete(self.current_rect)
-            self.current_rect = None
+        # 删除临时矩形 / 自由绘制的轨迹
+        self.canvas.delete("temp_rect")
+        self.current_rect = None
+        
+        polygon = self.shape_var.get() == "polygon" and len(self.stroke_points) >= 3
+        if polygon:
+            xs = [p[0] for p in self.stroke_points]
+            ys = [p[1] for p in self.stroke_points]
+        else:
+            xs, ys = (self.start_x, event.x), (self.start_y, event.y)
         
-        # 计算矩形坐标
-        x1, y1 = min(self.start_x, event.x), min(self.start_y, event.y)
-        x2, y2 = max(self.start_x, event.x), max(self.start_y, event.y)
+        # 计算矩形坐标（自由绘制时为外接矩形）
+        x1, y1 = min(xs), min(ys)
+        x2, y2 = max(xs), max(ys)
         width = x2 - x1
         height = y2 - y1
         
@@ -2128,12 +2674,9 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
             return
         
         # 转换为相对于立绘的坐标
-        if hasattr(self, 'img_left') and hasattr(self, 'img_top'):
-            relative_x = x1 - self.img_left
-            relative_y = y1 - self.img_top
-        else:
-            relative_x = x1
-            relative_y = y1
+        offset_x, offset_y = (self.img_left, self.img_top) if hasattr(self, 'img_left') and hasattr(self, 'img_top') else (0, 0)
+        relative_x = x1 - offset_x
+        relative_y = y1 - offset_y
         
         # 打开对话框输入区域信息
         area_data = {
@@ -2143,6 +2686,9 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
             "height": int(height),
             "id": str(uuid.uuid4())
         }
+        if polygon:
+            area_data["shape"] = "polygon"
+            area_data["points"] = [[int(px - offset_x), int(py - offset_y)] for px, py in self.stroke_points]
         
         TouchAreaDialog(self, area_data, lambda data: self.add_area(data))
     
@@ -2173,12 +2719,17 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
                 canvas_x = x
                 canvas_y = y
             
-            # 绘制矩形
+            # 绘制矩形 / 多边形
             color = "#7EA0B7"
-            rect_id = self.canvas.create_rectangle(
-                canvas_x, canvas_y, canvas_x + width, canvas_y + height,
-                outline=color, width=2, tags="area_rect"
-            )
+            points = area_points(area)
+            if points:
+                coords = [c for px, py in points for c in (px + canvas_x - x, py + canvas_y - y)]
+                self.canvas.create_polygon(*coords, outline=color, fill="", width=2, tags="area_rect")
+            else:
+                self.canvas.create_rectangle(
+                    canvas_x, canvas_y, canvas_x + width, canvas_y + height,
+                    outline=color, width=2, tags="area_rect"
+                )
             
             # 绘制标签
             name = area.get("name", f"区域{i+1}")
@@ -2218,6 +2769,8 @@ class TouchAreaEditorWindow(ctk.CTkToplevel):
                     text_color="#333333", anchor="w").pack(fill="x")
         
         pos_text = f"位置: ({area.get('x', 0)}, {area.get('y', 0)})  大小: {area.get('width', 0)}×{area.get('height', 0)}"
+        if area_points(area):
+            pos_text += "  自由形状"
         ctk.CTkLabel(info_frame, text=pos_text, font=("Microsoft YaHei UI", 10), 
                     text_color="gray", anchor="w").pack(fill="x")
         
@@ -2913,6 +3466,7 @@ class SettingsWindow:
         self.tab_touch = self.tabview.add("触摸")
         self.tab_daily = self.tabview.add("日常")
         self.tab_reminder = self.tabview.add("提醒")
+        self.tab_diagnostics = self.tabview.add("诊断")
         
         # 绑定标签页切换事件（懒加载）
         self.tabview.configure(command=self.on_tab_change)
@@ -2949,7 +3503,8 @@ class SettingsWindow:
             "角色": (self.setup_character_tab, self.tab_character),
             "触摸": (self.setup_touch_tab, self.tab_touch),
             "日常": (self.setup_daily_tab, self.tab_daily),
-            "提醒": (self.setup_reminder_tab, self.tab_reminder)
+            "提醒": (self.setup_reminder_tab, self.tab_reminder),
+            "诊断": (self.setup_diagnostics_tab, self.tab_diagnostics)
         }
         
         if tab_name in tab_setup_map:
@@ -2983,7 +3538,8 @@ class SettingsWindow:
         self.model_combo.pack(side="left", fill="x", expand=True, padx=5)
         self.model_combo.set(self.cm.get("model"))
         
-        ctk.CTkButton(model_frame, text="刷新", width=60, command=self.refresh_models, fg_color="#F2F2F7", text_color="#333333", hover_color="#E5E5EA").pack(side="right")
+        self.refresh_models_btn = ctk.CTkButton(model_frame, text="刷新", width=60, command=self.refresh_models, fg_color="#F2F2F7", text_color="#333333", hover_color="#E5E5EA")
+        self.refresh_models_btn.pack(side="right")
 
         # 历史消息数量
         self.create_input_row(api_card, "历史消息数", "max_history_messages", self.cm.get("max_history_messages", 10))
@@ -3033,6 +3589,7 @@ class SettingsWindow:
         self.create_slider_input(appearance_card, "垂直内边距", "bubble_padding_y", bubble_style.get("padding_y", 28), 10, 50)
         self.create_slider_input(appearance_card, "字体大小", "bubble_font", bubble_style.get("font_size", 14), 10, 20)
         self.create_slider_input(appearance_card, "边框粗细", "bubble_border_width", bubble_style.get("border_width", 1), 0, 5)
+        self.create_slider_input(appearance_card, "最大高度(0不限)", "bubble_max_height", bubble_style.get("max_height", 320), 0, 600)
         
         # 字体配置
         self.create_font_selector(appearance_card, "字体设置", "bubble_font", 
@@ -3501,7 +4058,8 @@ class SettingsWindow:
                     "padding_x": 30,
                     "padding_y": 28,
                     "font_size": 14,
-                    "border_width": 1
+                    "border_width": 1,
+                    "max_height": 320
                 },
                 "input_box": {
                     "background_color": "#FFFFFF",
@@ -3693,6 +4251,29 @@ class SettingsWindow:
         ctk.CTkButton(btn_frame, text="+ 添加条目", height=35, fg_color="#7EA0B7", command=self.add_lore_entry).pack(side="left")
         ctk.CTkLabel(btn_frame, text="双击条目编辑，右侧按钮删除", text_color="gray", font=("Microsoft YaHei UI", 11)).pack(side="right")
 
+        # 注入方式与 Token 预算
+        lore_settings = dict(DEFAULT_LOREBOOK_SETTINGS, **(self.cm.get("lorebook_settings") or {}))
+        lore_opt_frame = ctk.CTkFrame(character_card, fg_color="transparent")
+        lore_opt_frame.pack(fill="x", pady=(0, 5))
+        
+        ctk.CTkLabel(lore_opt_frame, text="注入方式", font=("Microsoft YaHei UI", 12), text_color="gray").pack(side="left", padx=(0, 5))
+        self.lore_mode_var = ctk.StringVar(value=LORE_MODE_LABELS.get(lore_settings["mode"], LORE_MODE_LABELS["keyword"]))
+        ctk.CTkComboBox(lore_opt_frame, values=list(LORE_MODE_LABELS.values()), variable=self.lore_mode_var, width=130,
+                        state="readonly", border_width=0, fg_color="#F2F2F7", text_color="#333333").pack(side="left", padx=(0, 15))
+        
+        ctk.CTkLabel(lore_opt_frame, text="Token 预算", font=("Microsoft YaHei UI", 12), text_color="gray").pack(side="left", padx=(0, 5))
+        self.entry_lore_budget = ctk.CTkEntry(lore_opt_frame, width=70)
+        self.entry_lore_budget.insert(0, str(lore_settings["token_budget"]))
+        self.entry_lore_budget.pack(side="left", padx=(0, 15))
+        
+        ctk.CTkLabel(lore_opt_frame, text="最多条目", font=("Microsoft YaHei UI", 12), text_color="gray").pack(side="left", padx=(0, 5))
+        self.entry_lore_top_k = ctk.CTkEntry(lore_opt_frame, width=50)
+        self.entry_lore_top_k.insert(0, str(lore_settings["top_k"]))
+        self.entry_lore_top_k.pack(side="left")
+        
+        ctk.CTkLabel(character_card, text="常驻条目也计入预算；BM25 模式会根据当前输入和最近聊天选出最相关的条目（最多条目不含常驻）",
+                    text_color="gray", font=("Microsoft YaHei UI", 11), wraplength=480, justify="left").pack(anchor="w", pady=(0, 10))
+
         self.refresh_lore_list()
         
         # === 表情系统 ===
@@ -3809,6 +4390,60 @@ class SettingsWindow:
             self.cm.set("lorebook", lorebook)
             self.refresh_lore_list()
 
+    def setup_diagnostics_tab(self, parent):
+        """诊断标签页：当前角色的请求性能与提示词构成统计（只读）"""
+        card = self.create_card(parent, expand=True)
+        
+        self.create_section_label(card, "请求性能与提示词构成 (当前角色)")
+        ctk.CTkLabel(card, text="注：耗时单位为毫秒，p50/p95 基于每种消息最近 200 次请求。", font=("Microsoft YaHei UI", 10), text_color="gray").pack(anchor="w", pady=(0, 10))
+        
+        self.txt_diagnostics = ctk.CTkTextbox(card, border_width=0, fg_color="#F2F2F7", corner_radius=10, font=("Consolas", 11), wrap="none")
+        self.txt_diagnostics.pack(fill="both", expand=True)
+        
+        ctk.CTkButton(card, text="刷新", width=80, command=self.refresh_diagnostics, fg_color="#F2F2F7", text_color="#333333", hover_color="#E5E5EA").pack(anchor="e", pady=(10, 0))
+        
+        ctk.CTkFrame(card, height=1, fg_color="#F2F2F7").pack(fill="x", pady=15) # 分割线
+        
+        self.create_section_label(card, "诊断工具")
+        diagnostics = self.cm.get("diagnostics") or {}
+        self.diag_tray_var = ctk.BooleanVar(value=diagnostics.get("tray_menu", False))
+        ctk.CTkSwitch(card, text="在托盘菜单中显示诊断工具", variable=self.diag_tray_var, font=("Microsoft YaHei UI", 12), progress_color="#7EA0B7").pack(anchor="w")
+        ctk.CTkLabel(card, text="注：包含性能分析、内存快照和线程堆栈导出，文件保存在 diagnostics 目录。", font=("Microsoft YaHei UI", 10), text_color="gray").pack(anchor="w", pady=(5, 0))
+        
+        self.refresh_diagnostics()
+
+    def refresh_diagnostics(self):
+        """重新读取并显示诊断数据"""
+        def fmt(value):
+            return "-" if value is None else f"{value:.0f}"
+        
+        lines = []
+        rows = request_metrics.summary(self.cm.get_current_character_id())
+        if rows:
+            lines.append(f"{'类型':<26}{'次数':>6}{'失败':>6}{'总耗时 p50/p95':>18}{'首字节 p50/p95':>18}{'上行/下行(B)':>16}{'Tokens':>8}")
+            for row in rows:
+                total = f"{fmt(row['p50_total_ms'])}/{fmt(row['p95_total_ms'])}"
+                ttfb = f"{fmt(row['p50_ttfb_ms'])}/{fmt(row['p95_ttfb_ms'])}"
+                size = f"{row['avg_request_bytes']}/{row['avg_response_bytes']}"
+                lines.append(f"{row['msg_type']:<26}{row['count']:>6}{row['errors']:>6}{total:>18}{ttfb:>18}{size:>16}{fmt(row['avg_total_tokens']):>8}")
+        else:
+            lines.append("暂无请求记录。")
+        
+        lines.append("")
+        lines.append("提示词构成 (估算 Token，按平均值排序)")
+        sections = prompt_stats.summary(self.cm.get_current_character_id())
+        if sections:
+            lines.append(f"{'部分':<18}{'平均字数':>10}{'平均Token':>12}{'峰值Token':>12}{'占比':>8}")
+            for row in sections:
+                lines.append(f"{row['section']:<18}{row['avg_chars']:>10}{row['avg_tokens']:>12}{row['max_tokens']:>12}{row['share']:>8.0%}")
+        else:
+            lines.append("暂无提示词记录。")
+        
+        self.txt_diagnostics.configure(state="normal")
+        self.txt_diagnostics.delete("1.0", "end")
+        self.txt_diagnostics.insert("1.0", "\n".join(lines))
+        self.txt_diagnostics.configure(state="disabled")
+
     # --- 辅助方法 ---
     def create_card(self, parent, expand=False, pady=0):
         card = ctk.CTkFrame(parent, fg_color="white", corner_radius=15)
@@ -3850,35 +4485,42 @@ class SettingsWindow:
         self.entries[entry_key] = entry
 
     def refresh_models(self):
-        temp_cm = ConfigManager()
-        temp_cm.config = self.cm.config.copy()
-        temp_cm.set("api_base_url", self.entries["api_base_url"].get())
-        temp_cm.set("api_key", self.entries["api_key"].get())
-        temp_client = AIClient(temp_cm)
-        try:
-            models = temp_client.get_models()
-            if models:
-                self.model_combo.configure(values=models)
-                self.model_combo.set(models[0])
-                messagebox.showinfo("成功", f"获取到 {len(models)} 个模型")
-            else:
-                messagebox.showwarning("警告", "未能获取到模型")
-        except Exception as e:
-            messagebox.showerror("错误", f"刷新失败: {e}")
+        """在后台线程拉取模型列表（使用输入框中尚未保存的地址和 Key）"""
+        base_url = self.entries["api_base_url"].get()
+        api_key = self.entries["api_key"].get()
+        self.refresh_models_btn.configure(state="disabled", text="...")
+        
+        def worker():
+            models = self.ai_client.get_models(base_url=base_url, api_key=api_key)
+            self.window.after(0, lambda: self._on_models_fetched(models))
+        
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _on_models_fetched(self, models):
+        if not self.window.winfo_exists():
+            return
+        self.refresh_models_btn.configure(state="normal", text="刷新")
+        if models:
+            self.model_combo.configure(values=models)
+            self.model_combo.set(models[0])
+            messagebox.showinfo("成功", f"获取到 {len(models)} 个模型")
+        else:
+            messagebox.showwarning("警告", "未能获取到模型")
 
     def save_settings(self):
         import copy
         logging.info("=== save_settings called ===")
         
         try:
-            # 使用深拷贝避免嵌套字典问题
-            new_config = copy.deepcopy(self.cm.config)
+            # 只收集各标签页修改的顶层配置项，最后由 ConfigManager 一次性应用，
+            # 修改子项时先复制该项，不改动正在使用的配置
+            patch = {}
             
             # 获取当前角色ID
             current_char_id = self.cm.get_current_character_id()
             logging.info(f"Current character ID: {current_char_id}")
             
-            if not current_char_id or current_char_id not in new_config.get("characters", {}):
+            if not current_char_id or current_char_id not in self.cm.config.get("characters", {}):
                 logging.error("Current character not found!")
                 messagebox.showerror("错误", "当前角色不存在")
                 return
@@ -3887,18 +4529,15 @@ class SettingsWindow:
             messagebox.showerror("错误", f"初始化失败: {str(e)}")
             return
         
-        # 获取当前角色配置的引用
-        char_config = new_config["characters"][current_char_id]
-        
         # === 只保存已加载标签页的数据 ===
         
         # 保存"基础"标签页（API、天气、外观）
         if "基础" in self.tabs_loaded:
             try:
                 logging.info("Saving 基础 tab settings...")
-                new_config["api_base_url"] = self.entries["api_base_url"].get()
-                new_config["api_key"] = self.entries["api_key"].get()
-                new_config["model"] = self.model_combo.get()
+                patch["api_base_url"] = self.entries["api_base_url"].get()
+                patch["api_key"] = self.entries["api_key"].get()
+                patch["model"] = self.model_combo.get()
         
                 # 历史消息数量
                 try:
@@ -3907,12 +4546,12 @@ class SettingsWindow:
                         max_history = 0
                     elif max_history > 50:
                         max_history = 50
-                    new_config["max_history_messages"] = max_history
+                    patch["max_history_messages"] = max_history
                 except:
-                    new_config["max_history_messages"] = 10  # 使用默认值
+                    patch["max_history_messages"] = 10  # 使用默认值
                 
-                new_config["weather_city"] = self.entries.get("weather_city", ctk.CTkEntry(self.window)).get()
-                new_config["weather_api_key"] = self.entries.get("weather_api_key", ctk.CTkEntry(self.window)).get()
+                patch["weather_city"] = self.entries.get("weather_city", ctk.CTkEntry(self.window)).get()
+                patch["weather_api_key"] = self.entries.get("weather_api_key", ctk.CTkEntry(self.window)).get()
                 # 外观设置也在基础标签页
                 # ... (外观设置代码保留在后面)
             except Exception as e:
@@ -3932,7 +4571,7 @@ class SettingsWindow:
                         "start": self.schedule_entries[f"{day}_start"].get(),
                         "end": self.schedule_entries[f"{day}_end"].get()
                     }
-                char_config["weekly_schedule"] = weekly_schedule
+                patch["weekly_schedule"] = weekly_schedule
             except Exception as e:
                 logging.error(f"Error saving 日常 tab: {e}")
                 # 不阻止保存，继续
@@ -3941,9 +4580,9 @@ class SettingsWindow:
         if "提醒" in self.tabs_loaded:
             try:
                 logging.info("Saving 提醒 tab settings...")
-                char_config["daily_target_cups"] = float(self.entries["daily_target_cups"].get())
+                patch["daily_target_cups"] = float(self.entries["daily_target_cups"].get())
                 
-                reminders = char_config.get("reminders", {})
+                reminders = copy.deepcopy(self.cm.get("reminders") or {})
                 if "water" not in reminders:
                     reminders["water"] = {}
                 reminders["water"]["enabled"] = True
@@ -3974,9 +4613,9 @@ class SettingsWindow:
                     "last_triggered": reminders.get("relax", {}).get("last_triggered")
                 }
                 
-                char_config["reminders"] = reminders
-                char_config["enable_random_chat"] = self.chat_var.get()
-                char_config["random_chat_interval"] = int(self.entries["random_chat_interval"].get())
+                patch["reminders"] = reminders
+                patch["enable_random_chat"] = self.chat_var.get()
+                patch["random_chat_interval"] = int(self.entries["random_chat_interval"].get())
             except Exception as e:
                 logging.error(f"Error saving 提醒 tab: {e}")
                 messagebox.showerror("错误", f"保存提醒设置失败: {str(e)}")
@@ -3986,9 +4625,9 @@ class SettingsWindow:
         if "触摸" in self.tabs_loaded:
             try:
                 logging.info("Saving 触摸 tab settings...")
-                touch_config = char_config.get("touch_areas", {"enabled": True, "areas": []})
+                touch_config = dict(self.cm.get("touch_areas") or {"enabled": True, "areas": []})
                 touch_config["enabled"] = self.touch_enabled_var.get()
-                char_config["touch_areas"] = touch_config
+                patch["touch_areas"] = touch_config
             except Exception as e:
                 logging.error(f"Error saving 触摸 tab: {e}")
         
@@ -3996,10 +4635,17 @@ class SettingsWindow:
         if "角色" in self.tabs_loaded:
             try:
                 logging.info("Saving 角色 tab settings...")
-                char_config["name"] = self.entry_char_name.get().strip() or "角色"
-                char_config["persona"] = self.txt_persona.get("1.0", tk.END).strip()
-                char_config["user_name"] = self.entry_user_name.get().strip() or "用户"
-                char_config["user_identity"] = self.txt_user_identity.get("1.0", tk.END).strip()
+                patch["name"] = self.entry_char_name.get().strip() or "角色"
+                patch["persona"] = self.txt_persona.get("1.0", tk.END).strip()
+                patch["user_name"] = self.entry_user_name.get().strip() or "用户"
+                patch["user_identity"] = self.txt_user_identity.get("1.0", tk.END).strip()
+                
+                lore_settings = dict(DEFAULT_LOREBOOK_SETTINGS, **(self.cm.get("lorebook_settings") or {}))
+                mode_by_label = {label: mode for mode, label in LORE_MODE_LABELS.items()}
+                lore_settings["mode"] = mode_by_label.get(self.lore_mode_var.get(), "keyword")
+                lore_settings["token_budget"] = max(0, int(self.entry_lore_budget.get()))
+                lore_settings["top_k"] = max(0, int(self.entry_lore_top_k.get()))
+                patch["lorebook_settings"] = lore_settings
             except Exception as e:
                 logging.error(f"Error saving character info: {e}")
                 messagebox.showerror("错误", f"保存角色信息失败: {str(e)}")
@@ -4010,7 +4656,7 @@ class SettingsWindow:
         
         if "角色" in self.tabs_loaded:
             try:
-                expressions_config = char_config.get("expressions", {})
+                expressions_config = dict(self.cm.get("expressions") or {})
                 
                 # 处理默认立绘：如果用户选择了新立绘，复制到角色目录
                 new_avatar_path = self.entry_default_img.get().strip()
@@ -4033,7 +4679,7 @@ class SettingsWindow:
                             avatar_dest = os.path.join(char_dir, f"character{ext}")
                             shutil.copy2(new_avatar_path, avatar_dest)
                             expressions_config["default"] = avatar_dest
-                            char_config["avatar"] = avatar_dest  # 同步更新 avatar
+                            patch["avatar"] = avatar_dest  # 同步更新 avatar
                             avatar_updated = True
                             logging.info(f"✓ Copied avatar: {new_avatar_path} -> {avatar_dest}")
                         except Exception as e:
@@ -4046,11 +4692,11 @@ class SettingsWindow:
                         # 如果是相对路径或不存在，直接使用（可能是已存在的路径）
                         logging.info(f"Using path as-is (relative or pre-existing): {new_avatar_path}")
                         expressions_config["default"] = new_avatar_path
-                        char_config["avatar"] = new_avatar_path  # 同步更新 avatar
+                        patch["avatar"] = new_avatar_path  # 同步更新 avatar
                 
                 expressions_config["restore_delay"] = int(self.entry_restore_delay.get())
                 # mappings 已经在 save_expression_mapping 中实时更新了
-                char_config["expressions"] = expressions_config
+                patch["expressions"] = expressions_config
                 logging.info(f"✓ Expression config saved, avatar_updated={avatar_updated}")
                 
             except Exception as e:
@@ -4064,7 +4710,7 @@ class SettingsWindow:
         if "基础" in self.tabs_loaded:
             try:
                 logging.info("Saving appearance settings...")
-                appearance = char_config.get("appearance", {})
+                appearance = dict(self.cm.get("appearance") or {})
                 
                 font_type_var = self.entries.get("bubble_font_type")
                 font_name_var = self.entries.get("bubble_font_name")
@@ -4076,7 +4722,8 @@ class SettingsWindow:
                 
                 logging.info(f"保存字体配置 - 类型: {font_type}, 名称: {font_name}, 文件: {font_file}")
                 
-                appearance["bubble"] = {
+                # 合并到原有配置，保留设置界面中没有的字段
+                appearance["bubble"] = dict(appearance.get("bubble") or {}, **{
                     "background_color": self.entries.get("bubble_bg", ctk.CTkEntry(self.window)).get(),
                     "border_color": self.entries.get("bubble_border", ctk.CTkEntry(self.window)).get(),
                     "text_color": self.entries.get("bubble_text", ctk.CTkEntry(self.window)).get(),
@@ -4085,10 +4732,11 @@ class SettingsWindow:
                     "padding_y": int(self.entries.get("bubble_padding_y", ctk.CTkSlider(self.window)).get()),
                     "font_size": int(self.entries.get("bubble_font", ctk.CTkSlider(self.window)).get()),
                     "border_width": int(self.entries.get("bubble_border_width", ctk.CTkSlider(self.window)).get()),
+                    "max_height": int(self.entries.get("bubble_max_height", ctk.CTkSlider(self.window)).get()),
                     "font_type": font_type,
                     "font_name": font_name,
                     "font_file": font_file
-                }
+                })
                 appearance["input_box"] = {
                     "background_color": self.entries.get("input_bg", ctk.CTkEntry(self.window)).get(),
                     "border_color": self.entries.get("input_border", ctk.CTkEntry(self.window)).get(),
@@ -4098,20 +4746,20 @@ class SettingsWindow:
                     "corner_radius": int(self.entries.get("input_corner", ctk.CTkSlider(self.window)).get()),
                     "font_size": int(self.entries.get("input_font", ctk.CTkSlider(self.window)).get())
                 }
-                char_config["appearance"] = appearance
+                patch["appearance"] = appearance
             except Exception as e:
                 logging.error(f"Error saving appearance: {e}")
         
-        # 将更新后的角色配置写回总配置
-        new_config["characters"][current_char_id] = char_config
+        # 保存"诊断"标签页（全局配置）
+        if "诊断" in self.tabs_loaded:
+            diagnostics = dict(self.cm.get("diagnostics") or {})
+            diagnostics["tray_menu"] = self.diag_tray_var.get()
+            patch["diagnostics"] = diagnostics
         
         try:
             logging.info("Saving config...")
-            self.cm.save_config(new_config)
-            
-            # 重新加载配置（关键！确保内存中的config与文件一致）
-            logging.info("Reloading config...")
-            self.cm.config = self.cm.load_config()
+            changed = self.cm.apply_patch(patch)
+            logging.info(f"Changed settings: {changed}")
             
             logging.info("Reloading AI client...")
             self.ai_client.reload_client()
@@ -4138,6 +4786,94 @@ class SettingsWindow:
             messagebox.showerror("保存失败", f"保存设置时出错:\n{str(e)}")
             return
 
+class ChatArchiveWindow(ctk.CTkToplevel):
+    """聊天记录窗口：浏览和全文搜索某个角色的全部聊天记录"""
+    MAX_RESULTS = 100
+    
+    def __init__(self, parent, config_manager, char_id, char_name):
+        super().__init__(parent)
+        self.cm = config_manager
+        self.char_id = char_id
+        self.char_name = char_name
+        # 用户称呼取自该角色的配置（不一定是当前角色）
+        snap = self.cm.snapshot_for(char_id)
+        self.user_name = snap.get_user_name() if snap else "用户"
+        self.title(f"聊天记录 - {char_name}")
+        self.geometry("600x650")
+        
+        try:
+            sw = self.winfo_screenwidth()
+            sh = self.winfo_screenheight()
+            x = (sw - 600) // 2
+            y = (sh - 650) // 2
+            self.geometry(f"+{x}+{y}")
+        except:
+            pass
+
+        self.attributes('-topmost', True)
+        self.after(100, lambda: self.attributes('-topmost', False))
+
+        self.setup_ui()
+        self.search()
+        
+    def setup_ui(self):
+        # 顶部
+        header = ctk.CTkFrame(self, fg_color="transparent")
+        header.pack(fill="x", padx=20, pady=(20, 10))
+        ctk.CTkLabel(header, text="聊天记录", font=("Microsoft YaHei UI", 20, "bold")).pack(side="left")
+        
+        # 搜索栏
+        search_frame = ctk.CTkFrame(self, fg_color="transparent")
+        search_frame.pack(fill="x", padx=20, pady=(0, 5))
+        self.search_entry = ctk.CTkEntry(search_frame, placeholder_text="输入关键词搜索（留空显示最近的记录）")
+        self.search_entry.pack(side="left", fill="x", expand=True)
+        self.search_entry.bind("<Return>", lambda e: self.search())
+        ctk.CTkButton(search_frame, text="搜索", width=70, fg_color="#7EA0B7", command=self.search).pack(side="left", padx=(10, 0))
+        
+        self.status_label = ctk.CTkLabel(self, text="", font=("Microsoft YaHei UI", 11), text_color="gray", anchor="w")
+        self.status_label.pack(fill="x", padx=25)
+        
+        # 结果列表
+        self.scroll = ctk.CTkScrollableFrame(self, fg_color="#F2F2F7", corner_radius=15)
+        self.scroll.pack(fill="both", expand=True, padx=20, pady=(5, 20))
+        
+    def search(self):
+        for widget in self.scroll.winfo_children():
+            widget.destroy()
+        
+        query = self.search_entry.get().strip()
+        start = time.perf_counter()
+        if query:
+            messages = self.cm.search_chat_history(query, limit=self.MAX_RESULTS, char_id=self.char_id)
+        else:
+            messages = list(reversed(self.cm.get_chat_history(self.MAX_RESULTS, char_id=self.char_id)))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        
+        total = self.cm.count_chat_messages(char_id=self.char_id)
+        if query:
+            self.status_label.configure(text=f"共 {total} 条记录，找到 {len(messages)} 条（{elapsed_ms:.1f} ms）")
+        else:
+            self.status_label.configure(text=f"共 {total} 条记录，显示最近 {len(messages)} 条")
+        
+        if not messages:
+            ctk.CTkLabel(self.scroll, text="没有找到相关记录" if query else "暂无聊天记录", text_color="gray").pack(pady=50)
+            return
+        
+        for msg in messages:
+            self.create_item(msg)
+    
+    def create_item(self, msg):
+        is_user = msg["role"] == "user"
+        card = ctk.CTkFrame(self.scroll, fg_color="#E3F2FD" if is_user else "white", corner_radius=10)
+        card.pack(fill="x", pady=4, padx=5)
+        
+        speaker = self.user_name if is_user else self.char_name
+        ts = msg.get("ts", "")[:16].replace("T", " ")
+        ctk.CTkLabel(card, text=f"{speaker}  ·  {ts}", font=("Microsoft YaHei UI", 11, "bold"),
+                    text_color="#1976D2" if is_user else "#555555", anchor="w").pack(fill="x", padx=12, pady=(8, 0))
+        ctk.CTkLabel(card, text=msg["content"], font=("Microsoft YaHei UI", 12), text_color="#333333",
+                    anchor="w", justify="left", wraplength=500).pack(fill="x", padx=12, pady=(2, 8))
+
 class CharacterManagerWindow(ctk.CTkToplevel):
     """角色管理窗口"""
     def __init__(self, parent, config_manager, app):
@@ -4245,6 +4981,10 @@ class CharacterManagerWindow(ctk.CTkToplevel):
             ctk.CTkButton(btn_frame, text="切换", width=60, height=30, fg_color="#4CAF50", hover_color="#45A049", 
                           command=lambda: self.switch_character(char_info["id"])).pack(side="left", padx=5)
         
+        # 聊天记录按钮
+        ctk.CTkButton(btn_frame, text="记录", width=60, height=30, fg_color="#607D8B", hover_color="#546E7A",
+                      command=lambda: ChatArchiveWindow(self, self.cm, char_info["id"], char_info["name"])).pack(side="left", padx=5)
+        
         # 导出按钮
         ctk.CTkButton(btn_frame, text="导出", width=60, height=30, fg_color="#9C27B0", hover_color="#7B1FA2",
                       command=lambda: self.export_character(char_info["id"])).pack(side="left", padx=5)
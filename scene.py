@@ -0,0 +1,116 @@
+import logging
+
+render_logger = logging.getLogger("Render")
+
+
+class CanvasScene:
+    """主窗口画布上常驻的图元（立绘、气泡等）
+
+    每个图元按名称只创建一次，之后通过 coords/itemconfig 原地更新，不再删除重建。
+    同一帧内的多次修改先记录下来，在 Tk 空闲时一次性提交（flush），
+    读取位置/边界前也会先提交，保证读到的是最新状态。
+    画布正在显示的图片由场景持有引用，调用方替换自己的引用后提交前也不会出现空白。
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self._items = {}  # {名称: 图元ID}
+        self._images = {}  # {名称: 画布上正在显示的 PhotoImage}
+        self._pending = {}  # {名称: {"coords": (x, y), "config": {...}}}
+        self._flush_job = None
+
+    def has(self, name):
+        return name in self._items
+
+    def image(self, name, x, y, image, anchor="nw", tags=()):
+        """放置图片图元：不存在时创建，否则原地更新图片、位置并显示"""
+        if name not in self._items:
+            self._items[name] = self.canvas.create_image(x, y, image=image, anchor=anchor, tags=tags)
+            self._images[name] = image
+            render_logger.debug(f"Scene item created: {name}")
+            return
+        self._queue(name, coords=(x, y), image=image, anchor=anchor, state="normal")
+
+    def set_image(self, name, image):
+        """只更换图元的图片（位置不变）"""
+        self._queue(name, image=image, state="normal")
+
+    def current_image(self, name):
+        """图元当前（包含尚未提交的修改）显示的图片"""
+        pending = self._pending.get(name, {}).get("config", {}).get("image")
+        return pending if pending is not None else self._images.get(name)
+
+    def coords(self, name):
+        """图元的锚点位置（包含尚未提交的修改），不存在时返回 None"""
+        if name not in self._items:
+            return None
+        pending = self._pending.get(name, {}).get("coords")
+        if pending:
+            return pending
+        coords = self.canvas.coords(self._items[name])
+        return (coords[0], coords[1]) if coords else None
+
+    def move_to(self, name, x, y):
+        self._queue(name, coords=(x, y))
+
+    def move(self, name, dx, dy):
+        pos = self.coords(name)
+        if pos:
+            self.move_to(name, pos[0] + dx, pos[1] + dy)
+
+    def show(self, name):
+        self._queue(name, state="normal")
+
+    def hide(self, name):
+        self._queue(name, state="hidden")
+
+    def is_visible(self, name):
+        if name not in self._items:
+            return False
+        state = self._pending.get(name, {}).get("config", {}).get("state")
+        if state is None:
+            state = self.canvas.itemcget(self._items[name], "state")
+        return state != "hidden"
+
+    def bbox(self, name):
+        """图元的边界框（先提交未完成的修改）"""
+        if name not in self._items:
+            return None
+        self.flush()
+        return self.canvas.bbox(self._items[name])
+
+    def remove(self, name):
+        item = self._items.pop(name, None)
+        self._pending.pop(name, None)
+        self._images.pop(name, None)
+        if item is not None:
+            self.canvas.delete(item)
+
+    def _queue(self, name, coords=None, **config):
+        if name not in self._items:
+            return
+        entry = self._pending.setdefault(name, {})
+        if coords is not None:
+            entry["coords"] = coords
+        if config:
+            entry.setdefault("config", {}).update(config)
+        if self._flush_job is None:
+            self._flush_job = self.canvas.after_idle(self.flush)
+
+    def flush(self):
+        """把记录的修改提交到画布"""
+        if self._flush_job is not None:
+            self.canvas.after_cancel(self._flush_job)
+            self._flush_job = None
+        pending, self._pending = self._pending, {}
+        for name, entry in pending.items():
+            item = self._items.get(name)
+            if item is None:
+                continue
+            if "coords" in entry:
+                self.canvas.coords(item, *entry["coords"])
+            config = entry.get("config")
+            if config:
+                self.canvas.itemconfig(item, **config)
+                if "image" in config:
+                    self._images[name] = config["image"]
@@ -0,0 +1,313 @@
+import os
+import re
+import logging
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image as PILImage
+
+from utils import resource_path
+
+logger = logging.getLogger("Sprites")
+
+# 立绘显示的最大高度（超过时按比例缩小）
+SPRITE_MAX_HEIGHT = 400
+# alpha 大于该值的像素保持不透明，其余变为完全透明
+ALPHA_THRESHOLD = 200
+# 后台解码的线程数（Pillow 解码和缩放时会释放 GIL，少量线程即可并行）
+SPRITE_WORKERS = min(4, os.cpu_count() or 1)
+
+_EXPRESSION_TAG_RE = re.compile(r'\[([^\]]+)\]')
+
+
+def resolve_sprite_path(filename):
+    """优先使用当前目录的自定义立绘，否则使用打包的默认立绘；都不存在时返回 None"""
+    if not filename:
+        return None
+    if os.path.exists(filename):
+        return filename
+    path = resource_path(filename)
+    return path if os.path.exists(path) else None
+
+
+def binarize_alpha(image, threshold=ALPHA_THRESHOLD):
+    """二值化 Alpha 通道：移除所有半透明像素（原地修改并返回 image）"""
+    image.putalpha(image.getchannel('A').point(lambda x: 255 if x > threshold else 0))
+    return image
+
+
+def decode_sprite(filename, max_height=SPRITE_MAX_HEIGHT):
+    """读取并预处理立绘，返回 [(RGBA 模式的 PIL 图片, 显示毫秒数)]（失败时返回 None）
+
+    静态图片只有一帧（显示毫秒数为 0）；GIF/APNG 动图的每一帧都会解码出来，之后循环播放。
+    只使用 Pillow，不涉及 Tk，可以在后台线程中调用。
+
+    重要说明：
+    - tkinter使用-transparentcolor技术实现透明窗口
+    - 该技术将亮粉色(#ff00ff)像素视为透明
+    - PNG边缘的半透明像素会与粉色背景混合，产生粉色边缘
+    - 解决方案：对alpha通道进行二值化处理（牺牲抗锯齿，换取无粉边）
+
+    最佳实践：
+    - 在Photoshop中预处理PNG，去除半透明像素（参见PNG处理指南.md）
+    - 这样可以获得最佳显示效果
+    """
+    img_path = resolve_sprite_path(filename)
+    if not img_path:
+        return None
+
+    try:
+        source = PILImage.open(img_path)
+        frame_count = getattr(source, "n_frames", 1)
+        frames = []
+        for index in range(frame_count):
+            source.seek(index)
+            # 确保图像为RGBA模式（支持透明度）
+            pil_image = source.convert('RGBA')
+
+            # 缩放处理 - 使用高质量的LANCZOS算法
+            if pil_image.height > max_height:
+                ratio = max_height / pil_image.height
+                new_width = int(pil_image.width * ratio)
+                pil_image = pil_image.resize((new_width, max_height), PILImage.Resampling.LANCZOS)
+
+            # 阈值200而不是128可以保留更多边缘细节
+            duration = source.info.get("duration", 0) if frame_count > 1 else 0
+            frames.append((binarize_alpha(pil_image), duration))
+        return frames
+    except Exception as e:
+        logger.error(f"Error loading image {filename}: {e}")
+        return None
+
+
+class SpriteLoader:
+    """在线程池中批量解码立绘
+
+    每次 load() 开始新的一批，之前未完成的批次作废（切换角色时旧角色的立绘不会再送达）。
+    回调在工作线程中执行，调用方需自行切回 Tk 主线程再创建 PhotoImage。
+    """
+
+    def __init__(self, max_workers=SPRITE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="SpriteLoader")
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._futures = []
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def load(self, sprites, on_ready):
+        """后台解码 sprites（{表情标签: 文件名}），每张完成后调用 on_ready(generation, tag, frames)
+
+        frames 为 decode_sprite 的结果，None 表示加载失败。返回本批次的 generation。
+        """
+        with self._lock:
+            self._cancel_locked()
+            for tag, filename in sprites.items():
+                self._submit_locked(tag, filename, on_ready)
+            generation = self._generation
+        logger.debug(f"Queued {len(sprites)} sprites (generation {generation})")
+        return generation
+
+    def submit(self, tag, filename, on_ready):
+        """在当前批次中追加一张立绘（不作废正在解码的其他立绘）"""
+        with self._lock:
+            self._submit_locked(tag, filename, on_ready)
+            return self._generation
+
+    def _submit_locked(self, tag, filename, on_ready):
+        generation = self._generation
+        future = self._executor.submit(decode_sprite, filename)
+        future.add_done_callback(lambda f: self._deliver(generation, tag, f, on_ready))
+        self._futures = [f for f in self._futures if not f.done()] + [future]
+
+    def cancel(self):
+        """作废尚未送达的解码结果"""
+        with self._lock:
+            self._cancel_locked()
+
+    def _cancel_locked(self):
+        self._generation += 1
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+
+    def _deliver(self, generation, tag, future, on_ready):
+        if future.cancelled() or generation != self._generation:
+            return
+        try:
+            on_ready(generation, tag, future.result())
+        except Exception as e:
+            logger.error(f"Sprite callback failed for {tag}: {e}")
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class SpriteFrames:
+    """动图立绘：[(PhotoImage, 显示毫秒数)]，width/height 与第一帧相同，可以和 PhotoImage 一样放入缓存"""
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    @property
+    def first(self):
+        return self.frames[0][0]
+
+    def width(self):
+        return self.first.width()
+
+    def height(self):
+        return self.first.height()
+
+
+def photo_bytes(photo):
+    """PhotoImage（或 SpriteFrames 的全部帧）占用内存的估算值（RGBA 每像素 4 字节）"""
+    if not photo:
+        return 0
+    frames = getattr(photo, "frames", None)
+    if frames:
+        return sum(p.width() * p.height() * 4 for p, _ in frames)
+    return photo.width() * photo.height() * 4
+
+
+def likely_expressions(messages, tags, limit):
+    """根据近期 AI 回复中表情标签出现的次数，返回最常用的 limit 个表情（只包含 tags 中的）"""
+    if limit <= 0:
+        return []
+    counts = Counter()
+    for m in messages:
+        if m.get("role") == "assistant":
+            counts.update(t for t in _EXPRESSION_TAG_RE.findall(m.get("content", "")) if t in tags)
+    return [tag for tag, _ in counts.most_common(limit)]
+
+
+class ExpressionCache:
+    """按最近使用顺序（LRU）保存表情立绘，超出内存上限时淘汰最久未用的
+
+    常驻（pinned）的表情和正在显示的表情不会被淘汰；
+    正在显示的表情被淘汰会让 Tk 删除画布上的图片，所以必须通过 set_active 告知。
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.pinned = set()
+        self.active = None
+        self._photos = OrderedDict()  # {表情标签: PhotoImage}，最近使用的在末尾
+        self._sizes = {}
+        self.total_bytes = 0
+
+    def __contains__(self, tag):
+        return tag in self._photos
+
+    def __len__(self):
+        return len(self._photos)
+
+    def get(self, tag, default=None):
+        photo = self._photos.get(tag)
+        if photo is None:
+            return default
+        self._photos.move_to_end(tag)
+        return photo
+
+    def items(self):
+        return list(self._photos.items())
+
+    def put(self, tag, photo):
+        if photo is None:
+            return
+        self.pop(tag)
+        self._photos[tag] = photo
+        self._sizes[tag] = photo_bytes(photo)
+        self.total_bytes += self._sizes[tag]
+        self._evict()
+
+    def pop(self, tag, default=None):
+        photo = self._photos.pop(tag, None)
+        if photo is None:
+            return default
+        self.total_bytes -= self._sizes.pop(tag, 0)
+        return photo
+
+    def clear(self):
+        self._photos.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+        self.active = None
+
+    def set_active(self, tag):
+        self.active = tag
+        self._evict()
+
+    def _evict(self):
+        if not self.budget_bytes or self.total_bytes <= self.budget_bytes:
+            return
+        for tag in list(self._photos):
+            if self.total_bytes <= self.budget_bytes:
+                break
+            if tag in self.pinned or tag == self.active:
+                continue
+            self.pop(tag)
+            logger.debug(f"Evicted expression {tag} ({self.total_bytes}/{self.budget_bytes} bytes)")
+
+
+class ResidentCharacters:
+    """最近使用过的其他角色已加载的资源（表情缓存、字体等），切回这些角色时直接复用
+
+    按最近使用顺序保存，超出角色数或内存上限时淘汰最久未用的角色。
+    fingerprint 为保存时角色的立绘/外观配置，取出时配置已变化则视为失效。
+    """
+
+    def __init__(self, max_characters, budget_bytes):
+        self.max_characters = max_characters
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # {角色ID: (fingerprint, 资源, 字节数)}，最近使用的在末尾
+        self.total_bytes = 0
+
+    def __contains__(self, char_id):
+        return char_id in self._entries
+
+    def park(self, char_id, fingerprint, resources, size_bytes):
+        """保存角色的资源，返回因此被淘汰的角色ID列表"""
+        self.discard(char_id)
+        if self.max_characters <= 0:
+            return [char_id]
+        self._entries[char_id] = (fingerprint, resources, size_bytes)
+        self.total_bytes += size_bytes
+        return self.trim()
+
+    def peek(self, char_id, fingerprint):
+        """角色的资源是否可用（不取出）"""
+        entry = self._entries.get(char_id)
+        return entry is not None and entry[0] == fingerprint
+
+    def take(self, char_id, fingerprint):
+        """取出角色的资源，不存在或已失效时返回 None"""
+        entry = self._entries.get(char_id)
+        if entry is None:
+            return None
+        self.discard(char_id)
+        if entry[0] != fingerprint:
+            logger.debug(f"Resident resources of {char_id} are stale")
+            return None
+        return entry[1]
+
+    def discard(self, char_id):
+        entry = self._entries.pop(char_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def trim(self):
+        """按当前上限淘汰最久未用的角色，返回被淘汰的角色ID列表"""
+        evicted = []
+        while self._entries and (len(self._entries) > self.max_characters
+                                 or (self.budget_bytes and self.total_bytes > self.budget_bytes)):
+            char_id = next(iter(self._entries))
+            self.discard(char_id)
+            evicted.append(char_id)
+        if evicted:
+            logger.debug(f"Evicted resident characters {evicted} ({self.total_bytes}/{self.budget_bytes} bytes)")
+        return evicted
@@ -0,0 +1,119 @@
+import logging
+
+from PIL import Image as PILImage
+from PIL import ImageChops, ImageDraw
+
+touch_logger = logging.getLogger("Touch")
+
+# 触摸区域网格索引的格子边长（像素）
+TOUCH_GRID_CELL = 32
+
+
+class SpriteMask:
+    """按行打包的 1 位位图（与 PIL "1" 模式的原始数据相同：每行按字节对齐，高位在前）
+
+    用于判断某个像素是否不透明 / 是否在多边形区域内，查询为 O(1)。
+    """
+    __slots__ = ("width", "height", "stride", "bits")
+
+    def __init__(self, width, height, bits):
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+        self.bits = bits
+
+    @classmethod
+    def from_image(cls, image, threshold=0):
+        """从 "L" 模式图片（alpha 通道）生成位图，大于 threshold 的像素为 1"""
+        bitmap = image.point(lambda v: 255 if v > threshold else 0, "1")
+        return cls(bitmap.width, bitmap.height, bitmap.tobytes())
+
+    def contains(self, x, y):
+        x, y = int(x), int(y)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        return bool(self.bits[y * self.stride + (x >> 3)] & (0x80 >> (x & 7)))
+
+    def nbytes(self):
+        return len(self.bits)
+
+
+def sprite_mask(frames):
+    """立绘的不透明像素位图（frames 为 decode_sprite 的结果；动图取所有帧的并集）"""
+    if not frames:
+        return None
+    try:
+        alpha = frames[0][0].getchannel("A")
+        for image, _ in frames[1:]:
+            if image.size == alpha.size:
+                alpha = ImageChops.lighter(alpha, image.getchannel("A"))
+        return SpriteMask.from_image(alpha)
+    except Exception as e:
+        touch_logger.error(f"Failed to build sprite mask: {e}")
+        return None
+
+
+def area_points(area):
+    """多边形区域的顶点列表 [(x, y)]，矩形区域返回 None"""
+    if area.get("shape") != "polygon":
+        return None
+    points = [(int(p[0]), int(p[1])) for p in area.get("points") or () if len(p) >= 2]
+    return points if len(points) >= 3 else None
+
+
+class TouchIndex:
+    """触摸区域的网格索引
+
+    每个格子记录与之重叠的区域（保持配置中的先后顺序，先配置的区域优先），
+    点击时只检查所在格子里的几个区域。自由绘制的多边形区域预先栅格化为位图。
+    坐标均相对于立绘左上角。
+    """
+
+    def __init__(self, areas, cell=TOUCH_GRID_CELL):
+        self.cell = cell
+        self._shapes = []  # [(区域配置, x, y, 宽, 高, 多边形位图或 None)]
+        self._grid = {}  # {(列, 行): [self._shapes 的序号]}
+        for area in areas or ():
+            try:
+                shape = self._compile(area)
+            except Exception as e:
+                touch_logger.error(f"Invalid touch area {area.get('name')}: {e}")
+                continue
+            if shape is None:
+                continue
+            index = len(self._shapes)
+            self._shapes.append(shape)
+            _, x, y, w, h, _ = shape
+            for col in range(x // cell, (x + w) // cell + 1):
+                for row in range(y // cell, (y + h) // cell + 1):
+                    self._grid.setdefault((col, row), []).append(index)
+        touch_logger.debug(f"Touch index built: {len(self._shapes)} areas, {len(self._grid)} cells")
+
+    def __len__(self):
+        return len(self._shapes)
+
+    @staticmethod
+    def _compile(area):
+        points = area_points(area)
+        if points is None:
+            x, y = int(area.get("x", 0)), int(area.get("y", 0))
+            w, h = int(area.get("width", 0)), int(area.get("height", 0))
+            if w < 0 or h < 0:
+                return None
+            return (area, x, y, w, h, None)
+
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        x, y = min(xs), min(ys)
+        w, h = max(xs) - x, max(ys) - y
+        bitmap = PILImage.new("L", (w + 1, h + 1), 0)
+        ImageDraw.Draw(bitmap).polygon([(px - x, py - y) for px, py in points], fill=255, outline=255)
+        return (area, x, y, w, h, SpriteMask.from_image(bitmap))
+
+    def hit(self, x, y):
+        """返回包含 (x, y) 的第一个区域配置，没有时返回 None"""
+        for index in self._grid.get((int(x) // self.cell, int(y) // self.cell), ()):
+            area, ax, ay, aw, ah, mask = self._shapes[index]
+            if ax <= x <= ax + aw and ay <= y <= ay + ah and (mask is None or mask.contains(x - ax, y - ay)):
+                return area
+        return None
@@ -1,7 +1,9 @@
 import os
 import sys
+import queue
+import atexit
 import logging
-import datetime
+import logging.handlers
 import urllib.request
 import urllib.parse
 import json
@@ -21,32 +23,93 @@ def resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
-def setup_logging(max_lines=800):
-    """配置日志系统，并清理过大的日志文件"""
-    log_file = 'debug.log'
+# 后台写日志的监听器及其文件 handler（setup_logging 中创建，进程退出时停止）
+_log_listener = None
+_log_file_handler = None
+# RotatingFileHandler 在 backupCount 为 0 时永远不会滚动，日志会无限增长，因此至少保留 1 个旧文件
+MIN_LOG_BACKUPS = 1
+
+def setup_logging(max_bytes=2 * 1024 * 1024, backup_count=3):
+    """配置日志系统
     
-    # 检查日志文件是否过大，如果超过指定行数则清理
-    if os.path.exists(log_file):
-        try:
-            with open(log_file, 'r', encoding='utf-8', errors='ignore') as f:
-                lines = f.readlines()
-            
-            # 如果超过最大行数，只保留最后max_lines行
-            if len(lines) > max_lines:
-                with open(log_file, 'w', encoding='utf-8') as f:
-                    f.write(f"# 日志已自动清理，保留最近{max_lines}条记录\n")
-                    f.write(f"# 清理时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                    f.writelines(lines[-max_lines:])
-        except Exception as e:
-            print(f"日志清理失败: {e}")
+    各线程只把日志记录放进队列，由后台线程统一写入文件，
+    避免 UI 线程等待磁盘 I/O。日志按大小滚动：debug.log 超过 max_bytes 时
+    改名为 debug.log.1（依次后移，最多保留 backup_count 个旧文件，至少为 1），
+    程序长时间运行时同样生效，启动时也不需要读取旧日志。
+    """
+    global _log_listener, _log_file_handler
+    if _log_listener is not None:
+        return
+    
+    log_file = 'debug.log'
     
-    # 配置日志
-    logging.basicConfig(
-        filename=log_file,
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
+    # 配置日志：QueueHandler -> 队列 -> QueueListener(后台线程) -> 滚动文件
+    _log_file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=max(int(backup_count), MIN_LOG_BACKUPS), encoding='utf-8'
     )
+    _log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, _log_file_handler, respect_handler_level=True)
+    _log_listener.start()
+    # 退出时把队列里剩余的日志写完
+    atexit.register(_log_listener.stop)
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def apply_log_rotation(max_bytes=None, backup_count=None):
+    """运行时调整日志滚动参数（读取配置后调用）"""
+    if _log_file_handler is None:
+        return
+    if max_bytes:
+        _log_file_handler.maxBytes = int(max_bytes)
+    if backup_count is not None:
+        _log_file_handler.backupCount = max(int(backup_count), MIN_LOG_BACKUPS)
+
+def apply_log_levels(levels):
+    """按子系统设置日志级别
+    
+    Args:
+        levels: {logger 名称: 级别名}，"root" 表示根 logger，如 {"root": "DEBUG", "Touch": "INFO"}
+    """
+    for name, level_name in (levels or {}).items():
+        level = logging.getLevelName(str(level_name).upper())
+        if not isinstance(level, int):
+            logging.warning(f"Invalid log level for {name}: {level_name}")
+            continue
+        logger = logging.getLogger() if name == "root" else logging.getLogger(name)
+        logger.setLevel(level)
+
+def atomic_write_text(path, text, encoding='utf-8'):
+    """原子地写入文本文件：先写临时文件并 fsync，再用 os.replace 替换
+
+    写入过程中崩溃或断电时，目标文件要么是旧内容，要么是新内容，不会被截断。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding=encoding) as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # 同步目录项，确保重命名本身落盘（Windows 不支持打开目录，忽略）
+    if hasattr(os, "O_DIRECTORY"):
+        try:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+def truncate_for_log(text, max_chars):
+    """截断写入日志的大段文本（max_chars <= 0 表示不截断）"""
+    if max_chars and max_chars > 0 and len(text) > max_chars:
+        return f"{text[:max_chars]}... (共 {len(text)} 字符，已截断)"
+    return text
 
 def name_to_pinyin(name):
     """将中文名称转换为拼音（用于生成角色ID）
@@ -80,6 +143,59 @@ def name_to_pinyin(name):
         logging.error(f"Failed to convert name to pinyin: {e}, using UUID")
         return str(uuid.uuid4())[:8]
 
+# 中日韩统一表意文字、假名、全角标点等，大多数分词器里每个字约占 1 个 Token
+_CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+def is_cjk(token):
+    """token 是否以中日韩字符开头（search_tokens 切出的中日韩单字）"""
+    return bool(token) and _CJK_RE.match(token) is not None
+
+def estimate_tokens(text):
+    """粗略估算文本的 Token 数（不依赖具体模型的分词器）
+
+    中日韩字符按每字 1 个 Token 计，其余字符按每 4 个字符 1 个 Token 计。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+# 全文检索分词：中日韩字符逐字切分，其余按单词切分
+_SEARCH_TOKEN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]|[0-9A-Za-z_]+')
+
+def search_tokens(text):
+    """把文本切分为检索用的词（中日韩单字 + 小写英文单词/数字）"""
+    if not text:
+        return []
+    return [t.lower() for t in _SEARCH_TOKEN_RE.findall(text)]
+
+def segment_for_search(text):
+    """把文本转换为用空格分隔的词，供 SQLite FTS5 的 unicode61 分词器索引"""
+    return " ".join(search_tokens(text))
+
+def build_fts_query(text, match_all=True):
+    """把用户输入转换为 FTS5 查询语句
+
+    match_all=True：每段连续的中文按短语匹配、各段之间为 AND（用于搜索框）；
+    match_all=False：中文按相邻二字短语、各项之间为 OR，由 bm25 排序（用于相关记忆召回）。
+    返回 None 表示没有可检索的内容。
+    """
+    if not text:
+        return None
+    terms = []
+    for run in re.findall(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9A-Za-z_]+', text):
+        tokens = search_tokens(run)
+        if match_all or len(tokens) < 2:
+            terms.append('"' + " ".join(tokens) + '"')
+        else:
+            terms.extend(f'"{a} {b}"' for a, b in zip(tokens, tokens[1:]))
+    if not terms:
+        return None
+    # 去重并保持顺序
+    terms = list(dict.fromkeys(terms))
+    return (" AND " if match_all else " OR ").join(terms)
+
 def parse_sillytavern_card(png_path):
     """解析 SillyTavern 角色卡 PNG
     
@@ -196,7 +312,8 @@ def parse_sillytavern_card(png_path):
                                 "id": str(entry.get("id", len(lorebook))),
                                 "type": entry_type,
                                 "keywords": keywords,
-                                "content": content
+                                "content": content,
+                                "insertion_order": entry.get("insertion_order", 0)
                             }
                             
                             lorebook.append(lorebook_entry)